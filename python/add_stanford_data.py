@@ -5,9 +5,10 @@ of previously added datasets.
 """
 
 import pandas as pd
-import requests
 from datetime import datetime
 
+import download_cache
+
 plot_flag = False
 
 new_cases = {'New Jersey Camden':'Camden County Police Department',
@@ -155,7 +156,7 @@ df = df[not_stanford]
 
 url = "https://openpolicing.stanford.edu/data/"
 
-r = requests.get(url)
+r = download_cache.get(url)
 
 row_states = df["State"].to_list()
 row_pds = ["Charlotte" if x == "Charlotte-Mecklenburg" else x for x in df["Agency"].to_list()]
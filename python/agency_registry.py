@@ -0,0 +1,346 @@
+"""Registry of the police agencies in the OPD source table, updated incrementally.
+
+Finding the agencies in multi-agency datasets takes hours, but only a few rows of the source table change between
+runs. The registry stores each agency (canonical name and state) with the names it was found under (aliases) and
+the source_table_ids of the rows that contain it. When count_agencies runs, only rows that are new or whose agency
+fields changed (and multi-year multi-agency rows that have not been checked for REFRESH_DAYS) are read, and
+agencies are removed when the last row that contains them is deleted from the table. The number of agencies is
+always available without reading any data:
+
+    python agency_registry.py
+
+add_agency decides whether a name is a new agency or another name of a known agency.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, Optional
+
+import pandas as pd
+from rapidfuzz import fuzz
+
+import openpolicedata as opd
+
+import state
+
+
+STATE_FILE = "agency_registry.json"
+# Multi-year datasets can add agencies without the row changing
+REFRESH_DAYS = 30
+FINGERPRINT_FIELDS = ["State", "Agency", "AgencyFull", "Year", "agency_field", "query"]
+
+ca_state_prison = "California St Prison"
+st_univ_police = 'St University Police'
+
+agency_types = ['Police',"Sheriffs", 'St Prison for Women',"St Prison",
+                "St Hospital", "Probation", "Department of Corrections",'Health Care Facility','Medical Facility',
+                'Department of Public Safety','Community Correctional Facility', 'Prison', 
+                'Department of Forestry & Fire Protection','Department of Parks & Recreation','Transit',
+                'Unified School District Police','Sheriff','Forest Preserve Police',
+                'Park District Police','University Police','Illinois University Police',
+                'Transit Administration Police', 'District Attorney']
+agency_types.sort(key=len, reverse=True)
+agency_types = [x.title() for x in agency_types]
+agency_types = [re.sub(r"s\s",' ',x) for x in agency_types]
+
+p = re.compile(r"\s("+"|".join(agency_types)+r").*$", re.IGNORECASE)
+
+def clean(x):
+    return p.sub("", x).strip()
+
+def add_agency(agency_name_orig, state, agencies):
+    """Add an agency name to agencies (list of (canonical name, state)) unless it is another name of an agency that
+    is already in it. A canonical name may be replaced by a longer name of the same agency.
+
+    Returns the canonical name that agency_name_orig was added or matched to or None if it was not recognized.
+    """
+    agency_name = agency_name_orig.strip().title()\
+                             .replace("Allegany","Alleghany")\
+                             .replace(" Co. ", " County ")\
+                             .replace(" So"," Sheriff").title()
+    agency_name = re.sub('(.+) \\1', '\\1', agency_name)
+
+    agency_name = re.sub(r"['’]?s?\s*(Department|Office|dept\.?)", "", agency_name, flags=re.IGNORECASE)
+    agency_name = re.sub(r'\sPD\b',r' Police',agency_name, flags=re.IGNORECASE)
+    agency_name = re.sub(r"(\w+)pd",'\\1 Police', agency_name.lower(), flags=re.IGNORECASE)
+    agency_name = re.sub(r"\sSd$",r" Sheriff",agency_name, flags=re.IGNORECASE)
+    agency_name = re.sub(r"\sDa$",r" District Attorney",agency_name, flags=re.IGNORECASE)
+    agency_name = re.sub(r"P(oli|rin)$",r"Police",agency_name)
+    agency_name = re.sub('Csp Troop [A-Z]','Connecticut St Police',agency_name)
+    agency_name = re.sub(r'\s+',' ',agency_name)
+    agency_name = re.sub(r'\buniv\.?\b','university',agency_name, flags=re.IGNORECASE)
+    # agency_name = re.sub(r"('s|s|')\s",' ',agency_name.lower())
+    agency_name = re.sub(r"\sco\.?(?=\s|$)",' county',agency_name)
+    # Both saint and state can be abbreviated st so just convert to abbreviation
+    agency_name = re.sub(r"\b(state|saint)\b", "st", agency_name,  flags=re.IGNORECASE)
+    agency_name = re.sub(r"\s*\#?\s*\d+$", "", agency_name)  # Remove any numbers at the end that may indicate parts of a larger org
+    agency_name = agency_name.replace("-",' ').replace(',','')
+    agency_name = agency_name.title()
+    agency = clean(agency_name)
+    reduced_agencies = [x[0] for x in agencies if x[1]==state]
+    cleaned_agencies = [clean(x) for x in reduced_agencies]
+    cur_type = [x for x in agency_types if x in agency_name]
+    cur_type = cur_type[0] if len(cur_type)>0 else None
+    matches = [x.replace('-',' ')==agency.replace('-',' ') for x in cleaned_agencies]
+    if len([m.start() for m in re.finditer('department', agency_name, re.IGNORECASE)])>1:
+        # Word department is repeated. String likely contains multiple departments or same one repeated
+        return
+    if any(matches):
+        full_names = [x for x,y in zip(reduced_agencies, matches) if y]
+        match_types = []
+        for y in full_names:
+            full_type = [x for x in agency_types if x in y]
+            match_types.append(full_type[0] if len(full_type)>0 else None)
+        if any([x.replace('-',' ') == agency_name.replace('-',' ') for x in full_names]) or \
+            full_names[0].lower().replace(" ", "").startswith(agency_name.replace(" ", "").lower()):
+            return next((x for x in full_names if x.replace('-',' ') == agency_name.replace('-',' ')), full_names[0])
+        elif cur_type is not None and all([x is not None and (w.startswith(ca_state_prison) or x!=cur_type) for w,x in zip(full_names,match_types)]):
+            agencies.append((agency_name,state))
+        elif agency_name.startswith(st_univ_police) and all([x.startswith(st_univ_police) and \
+                x.replace(st_univ_police,'').strip() != agency_name.replace(st_univ_police,'').strip() for x in full_names]):
+            agencies.append((agency_name,state))
+        elif len(full_names) != 1:
+            if agency_name.startswith(ca_state_prison) and \
+                all([x.startswith(ca_state_prison) and x.split(',')[1] != agency_name.split(',')[1] for x in full_names]):
+                agencies.append((agency_name,state))
+            # elif any(['Departmentuthern' in x for x in full_names]):
+            #     return
+            else:
+                return
+        else:
+            full_type = [x for x in agency_types if x in full_names[0]]
+            if cur_type is not None and len(full_type)>=1 and cur_type!=full_type[0] and \
+                full_names[0].replace(full_type[0],cur_type) == agency_name:
+                agencies.append((agency_name,state))
+            elif (full_names[0].startswith(ca_state_prison) and agency_name.startswith(ca_state_prison) and \
+                full_names[0].split(',')[1] != agency_name.split(',')[1]) or \
+                    full_names[0].startswith(ca_state_prison) + agency_name.startswith(ca_state_prison)==1:
+                agencies.append((agency_name,state))
+            elif full_names[0].startswith(st_univ_police) and agency_name.startswith(st_univ_police) and \
+                full_names[0].replace(st_univ_police,'').strip() != agency_name.replace(st_univ_police,'').strip():
+                agencies.append((agency_name,state))
+            elif agency_name.split('-')[0].strip() == full_names[0]:
+                return full_names[0]
+            elif (full_names[0].startswith(agency_name) and cur_type is None):
+                return full_names[0]
+            elif agency_name.startswith(full_names[0]) and len(full_type)==0:
+                k = [k for k,x in enumerate(agencies) if x==(full_names[0],state)][0]
+                agencies[k] = (agency_name,state)
+            elif agency_name.startswith(full_names[0]) and '-' in agency_name_orig:
+                # This was found when 2 departments were concatenated with a -
+                return full_names[0]
+            else:
+                return
+    else:
+        def fuzzclean(x):
+            return x.replace("County","").replace("University Of","")
+        ratios = [fuzz.ratio(fuzzclean(agency), fuzzclean(x)) for x in cleaned_agencies]
+        if len(ratios)> 0 and max(ratios)>86:
+            high_scoring = [x for x,y in zip(cleaned_agencies, ratios) if y==max(ratios)]
+            if high_scoring[0]=="Chico" and agency=="Chino":
+                return
+            r = [x for x,y in zip(reduced_agencies,cleaned_agencies) if y in high_scoring]
+            match_types = []
+            for y in r:
+                full_type = [x for x in agency_types if x in y]
+                match_types.append(full_type[0] if len(full_type)>0 else None)
+            keep = [cur_type is None or x is None or x==cur_type for x in match_types]
+            match_types = [x for x,y in zip(match_types, keep) if y]
+            r = [x for x,y in zip(r, keep) if y]
+            if len(r)==0:
+                agencies.append((agency_name,state))
+            elif len(r)>0 and cur_type is not None and \
+                any([y is not None and y==cur_type and fuzz.ratio(agency_name, x)>98 for x,y in zip(r,match_types)]):
+                return next(x for x,y in zip(r,match_types) if y is not None and y==cur_type and fuzz.ratio(agency_name, x)>98)
+            elif len(r)==1:
+                if agency.replace("Women","Men")==r[0] or\
+                    agency_name.replace("Park","Beach")==r[0] or\
+                    agency.replace("Center","Institution")==r[0] or \
+                    agency_name.replace("County ","")==r[0] or \
+                    ((a:=re.match(r"Sant?a?\s([A-Z][a-z]+)", agency_name)) and (b:=re.match(r"Sant?a?\s([A-Z][a-z]+)", r[0])) and a.group(1)!=b.group(1)) or \
+                    (len(agency_name) > len(r[0]) and r[0]==agency_name[-len(r[0]):]):
+                    agencies.append((agency_name,state))
+                elif (agency_name.startswith('Willisville') and len(r)==1 and r[0].startswith('Williamsville')):
+                    agencies.append((agency_name,state))
+                elif (agency_name.startswith(r[0]) and len(r[0])>=35) or \
+                    agency_name in ["Towsonu",] or \
+                    " " not in agency_name and r[0].startswith(agency_name+" ") or \
+                    r[0].lower().replace(" ", "").startswith(agency_name.lower()):
+                    return r[0]
+                else:
+                    words1 = agency_name.split()
+                    words2 = r[0].split()
+                    k1 = k2 = 0
+                    while k1<len(words1) and k2<len(words2):
+                        if words1[k1]==words2[k2]:
+                            words1.pop(k1)
+                            words2.pop(k2)
+                        else:
+                            break
+                    k1 = len(words1)-1
+                    k2 = len(words2)-1
+                    while k1>=0 and k2>=0:
+                        if words1[k1]==words2[k2]:
+                            words1.pop(k1)
+                            words2.pop(k2)
+                            k1-=1
+                            k2-=1
+                        else:
+                            break
+                    w1 = " ".join(words1)
+                    w2 = " ".join(words2)
+                    score = fuzz.ratio(w1, w2)
+                    if score==0:
+                        if agency_name.split()==1:
+                            raise NotImplementedError()
+                        else:
+                            agencies.append((agency_name,state))
+                    elif score<90:
+                        agencies.append((agency_name,state))
+                    else:
+                        return r[0]
+            elif (cur_type is not None and all([x is not None and (w.startswith(ca_state_prison) or x!=cur_type) for w,x in zip(r,match_types)])) or \
+                (a:=re.match(r"Lo\s([A-Z][a-z]+)", agency_name)) and all([(b:=re.match(r"Lo\s([A-Z][a-z]+)", d)) and a.group(1)!=b.group(1) for d in r]):
+                agencies.append((agency_name,state))
+            elif agency_name=="Prince George Police" or \
+                " " not in agency_name and r[0].startswith(agency_name+" ") or \
+                r[0].lower().replace(" ", "").startswith(agency_name.lower()):
+                # Should be County PD
+                return r[0]
+            elif 'forest ranger' in agency_name.lower():
+                return
+            else:
+                print(f"{agency_name_orig} is unknown")
+                return
+            # elif all([("county" in agency_name.lower())+("county" in x.lower())==1 for x in high_scoring]):
+            #     agencies.append((agency_name,state))
+        else:
+            agencies.append((agency_name,state))
+
+    return agency_name
+
+
+def row_fingerprint(row) -> str:
+    """Hash of the fields of a row that affect which agencies it contains. URL and dataset_id are part of source_table_id."""
+    fields = {k: row.get(k) for k in FINGERPRINT_FIELDS}
+    fields = {k: (None if not isinstance(v, (dict, list)) and pd.isnull(v) else v) for k, v in fields.items()}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class AgencyRegistry:
+    """Agencies of the source table with their aliases and the rows (source_table_ids) that contain them
+
+    Parameters
+    ----------
+    state_file : str
+        Name of the file in the state directory that the registry is stored in
+    rebuild : bool
+        If True, start from an empty registry rather than the stored one
+    clock : callable
+        Returns the current datetime. Defaults to datetime.now
+    """
+
+    def __init__(self, state_file: str = STATE_FILE, rebuild: bool = False,
+                 clock: Callable[[], datetime] = datetime.now) -> None:
+        self.state_file = state_file
+        self._clock = clock
+        stored = {} if rebuild else state.load_json(state_file)
+        # (canonical name, state) in the order that they were added. add_agency matches names against this list.
+        self._agencies: list[tuple[str, str]] = [tuple(x["key"]) for x in stored.get("agencies", [])]
+        self._entries: dict[tuple[str, str], dict[str, set]] = {
+            tuple(x["key"]): {"aliases": set(x["aliases"]), "sources": set(x["sources"])} for x in stored.get("agencies", [])
+        }
+        # source_table_id -> {"fingerprint": ..., "checked": ..., "multi_year": ...}
+        self._rows: dict[str, dict] = stored.get("rows", {})
+
+    def __len__(self) -> int:
+        return len(self._agencies)
+
+    @property
+    def agencies(self) -> list[tuple[str, str]]:
+        return list(self._agencies)
+
+    @property
+    def source_table_ids(self) -> list[str]:
+        """Rows whose agencies have been added"""
+        return list(self._rows)
+
+    def save(self) -> None:
+        state.save_json(self.state_file, {
+            "count": len(self),
+            "agencies": [{"key": list(k), "aliases": sorted(self._entries[k]["aliases"]),
+                          "sources": sorted(self._entries[k]["sources"])} for k in self._agencies],
+            "rows": self._rows,
+        })
+
+    def is_current(self, row: pd.Series, refresh_days: int = REFRESH_DAYS) -> bool:
+        """Whether the agencies of a row are up to date. Rows are out of date if they are new or their agency
+        fields changed. Multi-year multi-agency rows are also out of date if not checked for refresh_days.
+        """
+        entry = self._rows.get(row["source_table_id"])
+        if entry is None or entry["fingerprint"] != row_fingerprint(row):
+            return False
+        return not entry["multi_year"] or \
+            self._clock() - datetime.fromisoformat(entry["checked"]) <= timedelta(days=refresh_days)
+
+    def add_row(self, row: pd.Series, raw_agencies: Iterable[str]) -> None:
+        """Replace the agencies of a row with the agencies named raw_agencies"""
+        sid = row["source_table_id"]
+        self.remove_row(sid)
+        for raw in raw_agencies:
+            if pd.isnull(raw) or len(raw)==1:
+                continue
+            self._add(raw, row["State"], sid)
+        self._rows[sid] = {"fingerprint": row_fingerprint(row), "checked": self._clock().isoformat(timespec="seconds"),
+                           "multi_year": row["Agency"] == opd.defs.MULTI and row["Year"] == opd.defs.MULTI}
+
+    def _add(self, raw: str, state_name: str, sid: str) -> None:
+        key = (raw, state_name)
+        if key not in self._entries:
+            known = set(self._agencies)
+            name = add_agency(raw, state_name, self._agencies)
+            if name is None:
+                return
+            key = (name, state_name)
+            if key not in self._entries:
+                renamed = [k for k in known if k not in set(self._agencies)]
+                # add_agency replaced the canonical name of an agency with a longer one
+                self._entries[key] = self._entries.pop(renamed[0]) if renamed else {"aliases": set(), "sources": set()}
+        self._entries[key]["aliases"].add(raw)
+        self._entries[key]["sources"].add(sid)
+
+    def remove_row(self, source_table_id: str) -> None:
+        """Remove a row and the agencies that are not in any other row"""
+        if self._rows.pop(source_table_id, None) is None:
+            return
+        removed = set()
+        for key, entry in self._entries.items():
+            entry["sources"].discard(source_table_id)
+            if len(entry["sources"]) == 0:
+                removed.add(key)
+        for key in removed:
+            del self._entries[key]
+        if removed:
+            self._agencies = [x for x in self._agencies if x not in removed]
+
+    def prune(self, source_table_ids: Iterable[str]) -> list[str]:
+        """Remove rows that are not in source_table_ids (i.e. deleted from the table). Returns the removed IDs."""
+        keep = set(source_table_ids)
+        removed = [x for x in self._rows if x not in keep]
+        for sid in removed:
+            self.remove_row(sid)
+        return removed
+
+
+def main() -> int:
+    registry = AgencyRegistry()
+    print(f"OPD contains data for {len(registry)} police agencies from {len(registry.source_table_ids)} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+"""Find when ArcGIS layers were last edited and their date ranges with a few requests per service.
+
+Many ArcGIS rows are layers of the same FeatureServer or MapServer. The layers resource of a service returns the
+metadata of all of its layers and tables, including editingInfo.dataLastEditDate (or lastEditDate), so the edit
+times of every layer of a service are found with one request. See upstream_changes for how the edit times are
+used to skip layers that have not changed.
+
+For layers that have changed, date_stats finds the min, max and count of the date field with a single
+outStatistics query instead of a count query per year and loading the first and last years. distinct_values finds
+the distinct values of a field (e.g. the agencies of a multi-agency layer) without loading its features.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Optional
+
+import pandas as pd
+import requests
+
+from circuit_breaker import HostCircuitBreaker
+from scheduler import Budget
+
+
+TIMEOUT = 30
+_LAYER_URL = re.compile(r"^(?P<root>.*/(?:MapServer|FeatureServer))/(?P<layer>\d+)", re.IGNORECASE)
+
+
+def service_root(url: str) -> tuple[Optional[str], Optional[int]]:
+    """Root URL of the service and layer number of a layer URL"""
+    m = _LAYER_URL.match(url.strip()) if isinstance(url, str) else None
+    return (m.group("root"), int(m.group("layer"))) if m else (None, None)
+
+
+def _get_json(url: str, params: dict, session: Optional[requests.Session] = None) -> dict:
+    session = session or requests
+    r = session.get(url, params={**params, "f": "json"}, timeout=TIMEOUT)
+    r.raise_for_status()
+    result = r.json()
+    # ArcGIS reports errors with a 200 status code
+    if "error" in result:
+        raise ValueError(f"Error response from {url}: {result['error']}")
+    return result
+
+
+def fetch_edit_dates(root: str, session: Optional[requests.Session] = None) -> dict[int, int]:
+    """Last edit time (ms since the epoch) of each layer and table of the service at root that reports one"""
+    result = _get_json(f"{root}/layers", {}, session)
+    edits = {}
+    for layer in result.get("layers", []) + result.get("tables", []):
+        info = layer.get("editingInfo") or {}
+        value = info.get("dataLastEditDate") or info.get("lastEditDate")
+        if value is not None:
+            edits[layer["id"]] = value
+    return edits
+
+
+def sweep(df: pd.DataFrame, breaker: Optional[HostCircuitBreaker] = None,
+          session: Optional[requests.Session] = None, budget: Optional[Budget] = None) -> pd.Series:
+    """Last edit time of each ArcGIS row of df with one request per service. Other rows and layers that do not
+    report an edit time are null. Each service is charged to budget, and no more services are read once it is
+    exhausted.
+    """
+    updated = pd.Series(None, index=df.index, dtype=object)
+    arcgis = df[df["DataType"] == "ArcGIS"]
+    layers = pd.DataFrame([service_root(x) for x in arcgis["URL"]], index=arcgis.index, columns=["root", "layer"])
+    layers = layers[layers["root"].notnull()]
+    for root, rows in layers.groupby("root"):
+        if budget is not None and budget.exhausted():
+            break
+        if breaker is not None and not breaker.allow(root):
+            continue
+        if budget is not None:
+            budget.charge()
+        try:
+            edits = fetch_edit_dates(root, session)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if breaker is not None:
+                breaker.record_failure(root, e)
+            print(f"Unable to read the layers of {root}. Its rows will be checked: {e}")
+            continue
+        if breaker is not None:
+            breaker.record_success(root)
+        updated[rows.index] = rows["layer"].map(lambda x: str(edits[x]) if x in edits else None).values
+    return updated.where(updated.notnull(), None)
+
+
+def _to_timestamp(value) -> Optional[pd.Timestamp]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return pd.Timestamp(value, unit="ms")
+    # Dates stored as strings cannot be compared by the server
+    raise ValueError(f"Date statistic {value} is not a date")
+
+
+def date_stats(url: str, date_field: str, min_year: Optional[int] = None, session: Optional[requests.Session] = None) -> dict:
+    """Smallest, 2nd smallest, and largest values of date_field and the number of records with a date (see
+    file_executor.reduce_dates) using outStatistics queries. Dates before min_year are ignored.
+
+    Raises ValueError if the server does not support the query or date_field is not a date field.
+    """
+    where = f"{date_field} >= timestamp '{min_year}-01-01 00:00:00'" if min_year else "1=1"
+    stats = [{"statisticType": t, "onStatisticField": date_field, "outStatisticFieldName": f"{t}_value"}
+             for t in ["min", "max", "count"]]
+    result = _get_json(f"{url.rstrip('/')}/query", {"where": where, "outStatistics": json.dumps(stats)}, session)
+    features = result.get("features", [])
+    if len(features) != 1:
+        raise ValueError(f"Unexpected statistics response from {url}: {result}")
+    values = {k.lower(): v for k, v in features[0]["attributes"].items()}
+
+    reduced = {"min": _to_timestamp(values.get("min_value")), "second_min": None,
+               "max": _to_timestamp(values.get("max_value")), "count": values.get("count_value") or 0}
+    if reduced["min"] is not None and reduced["min"].year < 2000:
+        # date_range_coverage uses the 2nd smallest date if the smallest one may be a mistake
+        after = f"{date_field} > timestamp '{reduced['min']:%Y-%m-%d %H:%M:%S}'"
+        result = _get_json(f"{url.rstrip('/')}/query", {"where": f"({where}) AND {after}", "outStatistics": json.dumps(stats[:1])}, session)
+        features = result.get("features", [])
+        if len(features) == 1:
+            reduced["second_min"] = _to_timestamp(next(iter(features[0]["attributes"].values())))
+    return reduced
+
+
+def distinct_values(url: str, field: str, session: Optional[requests.Session] = None) -> list:
+    """Distinct non-null values of field in the layer at url using returnDistinctValues queries
+
+    Raises ValueError if the server does not support the query.
+    """
+    params = {"where": "1=1", "outFields": field, "returnDistinctValues": "true", "returnGeometry": "false",
+              "orderByFields": field}
+    values = []
+    while True:
+        result = _get_json(f"{url.rstrip('/')}/query", {**params, "resultOffset": len(values)}, session)
+        features = result.get("features", [])
+        values.extend(next(iter(x["attributes"].values()), None) for x in features)
+        if not result.get("exceededTransferLimit") or len(features) == 0:
+            break
+    return [x for x in dict.fromkeys(values) if x is not None]
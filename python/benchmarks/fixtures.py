@@ -0,0 +1,271 @@
+"""Offline fixtures for the benchmarks.
+
+Source tables of any size are synthesized by resampling the rows of opd_source_table.csv (so that the mix of
+DataTypes, years, URLs and dataset IDs is realistic) and making the key columns of each copy unique. The Stanford
+Open Policing page is synthesized in the HTML structure that stanford.py parses. StubSource stands in for
+opd.Source and returns canned years and frames so that update_dates can run without a network connection, and
+LocalServer serves files over HTTP from a temporary directory in place of data portals.
+"""
+
+from __future__ import annotations
+
+import functools
+import http.server
+import re
+import threading
+from datetime import timedelta
+from pathlib import Path
+from typing import Optional
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+import openpolicedata as opd
+
+from generate_source_table_ids import SOURCE_TABLE_ID
+from table_diff import table_ids
+
+
+REPO_DIR = Path(__file__).parent.parent.parent
+SOURCE_TABLE = REPO_DIR / "opd_source_table.csv"
+SEED = 20240101
+# OPD truncates ArcGIS URLs after the layer number
+_ARCGIS_LAYER = re.compile(r"^(.*(?:MapServer|FeatureServer)/\d+)")
+
+
+@functools.lru_cache(maxsize=None)
+def _source_table() -> pd.DataFrame:
+    return pd.read_csv(SOURCE_TABLE, dtype=str, keep_default_na=False)
+
+
+def source_table() -> pd.DataFrame:
+    """The source table as strings"""
+    return _source_table().copy()
+
+
+def synthetic_table(nrows: int, seed: int = SEED) -> pd.DataFrame:
+    """Source table of nrows rows resampled from the source table. Each copy of a row is made unique by
+    appending the copy number to its SourceName, Agency and URL.
+    """
+    base = _source_table()
+    rng = np.random.default_rng(seed)
+    index = np.concatenate([np.arange(len(base)), rng.integers(0, len(base), max(0, nrows - len(base)))])[:nrows]
+    df = base.iloc[index].reset_index(drop=True)
+    copy = pd.Series(index).groupby(index).cumcount()
+    suffix = np.where(copy > 0, " " + copy.astype(str), "")
+    for column in ["SourceName", "Agency"]:
+        df[column] = df[column].where(df[column].isin(["MULTIPLE", "NONE"]), df[column] + suffix)
+    df["URL"] = df["URL"] + np.where(copy > 0, "#" + copy.astype(str), "")
+    df[SOURCE_TABLE_ID] = ""
+    df[SOURCE_TABLE_ID] = table_ids(df)
+    return df
+
+
+def modify(df: pd.DataFrame, frac: float = 0.01, seed: int = SEED) -> pd.DataFrame:
+    """Copy of df with the coverage_end of frac of the rows moved 30 days later and frac of the rows deleted
+    and replaced with new rows
+    """
+    rng = np.random.default_rng(seed + 1)
+    df = df.copy()
+    n = max(1, int(len(df) * frac))
+    changed = rng.choice(df.index, n, replace=False)
+    end = pd.to_datetime(df.loc[changed, "coverage_end"], format="%m/%d/%Y", errors="coerce") + timedelta(days=30)
+    df.loc[changed, "coverage_end"] = end.dt.strftime("%m/%d/%Y").fillna("")
+
+    deleted = rng.choice(df.index.difference(changed), n, replace=False)
+    new = df.loc[deleted].copy()
+    new["SourceName"] = new["SourceName"] + " New"
+    new[SOURCE_TABLE_ID] = ""
+    new[SOURCE_TABLE_ID] = table_ids(new)
+    return pd.concat([df.drop(deleted), new], ignore_index=True)
+
+
+def mixed_dates(nrows: int, frac: float = 0.01, seed: int = SEED) -> tuple[pd.Series, pd.Timestamp, pd.Timestamp]:
+    """Column of nrows date strings in MM/DD/YYYY HH:MM:SS format with frac of them in YYYY-MM-DD format instead
+    (including the earliest date) and a few values that are not dates. Returns the column and its earliest and
+    latest dates.
+    """
+    rng = np.random.default_rng(seed + 2)
+    dates = pd.Series(pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 5 * 365 * 24 * 60, nrows), unit="min"))
+    dates = dates.dt.floor("D").where(rng.random(nrows) < frac, dates)
+    dates.iloc[0] = pd.Timestamp("2014-06-30")
+    values = dates.dt.strftime("%m/%d/%Y %H:%M:%S").astype(object)
+    other = (dates.dt.floor("D") == dates).to_numpy()
+    values[other] = dates[other].dt.strftime("%Y-%m-%d")
+    values.iloc[1:4] = ["NOT PROVIDED", 20190101, None]
+    dates.iloc[1:4] = pd.NaT
+    return values, dates.min(), dates.max()
+
+
+def quarterly_zip(path: Path, nrows: int, ncols: int = 12, seed: int = SEED) -> list[str]:
+    """Write a zip file of 4 quarterly Excel files of nrows rows each to path in the layout of the RIPA zip files
+    (see update_table.update_ripa). The files have DATE_OF_STOP, AGENCY_NAME and ncols other columns. Returns the
+    names of the files.
+    """
+    rng = np.random.default_rng(seed + 3)
+    names = []
+    with ZipFile(path, "w") as z:
+        for q in range(1, 5):
+            start = pd.Timestamp(f"2023-{3*q-2:02d}-01")
+            table = pd.DataFrame({
+                "DOJ_RECORD_ID": np.arange(nrows) + q * nrows,
+                "DATE_OF_STOP": start + pd.to_timedelta(rng.integers(0, 90 * 24 * 60, nrows), unit="min"),
+                "AGENCY_NAME": rng.choice(["ORANGE CO SO", "ANAHEIM PD", "IRVINE PD", "SANTA ANA PD"], nrows),
+            })
+            for c in range(ncols):
+                table[f"COLUMN_{c}"] = rng.integers(0, 10, nrows) if c % 2 else rng.choice(["Y", "N", "UNKNOWN"], nrows)
+            names.append(f"RIPA Stop Data _Orange 2023 Q{q} .xlsx")
+            with z.open(names[-1], "w") as f:
+                table.to_excel(f, index=False)
+    return names
+
+
+_STATES = ["AZ", "CA", "CT", "FL", "IL", "MD", "NC", "OH", "TX", "WA"]
+
+
+def stanford_page(nagencies: int = 100) -> str:
+    """HTML of the Stanford Open Policing data page with nagencies datasets spread over several states"""
+    parts = ["<html><body><table>"]
+    per_state = max(1, nagencies // len(_STATES))
+    k = 0
+    for state in _STATES:
+        parts.append(f'<tr class="state-title"><td colspan="8">{state}</td></tr>')
+        for j in range(per_state):
+            if k == nagencies:
+                break
+            multi = "<sup>1</sup>" if j == 0 else ""
+            pedestrian = "<sup>2</sup>" if k % 3 == 0 else ""
+            start = f"{2000 + k % 10}-01-01"
+            end = f"{2010 + k % 8}-12-31"
+            parts.append(
+                '<tr>'
+                f'<td class="state text-left" data-title="State"><span>Agency {k}{multi}</span></td>'
+                f'<td class="text-right" data-title="Stops">{1000 + k:,}{pedestrian}</td>'
+                f'<td class="text-right" data-title="Time range"><span>{start}</span> - <span>{end}</span></td>'
+                f'<td data-title="Download"><a href="https://example.com/{state}_{k}.csv.zip">Download data as CSV</a></td>'
+                '</tr>')
+            k += 1
+    parts.append("</table></body></html>")
+    return "\n".join(parts)
+
+
+def url_key(url: str) -> str:
+    """URL of the row that a copy was made from (see synthetic_table) as truncated by OPD"""
+    url = url.split("#")[0]
+    m = _ARCGIS_LAYER.match(url)
+    return m.group(1) if m else url
+
+
+class StubCache:
+    """Stands in for the download_cache module, returning a file for every URL"""
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+
+    def get(self, url: str, max_age=None):
+        import download_cache
+        return download_cache.CachedFile(url, self.path)
+
+    def fetch(self, url: str, max_age=None) -> Path:
+        return self.path
+
+
+class StubTable:
+    def __init__(self, table: pd.DataFrame) -> None:
+        self.table = table
+
+
+class StubLoader:
+    def __init__(self, years: list) -> None:
+        self.years = years
+
+    def get_years(self, check: Optional[list] = None) -> list:
+        return [y for y in self.years if check is None or y in check]
+
+
+class StubSource:
+    """Stands in for opd.Source. Rows are looked up by URL and loads return a canned frame with dates spanning
+    the row's coverage, so that update_dates finds the coverage unchanged except for rows in coverage.
+
+    coverage : dict
+        Maps URL (see url_key) to (coverage_start, coverage_end, date_field)
+    """
+    coverage: dict = {}
+
+    def __init__(self, source_name, state=None, agency=None) -> None:
+        self.source_name = source_name
+
+    def _Source__get_loader(self, data_type, url, query=None, dataset=None, date_field=None, agency_field=None):
+        start, end, _ = self.coverage[url_key(url)]
+        return StubLoader(list(range(start.year, end.year + 1)))
+
+    def load(self, table_type=None, year=None, nrows=None, url=None, id=None, sortby=None, **kwargs):
+        start, end, date_field = self.coverage[url_key(url)]
+        dates = pd.Series(pd.date_range(start, end, periods=8))
+        if isinstance(year, list):
+            year = year[0]
+        if isinstance(year, int):
+            dates = dates[dates.dt.year == year]
+            if len(dates) == 0:
+                dates = pd.Series([pd.Timestamp(year=year, month=1, day=1)])
+        table = pd.DataFrame({date_field: dates.reset_index(drop=True), "value": 1})
+        return StubTable(table.head(nrows) if nrows else table)
+
+
+def stub_date_stats(url, date_field, min_year=None, session=None) -> dict:
+    """Stands in for arcgis_layers.date_stats using the coverage of StubSource"""
+    start, end, _ = StubSource.coverage[url_key(url)]
+    return {"min": start, "second_min": None, "max": end, "count": 8}
+
+
+def stub_coverage(df: pd.DataFrame, changed_frac: float = 0.01, seed: int = SEED) -> dict:
+    """Coverage returned by StubSource for each URL of df. coverage_end is moved later for changed_frac of the rows."""
+    start = pd.to_datetime(df["coverage_start"], format="%m/%d/%Y", errors="coerce")
+    end = pd.to_datetime(df["coverage_end"], format="%m/%d/%Y", errors="coerce")
+    valid = start.notnull() & end.notnull()
+    rng = np.random.default_rng(seed + 2)
+    end = end + pd.to_timedelta(np.where(rng.random(len(df)) < changed_frac, 30, 0), unit="D")
+    return {url_key(url): (s, e, f) for url, s, e, f in zip(df["URL"][valid], start[valid], end[valid], df["date_field"].str.strip()[valid])}
+
+
+def refresh_table(nrows: int, seed: int = SEED) -> pd.DataFrame:
+    """Synthetic table for the full refresh benchmark. Only contains MULTIPLE year rows that can be loaded by
+    StubSource (i.e. no Stanford rows and rows with a date_field and coverage). StubSource looks up rows by URL,
+    so rows of the source table that share a URL are excluded.
+    """
+    base = _source_table()
+    shared = base["URL"].map(url_key)
+    shared = shared[shared.duplicated(keep=False)]
+    df = synthetic_table(max(nrows * 10, len(base)), seed)
+    keep = (df["Year"] == opd.defs.MULTI) & (df["date_field"] != "") & ~df["URL"].str.contains("stanford.edu") & \
+        (df["coverage_start"] != "") & (df["coverage_end"] != "") & (df["min_version"] != "-1") & \
+        ~df["URL"].map(url_key).isin(shared)
+    return df[keep].head(nrows).reset_index(drop=True)
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    """HTTP server on a background thread that serves the files in directory
+
+        with LocalServer(directory) as server:
+            url = server.url("file.csv")
+    """
+    def __init__(self, directory: Path) -> None:
+        handler = functools.partial(_QuietHandler, directory=str(directory))
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/{name}"
+
+    def __enter__(self) -> LocalServer:
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,370 @@
+"""Offline benchmarks of the table maintenance scripts.
+
+Each benchmark times a hot path (parsing the Stanford page, generating IDs, deduplicating, matching URL templates,
+diffing, merging, validating, scheduling, reducing dates, reading multi-file datasets, materializing compatibility
+snapshots, downloading and a full refresh with update_dates) against the fixtures in fixtures.py, so no network
+connection is needed. Table benchmarks are run for each size in --rows.
+
+Results are saved in the benchmarks directory of the local state directory by git commit so that a run can be
+compared with the results of an earlier commit:
+
+    python benchmarks/run_benchmarks.py --save
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py --compare main
+
+The exit code is 1 if any benchmark is slower than in the compared commit by more than --threshold.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+from unittest import mock
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / "predict_urls"))
+import openpolicedata as opd
+
+import state
+import fixtures
+
+
+RESULTS_DIR = "benchmarks"
+DEFAULT_ROWS = [10000, 100000]
+REFRESH_ROWS = 500
+# Rows of each quarterly file of the multi_file benchmarks
+QUARTER_ROWS = 10000
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 1.2
+UPDATE_COLS = ["coverage_start", "coverage_end", "last_coverage_check"]
+
+# name: (setup function, whether it is run for each table size)
+# The setup function is called with the number of rows and an ExitStack for cleanup and returns the function to time
+BENCHMARKS: dict[str, tuple[Callable, bool]] = {}
+
+
+def benchmark(name: str, sized: bool = True):
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, sized)
+        return setup
+    return decorator
+
+
+def _tempdir(stack: contextlib.ExitStack) -> Path:
+    return Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="opd_bench_")))
+
+
+@benchmark("stanford_parse", sized=False)
+def _stanford_parse(nrows, stack):
+    import stanford
+    page = _tempdir(stack) / "stanford.html"
+    page.write_text(fixtures.stanford_page())
+    stack.enter_context(mock.patch.object(stanford, "download_cache", fixtures.StubCache(page)))
+    return stanford.get_stanford
+
+
+@benchmark("generate_ids")
+def _generate_ids(nrows, stack):
+    from generate_source_table_ids import add_source_table_ids
+    path = _tempdir(stack) / "opd_source_table.csv"
+    fixtures.synthetic_table(nrows).to_csv(path, index=False)
+    return lambda: add_source_table_ids(path)
+
+
+@benchmark("dedupe")
+def _dedupe(nrows, stack):
+    from candidates import latest_per_series
+    df = fixtures.synthetic_table(nrows)
+    return lambda: latest_per_series(df)
+
+
+@benchmark("match_templates")
+def _match_templates(nrows, stack):
+    from url_templates import learn_templates
+    df = fixtures.synthetic_table(nrows)
+    return lambda: learn_templates(df)
+
+
+@benchmark("diff")
+def _diff(nrows, stack):
+    from table_diff import diff_tables
+    old = fixtures.synthetic_table(nrows)
+    new = fixtures.modify(old)
+    return lambda: diff_tables(old, new)
+
+
+@benchmark("merge")
+def _merge(nrows, stack):
+    from merge import three_way_merge
+    ancestor = fixtures.synthetic_table(nrows)
+    new = fixtures.modify(ancestor)
+    base = fixtures.modify(ancestor, seed=fixtures.SEED + 10)
+    return lambda: three_way_merge(base, new, UPDATE_COLS, ancestor)
+
+
+@benchmark("validate")
+def _validate(nrows, stack):
+    from validate_table import validate
+    df = fixtures.synthetic_table(nrows)
+    return lambda: validate(df)
+
+
+@benchmark("schedule")
+def _schedule(nrows, stack):
+    import scheduler
+    df = fixtures.synthetic_table(nrows)
+    return lambda: (scheduler.schedule(df, {}), scheduler.classify_immutable(df))
+
+
+@benchmark("compat_available")
+def _compat_available(nrows, stack):
+    from compat_resolver import available
+    df = fixtures.synthetic_table(nrows)
+    return lambda: available(df, "0.8", "3.9")
+
+
+@benchmark("reduce_dates")
+def _reduce_dates(nrows, stack):
+    from file_executor import reduce_dates
+    values, first, last = fixtures.mixed_dates(nrows)
+    table = pd.DataFrame({"date": values})
+    # Dates in the minority format and values that are not dates must not change the result
+    reduced = reduce_dates(table, "date")
+    if (reduced["min"], reduced["max"]) != (first, last):
+        raise ValueError(f"reduce_dates found {reduced['min']} to {reduced['max']} instead of {first} to {last}")
+    return lambda: reduce_dates(table, "date")
+
+
+def _quarterly_zip(stack: contextlib.ExitStack) -> tuple[str, list[str]]:
+    directory = _tempdir(stack)
+    names = fixtures.quarterly_zip(directory / "ripa.zip", QUARTER_ROWS)
+    server = stack.enter_context(fixtures.LocalServer(directory))
+    return server.url("ripa.zip"), names
+
+
+@benchmark("multi_file_load", sized=False)
+def _multi_file_load(nrows, stack):
+    import download_cache
+    from zipfile import ZipFile
+    url, names = _quarterly_zip(stack)
+
+    # Baseline for multi_file_read: every file of the dataset is loaded in full, one after another, and concatenated
+    def run():
+        with ZipFile(download_cache.fetch(url)) as z:
+            table = pd.concat([pd.read_excel(z.open(name)) for name in names], ignore_index=True)
+        return table[["DATE_OF_STOP", "AGENCY_NAME"]]
+    return run
+
+
+@benchmark("multi_file_read", sized=False)
+def _multi_file_read(nrows, stack):
+    from file_executor import FileExecutor
+    url, names = _quarterly_zip(stack)
+    executor = stack.enter_context(FileExecutor(cpu_workers=len(names)))
+    return lambda: executor.submit_read(url, ["DATE_OF_STOP", "AGENCY_NAME"], {"files": names}, "DATE_OF_STOP").result()
+
+
+@benchmark("compat_materialize", sized=False)
+def _compat_materialize(nrows, stack):
+    import compat_snapshots
+    directory = _tempdir(stack)
+    # A delta against a table that is neither the current table nor in a git repository
+    base = fixtures.modify(fixtures.source_table()).to_csv(index=False, lineterminator="\n").encode("utf-8")
+    blob = compat_snapshots.blob_hash(base)
+    (directory / blob).write_bytes(base)
+    csv_name = compat_snapshots.compat_versions()[-1]["csv_name"]
+    snapshot = compat_snapshots.read_snapshot(csv_name)
+    delta = compat_snapshots.build_delta(snapshot, compat_snapshots.BaseTable(base), csv_name=csv_name)
+
+    server = stack.enter_context(fixtures.LocalServer(directory))
+    stack.enter_context(mock.patch.object(compat_snapshots, "BLOB_URL", server.url("{blob}")))
+    stack.enter_context(mock.patch.object(compat_snapshots, "REPO_DIR", _tempdir(stack)))
+    if compat_snapshots.materialize(delta) != snapshot:
+        raise ValueError(f"Delta of {csv_name} against a downloaded base table does not reproduce the snapshot")
+    return lambda: compat_snapshots.materialize(delta)
+
+
+@benchmark("download", sized=False)
+def _download(nrows, stack):
+    import download_cache
+    directory = _tempdir(stack)
+    fixtures.synthetic_table(20000).to_csv(directory / "table.csv", index=False)
+    server = stack.enter_context(fixtures.LocalServer(directory))
+    url = server.url("table.csv")
+    calls = iter(range(sys.maxsize))
+    # A new index for each call so that the file is always downloaded
+    return lambda: download_cache.DownloadCache(index_file=f"bench_index_{next(calls)}.json").fetch(url)
+
+
+@benchmark("download_revalidate", sized=False)
+def _download_revalidate(nrows, stack):
+    import download_cache
+    from datetime import timedelta
+    directory = _tempdir(stack)
+    fixtures.synthetic_table(20000).to_csv(directory / "table.csv", index=False)
+    server = stack.enter_context(fixtures.LocalServer(directory))
+    url = server.url("table.csv")
+    cache = download_cache.DownloadCache(index_file="bench_index_revalidate.json")
+    cache.fetch(url)
+    # Server responds 304 Not Modified
+    return lambda: cache.fetch(url, max_age=timedelta(0))
+
+
+@benchmark("full_refresh", sized=False)
+def _full_refresh(nrows, stack):
+    import arcgis_layers
+    import ckan_portal
+    import socrata_catalog
+    import update_table
+    directory = _tempdir(stack)
+    df = fixtures.refresh_table(REFRESH_ROWS)
+    table = directory / "table.csv"
+    df.to_csv(table, index=False)
+
+    fixtures.StubSource.coverage = fixtures.stub_coverage(df)
+    stack.enter_context(mock.patch.object(opd, "Source", fixtures.StubSource))
+    # Canned update times and statistics in place of the Socrata catalogs, ArcGIS services and CKAN portals
+    stack.enter_context(mock.patch.object(socrata_catalog, "fetch_updated",
+                                          lambda domain, ids, session=None: {x: "2024-01-01T00:00:00.000Z" for x in ids}))
+    stack.enter_context(mock.patch.object(arcgis_layers, "fetch_edit_dates",
+                                          lambda root, session=None: dict.fromkeys(range(100), 1704067200000)))
+    stack.enter_context(mock.patch.object(arcgis_layers, "date_stats", fixtures.stub_date_stats))
+    stack.enter_context(mock.patch.object(ckan_portal, "package_search",
+                                          lambda portal, field, values, since=None, session=None: iter([])))
+    # Do not look for a compatibility table on GitHub
+    stack.enter_context(mock.patch.object(opd.datasets, "check_compat_source_table", lambda **kwargs: (False, None, None)))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    stack.callback(os.chdir, cwd)
+
+    def run():
+        shutil.copyfile(table, "opd_source_table.csv")
+        # Start from empty caches so that every repeat does the same work
+        with mock.patch.object(state, "STATE_DIR", Path(tempfile.mkdtemp(dir=directory))), \
+             contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            update_table.update_dates()
+    return run
+
+
+def time_benchmark(setup: Callable, nrows: Optional[int], repeat: int) -> dict:
+    with contextlib.ExitStack() as stack:
+        func = setup(nrows, stack)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t0)
+    return {"rows": nrows, "min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def git_commit(rev: str = "HEAD") -> str:
+    result = subprocess.run(["git", "rev-parse", "--verify", f"{rev}^{{commit}}"], cwd=fixtures.REPO_DIR,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ValueError(f"Unknown git revision {rev}: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+
+def _is_dirty() -> bool:
+    result = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=fixtures.REPO_DIR,
+                            capture_output=True, text=True)
+    return result.stdout.strip() != ""
+
+
+def results_file(commit: str) -> str:
+    return f"{RESULTS_DIR}/{commit}.json"
+
+
+def run(names: list[str], rows: list[int], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        setup, sized = BENCHMARKS[name]
+        for nrows in (rows if sized else [None]):
+            key = f"{name}[{nrows}]" if sized else name
+            result = time_benchmark(setup, nrows, repeat)
+            results[key] = result
+            print(f"{key:<32} min {result['min']:8.3f} s   median {result['median']:8.3f} s")
+    return results
+
+
+def compare(results: dict, previous: dict, threshold: float) -> pd.DataFrame:
+    """Ratio of the minimum time of each benchmark to the previous results. regression is True for ratios above threshold."""
+    common = [k for k in results if k in previous]
+    df = pd.DataFrame({
+        "previous": [previous[k]["min"] for k in common],
+        "current": [results[k]["min"] for k in common],
+    }, index=pd.Index(common, name="benchmark"))
+    df["ratio"] = df["current"] / df["previous"]
+    df["regression"] = df["ratio"] > threshold
+    return df
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help="Benchmarks to run (default: all)")
+    parser.add_argument("--rows", nargs="+", type=int, default=DEFAULT_ROWS, help="Sizes of synthetic tables")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Number of times to run each benchmark")
+    parser.add_argument("--save", action="store_true", help="Save results for the current commit")
+    parser.add_argument("--compare", metavar="REV", help="Compare with saved results of this git revision")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Ratio of current to previous time above which a benchmark has regressed")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        previous = state.load_json(results_file(git_commit(args.compare)))
+        if not previous:
+            print(f"No saved results for {args.compare}. Run with --save on that commit first.")
+            return 2
+
+    # Benchmarks must not change the caches of real runs
+    state_dir = state.STATE_DIR
+    state.STATE_DIR = Path(tempfile.mkdtemp(prefix="opd_bench_state_"))
+    try:
+        results = run(args.benchmarks, args.rows, args.repeat)
+    finally:
+        shutil.rmtree(state.STATE_DIR, ignore_errors=True)
+        state.STATE_DIR = state_dir
+
+    commit = git_commit()
+    if args.save:
+        state.state_path(RESULTS_DIR).mkdir(exist_ok=True)
+        state.save_json(results_file(commit), {
+            "commit": commit,
+            "dirty": _is_dirty(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "results": results,
+        })
+        print(f"Saved results for {commit[:10]}")
+
+    if previous:
+        comparison = compare(results, previous["results"], args.threshold)
+        with pd.option_context("display.width", 200, "display.float_format", "{:.3f}".format):
+            print(f"\nCompared with {previous['commit'][:10]}:\n{comparison}")
+        if comparison["regression"].any():
+            print(f"\n{comparison['regression'].sum()} benchmark(s) slower by more than {args.threshold:.2f}x")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,217 @@
+"""Per-host circuit breaker for bulk refreshes of the OPD source table.
+
+When a portal is down (e.g. a certificate failure), every row hosted on it fails in turn and each
+failure costs a full connection timeout. The breaker opens for a host after a number of consecutive
+connection-level failures, short-circuits the remaining rows for that host, and half-opens after
+a cool-down to let a single trial request through.
+"""
+
+from __future__ import annotations
+
+import socket
+import ssl
+import time
+import urllib.error
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+import pandas as pd
+import requests
+
+
+OUTAGES_TABLE = Path(__file__).parent.parent / "outages.csv"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Text in outages.csv errors that indicates the host itself is unreachable rather than a single dataset failing
+_HOST_ERROR_MARKERS = ("SSLError", "CERTIFICATE_VERIFY_FAILED", "MaxRetryError", "NameResolutionError",
+                       "ConnectionError", "ConnectTimeout", "Connection refused", "timed out")
+
+
+def host_of(url: Optional[str]) -> str:
+    """Return the lower-case host of a URL. Socrata rows store only the domain so scheme-less URLs are accepted."""
+    if not isinstance(url, str) or not url.strip():
+        return ""
+    url = url.strip()
+    netloc = urlparse(url).netloc
+    if not netloc:
+        netloc = urlparse("//" + url).netloc
+    return netloc.split("@")[-1].split(":")[0].lower()
+
+
+def is_host_failure(exc: BaseException) -> bool:
+    """Whether an exception indicates that the host is unreachable (connection, TLS or timeout failure).
+
+    HTTP errors such as a 404 on a single URL are not host failures. OPD wraps request errors in its own
+    exceptions so the cause/context chain and exception arguments are searched as well.
+    """
+    seen = set()
+    stack = [exc]
+    while stack:
+        e = stack.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+
+        if isinstance(e, urllib.error.HTTPError) or isinstance(e, requests.exceptions.HTTPError):
+            return False
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ssl.SSLError,
+                          socket.timeout, TimeoutError, ConnectionError, urllib.error.URLError)):
+            return True
+
+        stack.extend([e.__cause__, e.__context__])
+        stack.extend(x for x in getattr(e, "args", ()) if isinstance(x, BaseException))
+
+    return False
+
+
+@dataclass
+class _HostState:
+    state: str = CLOSED
+    failures: int = 0
+    opened_at: float = 0.0
+    reason: str = ""
+    trial_in_flight: bool = False
+
+
+class HostCircuitBreaker:
+    """Track consecutive failures per host and short-circuit requests to hosts that are down.
+
+    Parameters
+    ----------
+    failure_threshold : int
+        Number of consecutive host failures that opens the breaker for a host
+    reset_timeout : float
+        Seconds an open breaker waits before half-opening and allowing a single trial request
+    clock : callable
+        Returns the current time in seconds. Defaults to time.monotonic
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 900.0, clock=time.monotonic) -> None:
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._hosts: dict[str, _HostState] = {}
+        self.skipped: dict[str, int] = {}
+
+    @classmethod
+    def from_outages(cls, outages_file: Path = OUTAGES_TABLE, **kwargs) -> "HostCircuitBreaker":
+        """Create a breaker with hosts of ongoing, host-level outages in outages.csv already open"""
+        breaker = cls(**kwargs)
+        breaker.seed_from_outages(outages_file)
+        return breaker
+
+    def seed_from_outages(self, outages_file: Path = OUTAGES_TABLE) -> list[str]:
+        """Open the breaker for hosts with ongoing outages caused by connection failures.
+
+        Returns the list of hosts that were opened.
+        """
+        outages_file = Path(outages_file)
+        if not outages_file.exists():
+            return []
+
+        outages = pd.read_csv(outages_file, dtype=str)
+        ongoing = outages["Date Outage Ended"].isnull() if "Date Outage Ended" in outages else pd.Series(True, index=outages.index)
+        host_error = outages["Error"].fillna("").str.contains("|".join(_HOST_ERROR_MARKERS), regex=True)
+        outages = outages[ongoing & host_error]
+
+        opened = []
+        for url, error in zip(outages["URL"], outages["Error"]):
+            host = host_of(url)
+            if host and host not in opened:
+                self.trip(host, reason=f"Outage listed in {outages_file.name}: {error[:200]}")
+                opened.append(host)
+
+        return opened
+
+    def _get(self, host: str) -> _HostState:
+        if host not in self._hosts:
+            self._hosts[host] = _HostState()
+        return self._hosts[host]
+
+    def state(self, url: str) -> str:
+        """Current state of the breaker for the host of url"""
+        host = host_of(url)
+        if host not in self._hosts:
+            return CLOSED
+        s = self._hosts[host]
+        if s.state == OPEN and self._clock() - s.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return s.state
+
+    def allow(self, url: str) -> bool:
+        """Whether a request to the host of url should be attempted.
+
+        In the half-open state, only one trial request is allowed until its outcome is recorded.
+        """
+        host = host_of(url)
+        if not host or host not in self._hosts:
+            return True
+
+        s = self._hosts[host]
+        if s.state == OPEN and self._clock() - s.opened_at >= self.reset_timeout:
+            s.state = HALF_OPEN
+            s.trial_in_flight = False
+
+        if s.state == CLOSED:
+            return True
+        elif s.state == HALF_OPEN and not s.trial_in_flight:
+            s.trial_in_flight = True
+            return True
+
+        self.skipped[host] = self.skipped.get(host, 0) + 1
+        return False
+
+    def record_success(self, url: str) -> None:
+        host = host_of(url)
+        if host in self._hosts:
+            self._hosts[host] = _HostState()
+
+    def release(self, url: str) -> None:
+        """End a trial request allowed in the half-open state without recording an outcome (e.g. the request was
+        not made or its result says nothing about the host) so that another trial can be allowed.
+        """
+        host = host_of(url)
+        if host in self._hosts:
+            self._hosts[host].trial_in_flight = False
+
+    def record_failure(self, url: str, exc: Optional[BaseException] = None) -> None:
+        """Record the outcome of a failed request. Failures that are not host-level (see is_host_failure) are ignored
+        other than ending a trial request.
+        """
+        if exc is not None and not is_host_failure(exc):
+            self.release(url)
+            return
+
+        host = host_of(url)
+        if not host:
+            return
+
+        s = self._get(host)
+        s.failures += 1
+        if s.state == HALF_OPEN or s.failures >= self.failure_threshold:
+            self.trip(host, reason=repr(exc) if exc is not None else "")
+
+    def trip(self, host: str, reason: str = "") -> None:
+        """Open the breaker for host"""
+        s = self._get(host_of(host))
+        s.state = OPEN
+        s.opened_at = self._clock()
+        s.trial_in_flight = False
+        s.reason = reason
+
+    def open_hosts(self) -> dict[str, str]:
+        """Hosts that are currently open or half-open and the reason they were opened"""
+        return {h: s.reason for h, s in self._hosts.items() if s.state != CLOSED}
+
+    def summary(self) -> str:
+        lines = []
+        for host, reason in self.open_hosts().items():
+            lines.append(f"{host}: {self.state(host)} ({self.skipped.get(host, 0)} requests skipped). {reason}")
+        return "\n".join(lines)
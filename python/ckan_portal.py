@@ -0,0 +1,139 @@
+"""Find when CKAN resources were last modified with a few package_search requests per portal.
+
+The dataset_id of a CKAN row is the ID of a datastore resource. package_search returns packages with all of their
+resources, so the modification times of the tracked resources of a portal are found with a few requests (BATCH_SIZE
+IDs per request). The package of a resource that has not been seen before is found by searching for its ID in the
+URLs of resources (the URLs of uploaded and datastore resources contain their IDs), and the package of each resource
+found is cached. Known packages are then searched by ID. The resources of each portal are cached in the state
+directory, and later sweeps only request known packages whose metadata was modified since the last sweep (updating
+a resource updates its package's metadata_modified). A full sweep of the tracked packages is made every
+FULL_SWEEP_DAYS to pick up resources that were removed. See upstream_changes for how the modification times are used to skip resources that have not
+changed.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Optional
+
+import pandas as pd
+import requests
+
+import state
+from circuit_breaker import HostCircuitBreaker
+from scheduler import Budget
+
+
+STATE_FILE = "ckan_portals.json"
+SEARCH_PATH = "/api/3/action/package_search"
+PAGE_SIZE = 1000
+# Number of IDs in the filter of each package_search request
+BATCH_SIZE = 50
+FULL_SWEEP_DAYS = 30
+# Packages modified shortly before the last sweep may not have been indexed yet
+SWEEP_OVERLAP = timedelta(hours=1)
+TIMEOUT = 60
+
+
+def portal_url(url: str) -> str:
+    url = url.strip().rstrip("/")
+    return url if url.startswith("http") else "https://" + url
+
+
+def package_search(portal: str, field: str, values: list[str], since: Optional[datetime] = None,
+                   session: Optional[requests.Session] = None) -> Iterator[dict]:
+    """Packages of portal whose field (e.g. id) matches one of values, or only those whose metadata was modified
+    after since (UTC)
+    """
+    session = session or requests
+    for k in range(0, len(values), BATCH_SIZE):
+        fq = f"{field}:(" + " OR ".join(f'"{x}"' for x in values[k:k + BATCH_SIZE]) + ")"
+        if since is not None:
+            fq += f" AND metadata_modified:[{since:%Y-%m-%dT%H:%M:%SZ} TO *]"
+        params = {"fq": fq, "rows": PAGE_SIZE, "start": 0}
+        while True:
+            r = session.get(f"{portal}{SEARCH_PATH}", params=params, timeout=TIMEOUT)
+            r.raise_for_status()
+            result = r.json()
+            if not result.get("success"):
+                raise ValueError(f"package_search failed for {portal}: {result.get('error')}")
+            packages = result["result"]["results"]
+            yield from packages
+            params["start"] += len(packages)
+            if len(packages) == 0 or params["start"] >= result["result"]["count"]:
+                break
+
+
+def resource_modified(packages) -> dict[str, str]:
+    """Last modification time of each resource of packages"""
+    modified = {}
+    for package in packages:
+        for resource in package.get("resources", []):
+            value = resource.get("last_modified") or resource.get("metadata_modified") or package.get("metadata_modified")
+            if value:
+                modified[resource["id"]] = value
+    return modified
+
+
+def fetch_modified(portal: str, cache: dict, resource_ids: list[str], session: Optional[requests.Session] = None,
+                   now: Optional[datetime] = None) -> dict:
+    """Update the cache entry of a portal ({"resources": {id: modified}, "packages": {resource id: package id},
+    "swept": ..., "full_sweep": ...}) with the packages of resource_ids modified since the last sweep, or all of their
+    packages if a full sweep is due. Returns the updated entry.
+    """
+    now = now or datetime.now(timezone.utc)
+    packages = dict(cache.get("packages", {})) if cache else {}
+
+    # Packages of new resources are found by the IDs in the URLs of their resources. The results include the
+    # resources' modification times. Resources that are not found are searched for again in the next sweep.
+    new = set(x for x in resource_ids if x not in packages)
+    searched = set()
+    found = {}
+    for package in package_search(portal, "urls", sorted(new), session=session):
+        searched.add(package["id"])
+        found.update(resource_modified([package]))
+        packages.update({r["id"]: package["id"] for r in package.get("resources", []) if r.get("id") in new})
+
+    # Entries without packages were swept before sweeps were restricted to tracked packages
+    full = not cache or "packages" not in cache or \
+        now - datetime.fromisoformat(cache["full_sweep"]) > timedelta(days=FULL_SWEEP_DAYS)
+    since = None if full else datetime.fromisoformat(cache["swept"]) - SWEEP_OVERLAP
+    package_ids = sorted({packages[x] for x in resource_ids if x in packages} - searched)
+    found.update(resource_modified(package_search(portal, "id", package_ids, since, session)))
+    return {
+        "resources": found if full else {**cache["resources"], **found},
+        "packages": packages,
+        "swept": now.isoformat(timespec="seconds"),
+        "full_sweep": now.isoformat(timespec="seconds") if full else cache["full_sweep"],
+    }
+
+
+def sweep(df: pd.DataFrame, breaker: Optional[HostCircuitBreaker] = None,
+          session: Optional[requests.Session] = None, budget: Optional[Budget] = None) -> pd.Series:
+    """Last modification time of the resource of each CKAN row of df with a few requests per portal. Other rows
+    and resources that could not be found are null. Each portal is charged to budget, and no more portals are
+    searched once it is exhausted.
+    """
+    updated = pd.Series(None, index=df.index, dtype=object)
+    ckan = df[(df["DataType"] == "CKAN") & df["dataset_id"].apply(lambda x: isinstance(x, str))]
+    portals = state.load_json(STATE_FILE)
+    for portal, rows in ckan.groupby(ckan["URL"].map(portal_url)):
+        if budget is not None and budget.exhausted():
+            break
+        if breaker is not None and not breaker.allow(portal):
+            continue
+        if budget is not None:
+            budget.charge()
+        try:
+            resource_ids = list(rows["dataset_id"].str.strip().unique())
+            portals[portal] = fetch_modified(portal, portals.get(portal), resource_ids, session)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            if breaker is not None:
+                breaker.record_failure(portal, e)
+            print(f"Unable to search the packages of {portal}. Its rows will be checked: {e}")
+            continue
+        if breaker is not None:
+            breaker.record_success(portal)
+        updated[rows.index] = rows["dataset_id"].str.strip().map(portals[portal]["resources"]).values
+    state.save_json(STATE_FILE, portals)
+    return updated.where(updated.notnull(), None)
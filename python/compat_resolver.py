@@ -0,0 +1,141 @@
+"""Resolve the source table that a given version of OpenPoliceData uses.
+
+OPD versions up to the version of a row of compatibility/compat_versions.csv load that row's snapshot (the first
+one in version order) instead of the current table. Rows that the client cannot load are then removed: min_version
+of -1 means that no version can load the row, and otherwise the client version must be at least min_version and the
+Python version at least py_min_version. This follows the rules in openpolicedata.deprecated.source_table_compat
+and openpolicedata.data.
+
+Versions are compared once per distinct value rather than once per row. Resolved tables are cached in-process and in
+the local state directory, keyed by the contents of the tables they were resolved from, so that workers running
+different OPD versions resolve each (table, version) pair once.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import io
+import sys
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+from packaging import version
+
+import compat_snapshots
+import state
+
+
+CACHE_DIR = "compat"
+# Cached entries that have not been used for this many days are removed
+CACHE_MAX_AGE_DAYS = 30
+
+_cache: dict[str, pd.DataFrame] = {}
+
+
+def _parse(v) -> Optional[version.Version]:
+    try:
+        return version.parse(str(v).strip())
+    except version.InvalidVersion:
+        return None
+
+
+def snapshot_for(client_version: str, versions: Optional[pd.DataFrame] = None) -> Optional[str]:
+    """Name of the compatibility snapshot used by client_version or None if it uses the current table"""
+    if versions is None:
+        versions = pd.read_csv(compat_snapshots.COMPAT_VERSIONS, dtype=str)
+    parsed = versions["version"].map(_parse)
+    client = version.parse(client_version)
+    usable = versions[parsed.notnull()].assign(_version=parsed).sort_values("_version", kind="stable")
+    usable = usable[usable["_version"].map(lambda v: client <= v)]
+    return usable["csv_name"].iloc[0] if len(usable) else None
+
+
+def available(df: pd.DataFrame, client_version: str, python_version: Optional[str] = None) -> pd.Series:
+    """Boolean mask of rows of df that client_version of OPD running on python_version can load"""
+    client = version.parse(client_version)
+    python = version.parse(python_version or ".".join(str(x) for x in sys.version_info[:3]))
+
+    mask = pd.Series(True, index=df.index)
+    if "min_version" in df:
+        min_version = df["min_version"].fillna("").astype(str).str.strip()
+        distinct = pd.Series(min_version.unique())
+        ok = dict(zip(distinct, distinct.map(lambda v: v == "" or (v != "-1" and (p := _parse(v)) is not None and client >= p))))
+        mask &= min_version.map(ok)
+    if "py_min_version" in df:
+        py_min_version = df["py_min_version"].fillna("").astype(str).str.strip()
+        distinct = pd.Series(py_min_version.unique())
+        ok = dict(zip(distinct, distinct.map(lambda v: v == "" or ((p := _parse(v)) is not None and python >= p))))
+        mask &= py_min_version.map(ok)
+
+    return mask.astype(bool)
+
+
+def _read_table(csv_name: Optional[str]) -> bytes:
+    if csv_name is None:
+        return compat_snapshots.SOURCE_TABLE.read_bytes()
+    return compat_snapshots.read_snapshot(csv_name)
+
+
+def _cache_key(data: bytes, client_version: str, python_version: Optional[str]) -> str:
+    python = version.parse(python_version or ".".join(str(x) for x in sys.version_info[:3]))
+    key = f"{compat_snapshots.blob_hash(data)}|{version.parse(client_version)}|{python.major}.{python.minor}.{python.micro}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+
+
+def _prune(cache_dir: Path) -> None:
+    cutoff = pd.Timestamp.now().timestamp() - CACHE_MAX_AGE_DAYS * 86400
+    for path in cache_dir.glob("*.pkl"):
+        if path.stat().st_atime < cutoff:
+            path.unlink(missing_ok=True)
+
+
+def resolve(client_version: str, python_version: Optional[str] = None, use_cache: bool = True) -> pd.DataFrame:
+    """Source table as seen by client_version of OPD running on python_version (default: this Python).
+
+    All columns are strings as in the CSV file. A copy is returned so that callers can modify it.
+    """
+    csv_name = snapshot_for(client_version)
+    data = _read_table(csv_name)
+    key = _cache_key(data, client_version, python_version)
+
+    if use_cache and key in _cache:
+        return _cache[key].copy()
+
+    cache_file = state.state_path(CACHE_DIR) / f"{key}.pkl"
+    if use_cache and cache_file.exists():
+        df = pd.read_pickle(cache_file)
+    else:
+        df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, na_values=[""])
+        df = df[available(df, client_version, python_version)].reset_index(drop=True)
+        if use_cache:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_file.with_suffix(".tmp")
+            df.to_pickle(tmp)
+            tmp.replace(cache_file)
+            _prune(cache_file.parent)
+
+    _cache[key] = df
+    return df.copy()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("client_version", help="Version of OpenPoliceData")
+    parser.add_argument("--python", help="Python version of the client (default: this Python)")
+    parser.add_argument("-o", "--output", type=Path, help="Write the resolved table to this CSV file")
+    parser.add_argument("--no-cache", action="store_true", help="Resolve without reading or writing the cache")
+    args = parser.parse_args()
+
+    csv_name = snapshot_for(args.client_version)
+    df = resolve(args.client_version, args.python, use_cache=not args.no_cache)
+    print(f"OPD {args.client_version} uses {csv_name or compat_snapshots.SOURCE_TABLE.name}: {len(df)} loadable rows")
+    if args.output:
+        df.to_csv(args.output, index=False, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,281 @@
+"""Store compatibility snapshots of the source table as deltas against the current table.
+
+Each version in compatibility/compat_versions.csv is a frozen copy of the source table that older versions
+of OPD load. Most of its rows are identical to rows of the current table, so a version is stored as a JSON delta
+keyed by source_table_id: the version's columns and, in row order, either the ID of a row of the current table
+(with any cells that differ) or the full row if it is not in the current table. Rows whose URL or dataset_id
+(and therefore ID) has since changed are matched on the rest of their key. materialize reconstructs the
+version's CSV byte for byte.
+
+A delta records the git blob hash of the table it was built against. If the table has changed since then, the
+base table is read from git so that deltas remain valid until they are rebuilt against the new table. Without a
+git checkout (or if the blob is not in it), the base table is downloaded by its hash from GitHub (BLOB_URL). Rows
+are streamed so that only the base table is held in memory.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import subprocess
+from collections import Counter
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import requests
+
+import download_cache
+from generate_source_table_ids import SOURCE_TABLE_ID, build_source_table_id
+
+
+REPO_DIR = Path(__file__).parent.parent
+SOURCE_TABLE = REPO_DIR / "opd_source_table.csv"
+COMPAT_DIR = REPO_DIR / "compatibility"
+COMPAT_VERSIONS = COMPAT_DIR / "compat_versions.csv"
+DELTA_DIR = COMPAT_DIR / "deltas"
+# Contents of a git blob of this repository by its hash
+BLOB_URL = "https://api.github.com/repos/openpolicedata/opd-data/git/blobs/{blob}"
+BLOB_HEADERS = {"Accept": "application/vnd.github.raw+json"}
+# A blob never changes, so a downloaded base table does not need to be revalidated
+BLOB_MAX_AGE = timedelta(days=365)
+
+# Rows whose URL or dataset_id has changed since the snapshot are matched by these columns if they are unique
+FALLBACK_KEY = ("State", "SourceName", "Agency", "TableType", "Year")
+
+
+def blob_hash(data: bytes) -> str:
+    """Hash of file contents as computed by git hash-object"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def delta_path(csv_name: str) -> Path:
+    return DELTA_DIR / (Path(csv_name).stem + ".json")
+
+
+def _rows(text: str) -> Iterator[list[str]]:
+    return csv.reader(io.StringIO(text, newline=""))
+
+
+def _row_ids(fieldnames: list[str], rows: list[list[str]]) -> list[str]:
+    """IDs of rows. Repeated IDs are made unique with a suffix so that they are stored as full rows."""
+    seen = Counter()
+    ids = []
+    for values in rows:
+        row = dict(zip(fieldnames, values))
+        row_id = row.get(SOURCE_TABLE_ID) or build_source_table_id(row)
+        seen[row_id] += 1
+        ids.append(row_id if seen[row_id] == 1 else f"{row_id}#{seen[row_id]}")
+    return ids
+
+
+class BaseTable:
+    """Rows of a version of the source table indexed by source_table_id"""
+
+    def __init__(self, data: bytes) -> None:
+        self.blob = blob_hash(data)
+        rows = _rows(data.decode("utf-8"))
+        self.fieldnames = next(rows)
+        self._rows = {}
+        fallback = {}
+        for values in rows:
+            row = dict(zip(self.fieldnames, values))
+            row_id = row.get(SOURCE_TABLE_ID) or build_source_table_id(row)
+            self._rows[row_id] = row
+            fallback.setdefault(tuple(row.get(f, "") for f in FALLBACK_KEY), []).append(row_id)
+        self._fallback = {k: v[0] for k, v in fallback.items() if len(v) == 1}
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path] = SOURCE_TABLE) -> BaseTable:
+        return cls(Path(path).read_bytes())
+
+    @classmethod
+    def from_git(cls, blob: str, repo_dir: Optional[Path] = None) -> BaseTable:
+        try:
+            data = subprocess.run(["git", "cat-file", "blob", blob], cwd=repo_dir or REPO_DIR, capture_output=True,
+                                  check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise ValueError(f"Base table {blob} of delta is not in the git repository") from e
+        return cls(data)
+
+    @classmethod
+    def from_url(cls, blob: str) -> BaseTable:
+        """Base table downloaded from BLOB_URL (through the download cache)"""
+        url = BLOB_URL.format(blob=blob)
+        try:
+            data = download_cache.default_cache().fetch(url, BLOB_MAX_AGE, BLOB_HEADERS).read_bytes()
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Unable to download base table {blob} of delta from {url}") from e
+        if blob_hash(data) != blob:
+            raise ValueError(f"Contents of {url} do not match base table {blob} of delta")
+        return cls(data)
+
+    @classmethod
+    def from_blob(cls, blob: str) -> BaseTable:
+        """Base table with git blob hash blob from the git repository if available or otherwise from GitHub"""
+        try:
+            return cls.from_git(blob)
+        except ValueError:
+            pass
+        try:
+            return cls.from_url(blob)
+        except ValueError as e:
+            raise ValueError(f"Base table {blob} of delta is not available from git or GitHub. "
+                             "The delta must be rebuilt from the full snapshot.") from e
+
+    def __contains__(self, row_id: str) -> bool:
+        return row_id in self._rows
+
+    def match(self, row: dict[str, str]) -> Optional[str]:
+        """ID of the row with the same FALLBACK_KEY values as row if there is exactly one"""
+        return self._fallback.get(tuple(row.get(f, "") for f in FALLBACK_KEY))
+
+    def values(self, row_id: str, fieldnames: list[str]) -> list[str]:
+        row = self._rows[row_id]
+        return [row.get(f, "") for f in fieldnames]
+
+
+def build_delta(snapshot: bytes, base: BaseTable, version: str = "", csv_name: str = "") -> dict:
+    """Delta that reconstructs snapshot (contents of a compatibility CSV file) from base"""
+    text = snapshot.decode("utf-8")
+    rows = _rows(text)
+    fieldnames = next(rows)
+    rows = list(rows)
+
+    ids = _row_ids(fieldnames, rows)
+    used = set(ids)
+    entries = []
+    for row_id, values in zip(ids, rows):
+        if row_id not in base:
+            row_id = base.match(dict(zip(fieldnames, values)))
+            if row_id is None or row_id in used:
+                entries.append({"row": values})
+                continue
+            used.add(row_id)
+
+        changed = {f: v for f, v, b in zip(fieldnames, values, base.values(row_id, fieldnames)) if v != b}
+        entries.append({"id": row_id, "set": changed} if changed else row_id)
+
+    return {
+        "version": version,
+        "csv_name": csv_name,
+        "base": base.blob,
+        "fieldnames": fieldnames,
+        "trailing_newline": text.endswith("\n"),
+        "rows": entries,
+    }
+
+
+def materialize(delta: dict, base: Optional[BaseTable] = None) -> bytes:
+    """Reconstruct the contents of a compatibility CSV file from its delta"""
+    if base is None or base.blob != delta["base"]:
+        base = BaseTable.from_file()
+        if base.blob != delta["base"]:
+            base = BaseTable.from_blob(delta["base"])
+
+    fieldnames = delta["fieldnames"]
+    out = io.StringIO(newline="")
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(fieldnames)
+    for entry in delta["rows"]:
+        if isinstance(entry, str):
+            writer.writerow(base.values(entry, fieldnames))
+        elif "row" in entry:
+            writer.writerow(entry["row"])
+        else:
+            values = dict(zip(fieldnames, base.values(entry["id"], fieldnames)))
+            values.update(entry["set"])
+            writer.writerow([values[f] for f in fieldnames])
+
+    text = out.getvalue()
+    if not delta["trailing_newline"]:
+        text = text[:-1]
+    return text.encode("utf-8")
+
+
+def load_delta(csv_name: str) -> dict:
+    with delta_path(csv_name).open(encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def save_delta(delta: dict) -> Path:
+    path = delta_path(delta["csv_name"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8", newline="\n") as handle:
+        json.dump(delta, handle, separators=(",", ":"), ensure_ascii=False)
+        handle.write("\n")
+    return path
+
+
+def read_snapshot(csv_name: str) -> bytes:
+    """Contents of a compatibility CSV from the full file if present, otherwise from its delta"""
+    path = COMPAT_DIR / csv_name
+    if path.exists():
+        return path.read_bytes()
+    return materialize(load_delta(csv_name))
+
+
+def compat_versions() -> list[dict[str, str]]:
+    with COMPAT_VERSIONS.open(newline="", encoding="utf-8") as handle:
+        return list(csv.DictReader(handle))
+
+
+def build_all(versions: Optional[list[str]] = None, check: bool = False) -> int:
+    """Build (or with check, verify) the deltas of versions in compat_versions.csv against the current table"""
+    base = BaseTable.from_file()
+    failed = []
+    for v in compat_versions():
+        if versions and v["version"] not in versions:
+            continue
+
+        csv_name = v["csv_name"]
+        if check:
+            snapshot = (COMPAT_DIR / csv_name).read_bytes() if (COMPAT_DIR / csv_name).exists() else None
+            if not delta_path(csv_name).exists():
+                print(f"{csv_name}: delta missing")
+                failed.append(csv_name)
+            elif snapshot is not None and materialize(load_delta(csv_name), base) != snapshot:
+                print(f"{csv_name}: delta does not reproduce snapshot")
+                failed.append(csv_name)
+            continue
+
+        snapshot = read_snapshot(csv_name)
+        delta = build_delta(snapshot, base, v["version"], csv_name)
+        if materialize(delta, base) != snapshot:
+            raise ValueError(f"Delta for {csv_name} does not reproduce the snapshot")
+        path = save_delta(delta)
+        full_rows = sum(isinstance(e, dict) and "row" in e for e in delta["rows"])
+        print(f"{csv_name}: {len(delta['rows'])} rows ({full_rows} not in current table), "
+              f"{len(snapshot)/1e3:.0f} kB -> {path.stat().st_size/1e3:.0f} kB")
+
+    return 1 if failed else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Build deltas against the current source table")
+    build.add_argument("versions", nargs="*", help="Versions to build (default: all in compat_versions.csv)")
+    build.add_argument("--check", action="store_true", help="Verify that existing deltas reproduce the full snapshots.")
+    mat = sub.add_parser("materialize", help="Write the CSV of a version reconstructed from its delta")
+    mat.add_argument("version")
+    mat.add_argument("-o", "--output", type=Path, help="Output file (default: compatibility/<csv_name>)")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        return build_all(args.versions, args.check)
+
+    matches = [v for v in compat_versions() if v["version"] == args.version]
+    if not matches:
+        raise ValueError(f"Unknown version {args.version}")
+    csv_name = matches[0]["csv_name"]
+    output = args.output or COMPAT_DIR / csv_name
+    output.write_bytes(materialize(load_delta(csv_name)))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
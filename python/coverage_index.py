@@ -0,0 +1,241 @@
+"""Index of the coverage of the rows of the source table for point and range queries and gap reports.
+
+The rows of each dataset series (State, SourceName, Agency, TableType) are stored as slices of arrays that are
+sorted by series and then by coverage_start. For each row, the arrays also hold the latest coverage_end of the
+series up to that row. A query for a date or date range uses a binary search (searchsorted) on the starts of
+each matching series instead of parsing and scanning the whole table. The gaps and overlaps of every series are
+found in a single vectorized pass over the same arrays (see report).
+
+    index = CoverageIndex(df)
+    rows = index.search(date="03/15/2021", State="Virginia")
+    gaps = index.report()
+
+Rows without a valid coverage_start and coverage_end are not indexed.
+
+    python coverage_index.py --state Virginia --date 03/15/2021
+    python coverage_index.py --report
+"""
+
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from generate_source_table_ids import SOURCE_TABLE_ID
+
+
+SOURCE_TABLE = Path(__file__).parent.parent / "opd_source_table.csv"
+SERIES_KEY = ["State", "SourceName", "Agency", "TableType"]
+DATE_FORMAT = "%m/%d/%Y"
+ONE_DAY = np.timedelta64(1, "D")
+
+GAP = "gap"
+OVERLAP = "overlap"
+REPORT_COLUMNS = SERIES_KEY + ["issue", "start", "end", "days", "before", "after"]
+
+
+def _to_datetime(values: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format=DATE_FORMAT, errors="coerce")
+
+
+def _date(value) -> np.datetime64:
+    return pd.Timestamp(value).to_datetime64()
+
+
+class CoverageIndex:
+    """Coverage of each dataset series of the source table in sorted arrays
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Source table. coverage_start and coverage_end are MM/DD/YYYY strings or datetimes.
+    """
+
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = df
+        starts = _to_datetime(df["coverage_start"])
+        ends = _to_datetime(df["coverage_end"])
+        valid = (starts.notnull() & ends.notnull()).to_numpy()
+        keys = df.loc[valid, SERIES_KEY].astype(object).where(df.loc[valid, SERIES_KEY].notnull(), "").astype(str)
+
+        codes = keys.groupby(SERIES_KEY, sort=True).ngroup().to_numpy()
+        starts = starts[valid].to_numpy(dtype="datetime64[ns]")
+        ends = ends[valid].to_numpy(dtype="datetime64[ns]")
+        order = np.lexsort((ends, starts, codes))
+
+        self.codes = codes[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        # Labels of the rows in the index of df
+        self.labels = df.index[valid][order]
+
+        # Latest end of each series up to each row and the position of the row that it is from
+        ends = pd.Series(self.ends)
+        self.max_ends = ends.groupby(self.codes).cummax().to_numpy()
+        is_max = ends.to_numpy() == self.max_ends
+        self.max_positions = pd.Series(np.where(is_max, np.arange(len(ends)), np.nan)).groupby(self.codes) \
+            .ffill().to_numpy(dtype=int)
+
+        # Slice of the arrays of each series
+        bounds = np.flatnonzero(np.diff(self.codes)) + 1
+        self._lo = np.concatenate([[0], bounds]).astype(int)
+        self._hi = np.concatenate([bounds, [len(self.codes)]]).astype(int)
+        firsts = keys.iloc[order].iloc[self._lo] if len(order) else keys
+        self.series = pd.DataFrame(firsts.to_numpy(), columns=SERIES_KEY)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def _series_positions(self, **filters) -> np.ndarray:
+        """Positions in self.series of the series matching filters (e.g. State="Virginia")"""
+        mask = np.ones(len(self.series), dtype=bool)
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if column not in SERIES_KEY:
+                raise ValueError(f"Unable to filter coverage by {column}. Filters must be one of {SERIES_KEY}")
+            mask &= (self.series[column] == value).to_numpy()
+        return np.flatnonzero(mask)
+
+    def _overlapping(self, start: np.datetime64, end: np.datetime64, positions: np.ndarray) -> np.ndarray:
+        """Array positions of rows of the series at positions whose coverage overlaps start to end"""
+        found = []
+        for s in positions:
+            lo, hi = self._lo[s], self._hi[s]
+            # Only rows that start on or before the end of the range can overlap it
+            n = np.searchsorted(self.starts[lo:hi], end, side="right")
+            if n == 0 or self.max_ends[lo + n - 1] < start:
+                continue
+            found.append(lo + np.flatnonzero(self.ends[lo:lo + n] >= start))
+        return np.concatenate(found) if found else np.array([], dtype=int)
+
+    def search(self, date=None, start=None, end=None, **filters) -> pd.DataFrame:
+        """Rows of the source table whose coverage includes date or overlaps start to end. Missing start or end
+        is unbounded. filters are values of columns of SERIES_KEY (e.g. State="Virginia", TableType="STOPS").
+        """
+        if date is not None:
+            start = end = date
+        start = _date(start) if start is not None else pd.Timestamp.min.to_datetime64()
+        end = _date(end) if end is not None else pd.Timestamp.max.to_datetime64()
+        found = self._overlapping(start, end, self._series_positions(**filters))
+        return self.df.loc[self.labels[np.sort(found)]]
+
+    def covers(self, start, end, **filters) -> bool:
+        """Whether the rows of the series matching filters together cover every day from start to end"""
+        start, end = _date(start), _date(end)
+        rows = self._overlapping(start, end, self._series_positions(**filters))
+        if len(rows) == 0:
+            return False
+        # Walk the rows by start. Each one must begin by the day after the coverage so far.
+        rows = rows[np.argsort(self.starts[rows], kind="stable")]
+        covered = start - ONE_DAY
+        for k in rows:
+            if self.starts[k] > covered + ONE_DAY:
+                return False
+            covered = max(covered, self.ends[k])
+            if covered >= end:
+                return True
+        return False
+
+    def latest(self) -> pd.Index:
+        """Labels of the row with the latest coverage_end of each series"""
+        return self.labels[self.max_positions[self._hi - 1]] if len(self) else self.labels
+
+    def report(self, min_gap_days: int = 1) -> pd.DataFrame:
+        """Gaps and overlaps in the coverage of every series.
+
+        A gap is a period of at least min_gap_days between the latest coverage_end of the rows of a series so far and
+        the coverage_start of the next row. An overlap is a period that is covered by more than one row. before is
+        the source_table_id (or label if there is none) of the row before the gap or that is overlapped, and after is
+        the row after the gap or that overlaps it.
+        """
+        if len(self) < 2:
+            return pd.DataFrame(columns=REPORT_COLUMNS)
+
+        # Compare each row to the rows of its series that start before it
+        following = np.flatnonzero(self.codes[1:] == self.codes[:-1]) + 1
+        previous_end = self.max_ends[following - 1]
+        starts = self.starts[following]
+        gap_days = (starts - previous_end) // ONE_DAY - 1
+        is_gap = gap_days >= min_gap_days
+        is_overlap = starts <= previous_end
+
+        names = self.df[SOURCE_TABLE_ID] if SOURCE_TABLE_ID in self.df else pd.Series(self.df.index, index=self.df.index)
+        names = names.where(names.notnull(), pd.Series(self.df.index.astype(str), index=self.df.index))
+        names = names.loc[self.labels].to_numpy()
+
+        def issues(kind, mask, start, end, days):
+            rows = following[mask]
+            found = self.series.iloc[self.codes[rows]].reset_index(drop=True)
+            found["issue"] = kind
+            found["start"] = start[mask]
+            found["end"] = end[mask]
+            found["days"] = days[mask]
+            found["before"] = names[self.max_positions[rows - 1]]
+            found["after"] = names[rows]
+            return found
+
+        overlap_end = np.minimum(previous_end, self.ends[following])
+        report = pd.concat([
+            issues(GAP, is_gap, previous_end + ONE_DAY, starts - ONE_DAY, gap_days),
+            issues(OVERLAP, is_overlap, starts, overlap_end, (overlap_end - starts) // ONE_DAY + 1),
+        ], ignore_index=True)
+        return report.sort_values(SERIES_KEY + ["start"], kind="stable").reset_index(drop=True)[REPORT_COLUMNS]
+
+
+def new_issues(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    """Issues of a report in after that are not in before. Issues are matched by the rows on either side of them,
+    so a gap or overlap whose size changed is not new.
+    """
+    def key(r):
+        return r["issue"] + "|" + r["before"].astype(str) + "|" + r["after"].astype(str)
+    return after[~key(after).isin(key(before))]
+
+
+def warn_new_issues(before: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    """Report the gaps and overlaps of df and print those that are not in before. Returns the report of df."""
+    report = CoverageIndex(df).report()
+    new = new_issues(before, report)
+    if len(new) > 0:
+        print(f"WARNING: {len(new)} new coverage gap(s) or overlap(s) in the source table:")
+        for r in new.head(20).itertuples():
+            print(f"    {r.issue} of {r.days} days from {r.start:%m/%d/%Y} to {r.end:%m/%d/%Y} between {r.before} and {r.after}")
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source_table", nargs="?", default=SOURCE_TABLE, type=Path, help="Path to opd_source_table.csv")
+    parser.add_argument("--date", help="Find rows whose coverage includes this date")
+    parser.add_argument("--start", help="Find rows whose coverage overlaps the range from this date")
+    parser.add_argument("--end", help="Find rows whose coverage overlaps the range to this date")
+    for column in SERIES_KEY:
+        parser.add_argument(f"--{column.lower()}", dest=column, help=f"Only include rows with this {column}")
+    parser.add_argument("--report", action="store_true", help="Print the gaps and overlaps of every series")
+    parser.add_argument("--min-gap-days", type=int, default=1, help="Shortest gap to report")
+    parser.add_argument("-o", "--output", type=Path, help="Write the results to this CSV file")
+    args = parser.parse_args()
+
+    index = CoverageIndex(pd.read_csv(args.source_table, dtype=str))
+    if args.report:
+        result = index.report(args.min_gap_days)
+        for issue, n in result["issue"].value_counts().items():
+            print(f"{n} {issue}(s) in {result.loc[result['issue']==issue, SERIES_KEY].drop_duplicates().shape[0]} series")
+    else:
+        filters = {c: getattr(args, c) for c in SERIES_KEY}
+        result = index.search(args.date, args.start, args.end, **filters)
+        print(f"{len(result)} row(s)")
+        columns = SERIES_KEY + ["Year", "coverage_start", "coverage_end"]
+        print(result[columns].to_string(index=False) if len(result) else "")
+    if args.output:
+        result.to_csv(args.output, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,143 @@
+"""Infer the format of date columns once per dataset and parse them with a fixed format.
+
+Parsing a column of date strings with pd.to_datetime(format='mixed') infers the format of every element, which
+is very slow for large tables. infer_format finds a single format that parses a sample of the column, and
+DateFormatCache stores it by source_table_id and column so that later runs parse the whole column with that
+format in a single vectorized call. If the cached format does not parse every value of the column (e.g. the
+publisher changed it), the format is inferred again. Columns without a single format are parsed with
+format='mixed' as before. parse_dates converts columns that mix formats (or mix dates with other values)
+without a cache, parsing only the values that the column's main format does not parse with format='mixed'.
+
+    formats = DateFormatCache()
+    dates = formats.to_datetime(table[column], source_table_id, column)
+    formats.save()
+"""
+
+from __future__ import annotations
+
+import warnings
+from typing import Optional
+
+import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+
+import state
+
+
+STATE_FILE = "date_formats.json"
+SAMPLE_SIZE = 1000
+# Tried after the format guessed from the first value
+COMMON_FORMATS = [
+    "%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%fZ",
+    "%m/%d/%Y", "%m/%d/%Y %H:%M", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %I:%M:%S %p", "%m/%d/%y", "%Y/%m/%d",
+    "%Y%m%d", "%d-%b-%y", "%d-%b-%Y",
+]
+
+
+def _parsed_fraction(values: pd.Series, fmt: str) -> float:
+    if len(values) == 0:
+        return 0.0
+    return pd.to_datetime(values, format=fmt, errors="coerce").notnull().mean()
+
+
+def _sample(values: pd.Series, sample_size: int) -> pd.Series:
+    """Sample of the strings of a column. Values of a column of mixed types that are not strings are excluded."""
+    values = values.dropna()
+    sample = values.sample(sample_size, random_state=0) if len(values) > sample_size else values
+    if values.dtype == object:
+        sample = sample[[isinstance(x, str) for x in sample]]
+    return sample.astype(str)
+
+
+def _best_format(sample: pd.Series) -> tuple[Optional[str], float]:
+    """Format that parses the largest fraction of sample and that fraction"""
+    best, best_fraction = None, 0.0
+    if len(sample) == 0:
+        return best, best_fraction
+    guessed = guess_datetime_format(sample.iloc[0])
+    for fmt in ([guessed] if guessed else []) + COMMON_FORMATS:
+        fraction = _parsed_fraction(sample, fmt)
+        if fraction > best_fraction:
+            best, best_fraction = fmt, fraction
+        if fraction == 1.0:
+            break
+    return best, best_fraction
+
+
+def infer_format(values: pd.Series, sample_size: int = SAMPLE_SIZE) -> Optional[str]:
+    """Format that parses every value in a sample of a column of strings or None if there is no such format"""
+    fmt, fraction = _best_format(_sample(values, sample_size))
+    return fmt if fraction == 1.0 else None
+
+
+def _to_datetime_mixed(values: pd.Series) -> pd.Series:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return pd.to_datetime(values, format="mixed")
+
+
+def parse_dates(values: pd.Series) -> pd.Series:
+    """Convert a column of dates to datetimes. Values that are not dates (e.g. text or numbers mixed in with the
+    dates) become NaT.
+
+    Values are parsed with the format that parses most of a sample of the strings of the column, and only the values
+    that it does not parse are parsed with format='mixed', so values in other formats are kept rather than dropped.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        fmt, _ = _best_format(_sample(values, SAMPLE_SIZE))
+        parsed = pd.to_datetime(values, format=fmt, errors="coerce")
+        rest = parsed.isnull() & values.notnull()
+        if rest.any():
+            # format='mixed' would read numbers as a day of the current month
+            rest &= pd.to_numeric(values[rest], errors="coerce").isnull().reindex(rest.index, fill_value=False)
+            parsed[rest] = pd.to_datetime(values[rest], format="mixed", errors="coerce")
+    # Numbers are converted to nanoseconds after 1/1/1970. Only those values need to be checked.
+    suspect = parsed < pd.Timestamp("1970-01-02")
+    if suspect.any():
+        parsed[suspect] = parsed[suspect].where(pd.to_numeric(values[suspect], errors="coerce").isnull())
+    return parsed
+
+
+class DateFormatCache:
+    def __init__(self, state_file: str = STATE_FILE) -> None:
+        self.state_file = state_file
+        # source_table_id -> column -> format
+        self._formats: dict[str, dict[str, str]] = state.load_json(state_file)
+
+    def save(self) -> None:
+        state.save_json(self.state_file, self._formats)
+
+    def get(self, source_table_id: str, column: str) -> Optional[str]:
+        return self._formats.get(source_table_id, {}).get(column)
+
+    def to_datetime(self, values: pd.Series, source_table_id: Optional[str], column: str) -> pd.Series:
+        """Convert a column of a dataset to datetimes with its cached format, inferring it if needed. Columns
+        that are already datetimes are returned unchanged.
+        """
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+        if pd.api.types.infer_dtype(values, skipna=True) != "string":
+            # Dates or numbers, possibly mixed in with strings
+            return parse_dates(values)
+        strings = values.dropna()
+
+        fmt = self.get(source_table_id, column) if source_table_id else None
+        if fmt is not None:
+            parsed = pd.to_datetime(values, format=fmt, errors="coerce")
+            # Every value must be parsed. A value that is dropped could be the first or last date.
+            if parsed.notnull().sum() == len(strings):
+                return parsed
+
+        fmt = infer_format(strings)
+        if fmt is None:
+            return _to_datetime_mixed(values)
+        parsed = pd.to_datetime(values, format=fmt, errors="coerce")
+        if parsed.notnull().sum() < len(strings):
+            # The sample did not represent the whole column
+            return _to_datetime_mixed(values)
+        if source_table_id:
+            self._formats.setdefault(source_table_id, {})[column] = fmt
+        return parsed
@@ -0,0 +1,150 @@
+"""Find the agencies in multi-agency datasets without loading the datasets.
+
+count_agencies needs only the distinct values of the agency field of each multi-agency dataset. Loading a
+statewide dataset to find them takes gigabytes of memory, so the distinct values are requested from the server
+where possible (Socrata $group, ArcGIS returnDistinctValues, and SELECT DISTINCT for CKAN and Carto). CSV files
+are downloaded (through the download cache) and only the agency column is read, in chunks, into a running set. For
+single-year rows, the date column is read as well and only the rows of the row's year are kept, as OPD does.
+
+Rows with a query, combined datasets, single-year rows of portals (which OPD filters by date), and single-year CSV
+rows without a date field are not supported (see supported) and are loaded with OPD as before.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import pandas as pd
+import requests
+
+import openpolicedata as opd
+
+import arcgis_layers
+import download_cache
+from circuit_breaker import host_of
+from ckan_portal import portal_url
+from date_formats import parse_dates
+
+
+PAGE_SIZE = 32000
+CSV_CHUNK_SIZE = 500000
+TIMEOUT = 60
+# Data types that support getting distinct values from the server
+PORTALS = ["ArcGIS", "Carto", "CKAN", "Socrata"]
+
+
+def socrata_distinct(domain: str, dataset_id: str, field: str, session: Optional[requests.Session] = None) -> list:
+    """Distinct non-null values of field using $group queries"""
+    session = session or requests
+    url = f"https://{host_of(domain)}/resource/{dataset_id.strip()}.json"
+    params = {"$select": field, "$group": field, "$order": field, "$limit": PAGE_SIZE, "$offset": 0}
+    values = []
+    while True:
+        r = session.get(url, params=params, timeout=TIMEOUT)
+        r.raise_for_status()
+        page = r.json()
+        # The group of null values has no field
+        values.extend(x[field] for x in page if field in x)
+        params["$offset"] += len(page)
+        if len(page) < PAGE_SIZE:
+            break
+    return values
+
+
+def _sql_distinct(url: str, param: str, sql: str, get_records, session: Optional[requests.Session] = None) -> list:
+    """Run a SELECT DISTINCT ... AS value query one page at a time. get_records returns the records of a response."""
+    session = session or requests
+    values = []
+    offset = 0
+    while True:
+        r = session.get(url, params={param: f"{sql} LIMIT {PAGE_SIZE} OFFSET {offset}"}, timeout=TIMEOUT)
+        r.raise_for_status()
+        records = get_records(r.json())
+        values.extend(x["value"] for x in records if x["value"] is not None)
+        offset += len(records)
+        if len(records) < PAGE_SIZE:
+            break
+    return values
+
+
+def ckan_distinct(url: str, dataset_id: str, field: str, session: Optional[requests.Session] = None) -> list:
+    """Distinct non-null values of field of a CKAN datastore resource using SELECT DISTINCT"""
+    sql = f'SELECT DISTINCT "{field}" AS value FROM "{dataset_id.strip()}" ORDER BY value'
+    def records(result):
+        if not result.get("success"):
+            raise ValueError(f"datastore_search_sql failed for {url}: {result.get('error')}")
+        return result["result"]["records"]
+    return _sql_distinct(f"{portal_url(url)}/api/3/action/datastore_search_sql", "sql", sql, records, session)
+
+
+def carto_distinct(url: str, dataset_id: str, field: str, session: Optional[requests.Session] = None) -> list:
+    """Distinct non-null values of field of a Carto table using SELECT DISTINCT"""
+    # Same URL format as the OPD Carto loader: https://{username}.carto.com/api/v2/sql
+    username = url.replace("https://", "")
+    username = username[:username.find(".carto")] if ".carto" in username else username
+    sql = f'SELECT DISTINCT "{field}" AS value FROM {dataset_id.strip()} ORDER BY value'
+    return _sql_distinct(f"https://{username}.carto.com/api/v2/sql", "q", sql, lambda result: result["rows"], session)
+
+
+def _in_year(dates: pd.Series, date_field: str, year: int) -> pd.Series:
+    """Mask of dates in year. Columns of years (e.g. date_field Year) are compared to year."""
+    years = pd.to_numeric(dates, errors="coerce")
+    if date_field.lower() == "year" or (years.notnull().all() and years.between(1900, 2200).all()):
+        return years == year
+    return parse_dates(dates).dt.year == year
+
+
+def csv_distinct(url: str, field: str, date_field: Optional[str] = None, year: Optional[int] = None) -> list:
+    """Distinct non-null values of field of the CSV file (or zip file containing one CSV file) at url. Only the
+    column of field (and date_field if year is set) is read, one chunk at a time. If year is set, only rows whose
+    date_field is in year are included.
+    """
+    path = download_cache.fetch(url)
+    columns = [field, date_field] if year is not None else [field]
+    values = set()
+    # OPD strips column names
+    with pd.read_csv(path, usecols=lambda c: c.strip() in columns, dtype=str, chunksize=CSV_CHUNK_SIZE,
+                     compression="zip" if ".zip" in url else "infer", encoding_errors="replace") as reader:
+        for chunk in reader:
+            chunk.columns = chunk.columns.str.strip()
+            missing = [c for c in columns if c not in chunk]
+            if missing:
+                raise ValueError(f"Column(s) {missing} not found in {url}")
+            if year is not None:
+                chunk = chunk[_in_year(chunk[date_field], date_field, year).to_numpy()]
+            values.update(chunk[field].dropna().unique())
+    return sorted(values)
+
+
+def supported(row: pd.Series) -> bool:
+    """Whether the agencies of a row of the source table can be found by fetch"""
+    if pd.notnull(row.get("query")) or not isinstance(row.get("agency_field"), str):
+        return False
+    dataset_id = row.get("dataset_id")
+    if row["DataType"] == "CSV":
+        # OPD filters single-year rows by their date field
+        return opd.dataset_id.isnull(dataset_id) and \
+            (row["Year"] in [opd.defs.MULTI, opd.defs.NA] or isinstance(row.get("date_field"), str))
+    if row["DataType"] == "ArcGIS":
+        return row["Year"] == opd.defs.MULTI
+    if row["DataType"] in PORTALS:
+        return row["Year"] == opd.defs.MULTI and isinstance(dataset_id, str)
+    return False
+
+
+def fetch(row: pd.Series, session: Optional[requests.Session] = None) -> list:
+    """Distinct agencies in a row of the source table (see supported)"""
+    field = row["agency_field"]
+    if row["DataType"] == "CSV":
+        if row["Year"] in [opd.defs.MULTI, opd.defs.NA]:
+            return csv_distinct(row["URL"], field)
+        return csv_distinct(row["URL"], field, row["date_field"].strip(), int(row["Year"]))
+    elif row["DataType"] == "ArcGIS":
+        return arcgis_layers.distinct_values(row["URL"], field, session)
+    elif row["DataType"] == "Socrata":
+        return socrata_distinct(row["URL"], row["dataset_id"], field, session)
+    elif row["DataType"] == "CKAN":
+        return ckan_distinct(row["URL"], row["dataset_id"], field, session)
+    elif row["DataType"] == "Carto":
+        return carto_distinct(row["URL"], row["dataset_id"], field, session)
+    raise ValueError(f"Unable to get distinct agencies for data type {row['DataType']}")
@@ -0,0 +1,278 @@
+"""Content-addressed cache of files downloaded by the table maintenance scripts.
+
+Files are stored in the state directory by the SHA-256 of their contents, so a file that is published at several
+URLs (or that has not changed since it was last downloaded) is only stored once. An index maps each URL to the hash
+of its contents and the validators (ETag and Last-Modified) returned by the server. A URL that was fetched less
+than max_age ago is served from the cache without a request. Otherwise, a conditional request is made and the
+file is only downloaded if it has changed. When the cache grows beyond its size limit, the least recently used
+files are removed.
+
+    path = download_cache.fetch(url)
+
+Only files that the scripts download themselves go through the cache. Data loaded by OPD's loaders (e.g.
+Source.load in update_table.update_dates and is_data_available in predict_urls) is downloaded by OPD and is not
+cached.
+
+Several processes can share a cache (e.g. by setting OPD_STATE_DIR). Files are never modified once written, so the
+worst case of concurrent updates to the index is a repeated download.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import cached_property
+from pathlib import Path
+from typing import Optional, Union
+
+import requests
+
+import run_metrics
+import state
+
+
+INDEX_FILE = "download_index.json"
+OBJECTS_DIR = "downloads"
+MAX_AGE = timedelta(days=1)
+MAX_BYTES = int(float(os.environ.get("OPD_DOWNLOAD_CACHE_MB", 5000)) * 2**20)
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60
+# Some servers refuse requests without a browser user agent (see openpolicedata.data_loaders.Excel)
+BROWSER_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:106.0) Gecko/20100101 Firefox/106.0'}
+
+
+@dataclass
+class CachedFile:
+    """File from the cache with the attributes of a requests response that the scripts use"""
+    url: str
+    path: Path
+
+    @cached_property
+    def content(self) -> bytes:
+        return self.path.read_bytes()
+
+    @cached_property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+
+def _get(url: str, headers: dict) -> requests.Response:
+    """Streamed response for url. The caller must close it."""
+    try:
+        r = requests.get(url, stream=True, timeout=TIMEOUT, headers=headers)
+        if r.status_code in [403, 406]:
+            r.close()
+            r = requests.get(url, stream=True, timeout=TIMEOUT, headers={**BROWSER_HEADERS, **headers})
+    except requests.exceptions.SSLError:
+        # Some servers require legacy renegotiation
+        import openpolicedata as opd
+        with opd.data_loaders.get_legacy_session() as session:
+            r = session.get(url, stream=True, timeout=TIMEOUT, headers=headers)
+    return r
+
+
+class DownloadCache:
+    def __init__(self, max_bytes: int = MAX_BYTES, max_age: timedelta = MAX_AGE, index_file: str = INDEX_FILE) -> None:
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_file = index_file
+        self.directory = state.state_path(OBJECTS_DIR)
+        self.directory.mkdir(exist_ok=True)
+        index = state.load_json(index_file)
+        self._urls: dict[str, dict] = index.get("urls", {})
+        self._objects: dict[str, dict] = index.get("objects", {})
+        self._lock = threading.RLock()
+        # Number of users of each file that must not be evicted (see link)
+        self._pinned: dict[str, int] = {}
+        self.hits = 0
+        self.downloads = 0
+
+    def object_path(self, sha256: str) -> Path:
+        return self.directory / sha256[:2] / sha256
+
+    def _save(self) -> None:
+        state.save_json(self.index_file, {"urls": self._urls, "objects": self._objects})
+
+    def _touch(self, sha256: str, now: datetime) -> None:
+        self._objects[sha256]["last_used"] = now.isoformat(timespec="seconds")
+
+    def fetch(self, url: str, max_age: Optional[timedelta] = None, headers: Optional[dict] = None) -> Path:
+        """Path of the cached contents of url, downloading it if it is not in the cache or may have changed"""
+        return self._fetch(url, max_age, headers)
+
+    def cached(self, url: str, max_age: Optional[timedelta] = None) -> Optional[Path]:
+        """Path of the cached contents of url if it was fetched less than max_age ago or None. No request is made."""
+        url = url.replace(' ', '%20')
+        max_age = self.max_age if max_age is None else max_age
+        now = datetime.now()
+        with self._lock:
+            entry = self._urls.get(url)
+            if not entry or not self.object_path(entry["sha256"]).exists() or \
+                    now - datetime.fromisoformat(entry["fetched"]) >= max_age:
+                return None
+            self.hits += 1
+            self._touch(entry["sha256"], now)
+            self._save()
+            return self.object_path(entry["sha256"])
+
+    def _pin(self, sha256: str) -> None:
+        self._pinned[sha256] = self._pinned.get(sha256, 0) + 1
+
+    def _unpin(self, sha256: str) -> None:
+        with self._lock:
+            self._pinned[sha256] -= 1
+            if self._pinned[sha256] == 0:
+                del self._pinned[sha256]
+
+    def _fetch(self, url: str, max_age: Optional[timedelta] = None, headers: Optional[dict] = None,
+               pin: bool = False) -> Path:
+        """fetch. If pin is True, the file cannot be evicted until _unpin is called with its hash (the file name)."""
+        url = url.replace(' ', '%20')
+        max_age = self.max_age if max_age is None else max_age
+        now = datetime.now()
+
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry and not self.object_path(entry["sha256"]).exists():
+                entry = None
+            if entry and now - datetime.fromisoformat(entry["fetched"]) < max_age:
+                self.hits += 1
+                self._touch(entry["sha256"], now)
+                if pin:
+                    self._pin(entry["sha256"])
+                self._save()
+                return self.object_path(entry["sha256"])
+
+        request_headers = dict(headers or {})
+        if entry and entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        with _get(url, request_headers) as r:
+            if entry and r.status_code == 304:
+                with self._lock:
+                    if self.object_path(entry["sha256"]).exists():
+                        self.hits += 1
+                        entry["fetched"] = now.isoformat(timespec="seconds")
+                        self._touch(entry["sha256"], now)
+                        if pin:
+                            self._pin(entry["sha256"])
+                        self._save()
+                        return self.object_path(entry["sha256"])
+                # Evicted since it was checked above. Eviction also removed the URL so it is downloaded again.
+                return self._fetch(url, max_age, headers, pin)
+            r.raise_for_status()
+
+            sha256 = hashlib.sha256()
+            size = 0
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        run_metrics.add_bytes(size)
+        digest = sha256.hexdigest()
+        path = self.object_path(digest)
+
+        with self._lock:
+            # Under the lock so that the file cannot be evicted between checking that it exists and indexing it
+            if path.exists():
+                # Contents are already cached for another URL or an earlier download
+                os.remove(tmp)
+            else:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmp, path)
+            self.downloads += 1
+            self._urls[url] = {
+                "sha256": digest,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "fetched": now.isoformat(timespec="seconds"),
+            }
+            self._objects[digest] = {"size": size}
+            self._touch(digest, now)
+            if pin:
+                self._pin(digest)
+            self.evict(keep=digest)
+            self._save()
+        return path
+
+    def get(self, url: str, max_age: Optional[timedelta] = None, headers: Optional[dict] = None) -> CachedFile:
+        """Cached file that can be used in place of the response of requests.get"""
+        return CachedFile(url, self.fetch(url, max_age, headers))
+
+    def link(self, url: str, dest: Union[str, Path], max_age: Optional[timedelta] = None) -> Path:
+        """Hard link the cached contents of url to dest (copying if a link cannot be made). Files must not be modified."""
+        # The file is pinned so that another thread cannot evict it before it is linked
+        path = self._fetch(url, max_age, pin=True)
+        try:
+            dest = Path(dest)
+            if dest.exists():
+                dest.unlink()
+            try:
+                os.link(path, dest)
+            except OSError:
+                shutil.copyfile(path, dest)
+        finally:
+            self._unpin(path.name)
+        return dest
+
+    def size(self) -> int:
+        return sum(x["size"] for x in self._objects.values())
+
+    def evict(self, keep: Optional[str] = None) -> list[str]:
+        """Remove least recently used files until the cache is within max_bytes. Returns the hashes of removed files."""
+        with self._lock:
+            total = self.size()
+            removed = []
+            for sha256, obj in sorted(self._objects.items(), key=lambda x: x[1].get("last_used", "")):
+                if total <= self.max_bytes:
+                    break
+                if sha256 == keep or sha256 in self._pinned:
+                    continue
+                self.object_path(sha256).unlink(missing_ok=True)
+                total -= obj["size"]
+                removed.append(sha256)
+
+            for sha256 in removed:
+                del self._objects[sha256]
+            self._urls = {u: e for u, e in self._urls.items() if e["sha256"] not in removed}
+            return removed
+
+
+_default: Optional[DownloadCache] = None
+_default_lock = threading.Lock()
+
+
+def default_cache() -> DownloadCache:
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = DownloadCache()
+        return _default
+
+
+def fetch(url: str, max_age: Optional[timedelta] = None) -> Path:
+    """Path of the cached contents of url using the default cache"""
+    return default_cache().fetch(url, max_age)
+
+
+def cached(url: str, max_age: Optional[timedelta] = None) -> Optional[Path]:
+    """Path of the cached contents of url if it is current in the default cache or None"""
+    return default_cache().cached(url, max_age)
+
+
+def get(url: str, max_age: Optional[timedelta] = None) -> CachedFile:
+    """Cached file that can be used in place of the response of requests.get using the default cache"""
+    return default_cache().get(url, max_age)
@@ -0,0 +1,399 @@
+"""Download files on threads and parse them in a process pool.
+
+Parsing Excel workbooks is CPU-bound, so parsing them one after another (or on threads) uses a single core.
+FileExecutor downloads files (through the download cache) on a thread pool and parses them with the OPD Excel loader in a process pool. Each
+worker process reduces the table to what the caller needs (the date range or the set of agencies) so that only
+a few values are sent back to the main process rather than the table. Rows that share a file (e.g. sheets of a
+workbook or files in a zip file) are grouped so that the file is only downloaded and opened once.
+
+Rows whose dataset_id combines several files of a zip file (e.g. the quarterly files of RIPA counties written by
+update_table.update_ripa as {'files': [Q1, Q2, Q3, Q4]}) are parsed one file per process, and only the column that
+the reducer needs is read from each file (see read_columns). The reductions of the files are combined with
+COMBINERS, so the files are never loaded in full or concatenated.
+
+Datasets can also be read into a frame with only some columns (see FileExecutor.submit_read). The files of a
+combined dataset are read concurrently and their columns are concatenated in the order of the files.
+
+    with FileExecutor() as executor:
+        futures = executor.submit_rows(rows, "dates")
+        ...
+        reduced = futures[k].result()
+
+        table = executor.submit_read(url, ["date", "agency"], dataset_id, date_field="date").result()
+"""
+
+from __future__ import annotations
+
+import copy
+import os
+import shutil
+import tempfile
+import weakref
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+from zipfile import ZipFile
+
+import openpyxl
+import pandas as pd
+from openpyxl.utils.exceptions import InvalidFileException
+
+import openpolicedata as opd
+from openpolicedata.data_loaders.data_loader import filter_dataframe
+
+import download_cache
+from date_formats import parse_dates
+
+
+DEFAULT_IO_WORKERS = 8
+
+
+def download(url: str, directory: Path) -> Path:
+    """Link the file at url from the download cache to a new file in directory"""
+    suffix = ".zip" if ".zip" in url else Path(url.split("?")[0]).suffix
+    fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    os.close(fd)
+    return download_cache.default_cache().link(url, path)
+
+
+def reduce_dates(table: pd.DataFrame, date_field: str) -> dict:
+    """Smallest, 2nd smallest, and largest values of date_field"""
+    # Values that are not dates become NaT and are ignored. Values in more than one format are all kept.
+    col = table[date_field]
+    col = parse_dates(col) if pd.api.types.is_string_dtype(col.dtype) else col
+    min_val = col.min()
+    second_min = col.nsmallest(2).iloc[1] if isinstance(min_val, pd.Timestamp) and col.notnull().sum() > 1 else None
+    max_val = col.max()
+
+    return {"min": min_val, "second_min": second_min, "max": max_val}
+
+
+def reduce_agencies(table: pd.DataFrame, agency_field: str) -> list:
+    """Distinct values of agency_field"""
+    return list(table[agency_field].dropna().unique())
+
+
+REDUCERS = {
+    "dates": lambda table, date_field, agency_field: reduce_dates(table, date_field),
+    "agencies": lambda table, date_field, agency_field: reduce_agencies(table, agency_field),
+    # The table is already limited to the columns of the job
+    "columns": lambda table, date_field, agency_field: table,
+}
+
+
+def combine_dates(parts: list[dict]) -> dict:
+    """Reduction of the dates of several files from the reduce_dates result of each file"""
+    mins = [p["min"] for p in parts if pd.notnull(p["min"])]
+    maxes = [p["max"] for p in parts if pd.notnull(p["max"])]
+    if not all(isinstance(x, pd.Timestamp) for x in mins + maxes):
+        # Only compare dates if some files contain values that could not be converted to dates
+        mins = [x for x in mins if isinstance(x, pd.Timestamp)]
+        maxes = [x for x in maxes if isinstance(x, pd.Timestamp)]
+    # The 2 smallest dates of all files are among the 2 smallest dates of each file
+    smallest = sorted(mins + [p["second_min"] for p in parts if isinstance(p["second_min"], pd.Timestamp)])
+    return {
+        "min": smallest[0] if smallest else pd.NaT,
+        "second_min": smallest[1] if len(smallest) > 1 else None,
+        "max": max(maxes) if maxes else pd.NaT,
+    }
+
+
+def combine_agencies(parts: list[list]) -> list:
+    """Distinct agencies of several files from the reduce_agencies result of each file"""
+    return list(dict.fromkeys(x for p in parts for x in p))
+
+
+def combine_columns(parts: list[pd.DataFrame]) -> pd.DataFrame:
+    """Columns of several files concatenated in the order of the files"""
+    return pd.concat(parts, ignore_index=True)
+
+
+COMBINERS = {
+    "dates": combine_dates,
+    "agencies": combine_agencies,
+    "columns": combine_columns,
+}
+
+
+def read_columns(file, columns: list[str], sheets: Optional[list[str]] = None) -> Optional[pd.DataFrame]:
+    """Read only columns from sheets (default: the first sheet) of an .xlsx file (path or file object).
+
+    The workbook is read in openpyxl's read-only mode, which only creates the cells of the requested columns, so
+    this is faster and uses much less memory than loading every column with pandas. Returns None if the file is
+    not an .xlsx file or the column names are not in the first row of a sheet (or do not include all of columns).
+    The OPD loader is needed to find the header of such sheets.
+    """
+    try:
+        wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except (InvalidFileException, zipfile.BadZipFile):
+        return None
+    try:
+        frames = []
+        for sheet in (sheets or [None]):
+            if sheet is None:
+                ws = wb.worksheets[0]
+            elif isinstance(sheet, str) and sheet.strip() in wb.sheetnames:
+                ws = wb[sheet.strip()]
+            else:
+                # Wildcards and missing sheets are handled by the OPD loader
+                return None
+            header = next(ws.iter_rows(max_row=1, values_only=True), ())
+            names = [x.strip() if isinstance(x, str) else x for x in header]
+            while names and names[-1] is None:
+                names.pop()
+            if any(x is None for x in names) or not all(c in names for c in columns):
+                return None
+            idx = [names.index(c) for c in columns]
+            first = min(idx)
+            values = list(ws.iter_rows(min_row=2, min_col=first+1, max_col=max(idx)+1, values_only=True))
+            frames.append(pd.DataFrame({c: [row[i-first] for row in values] for c, i in zip(columns, idx)}, columns=columns))
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    finally:
+        wb.close()
+
+
+class Job(NamedTuple):
+    """Reduction of one row of the source table. dataset_id selects the sheet(s) and/or file(s) in a zip file.
+    columns are the columns read by the "columns" reducer.
+    """
+    reducer: str
+    dataset_id: object = None
+    date_field: Optional[str] = None
+    agency_field: Optional[str] = None
+    columns: Optional[tuple[str, ...]] = None
+
+
+def _columns(job: Job) -> list[str]:
+    """Columns that the reducer of job needs"""
+    if job.reducer == "columns":
+        return list(job.columns)
+    return [job.date_field if job.reducer == "dates" else job.agency_field]
+
+
+def _field(value) -> Optional[str]:
+    return value if isinstance(value, str) else None
+
+
+def _members(is_zip: bool, dataset_id) -> list[tuple[Optional[list], Optional[str]]]:
+    """Sheets and file in the zip file of each file of dataset_id. Raises ValueError for combined datasets that
+    are not files of a single zip file (e.g. files at several URLs or joined tables).
+    """
+    dataset_id = opd.dataset_id.parse_id(dataset_id)
+    expanded = opd.dataset_id.expand(dataset_id)
+    if not opd.dataset_id.is_combined_dataset(expanded):
+        return [opd.dataset_id.parse_excel_dataset(is_zip, dataset_id)]
+    if not is_zip or any(not isinstance(x, dict) or "url" in x or "on" in x for x in expanded):
+        raise ValueError(f"Combined dataset {dataset_id} is not supported. Only files of a single zip file can be combined.")
+    return [opd.dataset_id.parse_excel_dataset(True, x) for x in expanded]
+
+
+def _supported(url: str, dataset_id) -> bool:
+    try:
+        _members(".zip" in url, dataset_id)
+        return True
+    except ValueError:
+        return False
+
+
+def _reduce_workbook(path: str, jobs: list[tuple]) -> list[tuple[bool, object]]:
+    """Open the workbook at path once with the OPD Excel loader and load and reduce each job (sheets, date_field,
+    agency_field, reducer, columns, columns_only). Jobs with columns_only set read only the columns that their
+    reducer needs if possible (see read_columns). Runs in a worker process. Returns (True, result) or
+    (False, exception) for each job.
+    """
+    base = None
+    results = []
+    for sheets, date_field, agency_field, reducer, columns, columns_only in jobs:
+        try:
+            if columns_only:
+                table = read_columns(path, columns, sheets)
+                if table is not None:
+                    table = table.convert_dtypes()
+                    if date_field in columns:
+                        # Same date conversion as the OPD loader
+                        table = filter_dataframe(table, date_field=date_field)
+                    results.append((True, REDUCERS[reducer](table, date_field, agency_field)))
+                    continue
+            if base is None:
+                base = loader = opd.data_loaders.Excel(path, data_set={"sheets": sheets} if sheets else None,
+                                                       date_field=date_field, agency_field=agency_field)
+            else:
+                # Share the opened workbook
+                loader = copy.copy(base)
+                loader.sheet = sheets
+                loader.date_field = date_field
+                loader.agency_field = agency_field
+            table = loader.load(pbar=False)
+            if reducer == "columns":
+                table = table[columns]
+            results.append((True, REDUCERS[reducer](table, date_field, agency_field)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+def _extract(z: ZipFile, name: str, directory: Path) -> Path:
+    fd, path = tempfile.mkstemp(dir=directory, suffix=Path(name).suffix)
+    with os.fdopen(fd, "wb") as f, z.open(name) as member:
+        shutil.copyfileobj(member, f)
+    return Path(path)
+
+
+class FileExecutor:
+    """Download Excel files on threads and parse and reduce them in a process pool
+
+    Rows that share a URL can be submitted together (see submit_group and submit_rows) so that the file is
+    downloaded and opened once. Each workbook (or file in a zip file) is parsed in its own process and all of the
+    sheets that are needed from it are loaded from a single opened workbook.
+
+    Parameters
+    ----------
+    io_workers : int
+        Number of concurrent downloads
+    cpu_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    def __init__(self, io_workers: int = DEFAULT_IO_WORKERS, cpu_workers: Optional[int] = None) -> None:
+        self._directory = Path(tempfile.mkdtemp(prefix="opd_files_"))
+        self._threads = ThreadPoolExecutor(io_workers)
+        self._processes = ProcessPoolExecutor(cpu_workers)
+        # Remove downloads even if the executor is not shut down (e.g. after an exception)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self._directory, ignore_errors=True)
+
+    def __enter__(self) -> FileExecutor:
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb) -> None:
+        self.shutdown()
+
+    def shutdown(self) -> None:
+        self._threads.shutdown(wait=True, cancel_futures=True)
+        self._processes.shutdown(wait=True, cancel_futures=True)
+        self._cleanup()
+
+    def _workbooks(self, path: Path, url: str, parts: list[tuple[int, Optional[list], Optional[str]]],
+                   failed: dict[int, Exception]) -> dict[Path, list[int]]:
+        """Paths of the workbooks needed by parts (job index, sheets, file in zip file) and the indices of the
+        parts that use each. Files in a zip file are extracted. Jobs with a part whose file cannot be found are
+        added to failed.
+        """
+        if ".zip" not in url:
+            return {path: list(range(len(parts)))}
+
+        workbooks = {}
+        members = {}
+        with ZipFile(path) as z:
+            names = z.namelist()
+            for n, (i, _, file_in_zip) in enumerate(parts):
+                if i in failed:
+                    continue
+                if not file_in_zip:
+                    if len(names) > 1:
+                        failed[i] = ValueError(f"More than one file found in zip file at {url}. "
+                                               "One file must be specified if there is more than one file.")
+                        continue
+                    file_in_zip = names[0]
+                elif file_in_zip not in names:
+                    failed[i] = ValueError(f"Unable to find file {file_in_zip} in {url}")
+                    continue
+                if file_in_zip not in members:
+                    members[file_in_zip] = _extract(z, file_in_zip, self._directory)
+                workbooks.setdefault(members[file_in_zip], []).append(n)
+        return workbooks
+
+    def _run(self, url: str, jobs: list[Job], futures: list[Future]) -> None:
+        try:
+            path = download(url, self._directory)
+        except BaseException as e:
+            for f in futures:
+                f.set_exception(e)
+            return
+
+        workbooks = {}
+        try:
+            # Each job has a part for each of its files
+            members = [_members(".zip" in url, job.dataset_id) for job in jobs]
+            parts = [(i, sheets, file) for i, m in enumerate(members) for sheets, file in m]
+            failed = {}
+            workbooks = self._workbooks(path, url, parts, failed)
+            # Parts of jobs that have already failed are not parsed
+            needed = {wb: [n for n in idx if parts[n][0] not in failed] for wb, idx in workbooks.items()}
+            needed = {wb: idx for wb, idx in needed.items() if idx}
+            # Files of combined datasets are parsed concurrently in separate processes
+            parsed = {}
+            for wb, idx in needed.items():
+                args = []
+                for n in idx:
+                    job = jobs[parts[n][0]]
+                    columns_only = job.reducer == "columns" or len(members[parts[n][0]]) > 1
+                    args.append((parts[n][1], job.date_field, job.agency_field, job.reducer, _columns(job), columns_only))
+                parsed[wb] = self._processes.submit(_reduce_workbook, str(wb), args)
+            # The download thread waits for the parse so that downloads do not get too far ahead of parsing
+            reduced = [[] for _ in jobs]
+            for wb, future in parsed.items():
+                try:
+                    results = future.result()
+                except BaseException as e:
+                    results = [(False, e)] * len(needed[wb])
+                for n, (ok, value) in zip(needed[wb], results):
+                    if ok:
+                        reduced[parts[n][0]].append(value)
+                    else:
+                        failed.setdefault(parts[n][0], value)
+            for i, (job, f) in enumerate(zip(jobs, futures)):
+                if i in failed:
+                    f.set_exception(failed[i])
+                elif len(reduced[i]) == 1:
+                    f.set_result(reduced[i][0])
+                else:
+                    f.set_result(COMBINERS[job.reducer](reduced[i]))
+        except BaseException as e:
+            for f in futures:
+                if not f.done():
+                    f.set_exception(e)
+        finally:
+            for p in set(workbooks) | {path}:
+                os.remove(p)
+
+    def submit_group(self, url: str, jobs: list[Job]) -> list[Future]:
+        """Download the Excel or zip file at url once and reduce it for each job. The result of each returned
+        future is the result of REDUCERS[job.reducer] (combined with COMBINERS[job.reducer] for combined datasets).
+        """
+        for job in jobs:
+            if job.reducer not in REDUCERS:
+                raise ValueError(f"Unknown reducer {job.reducer}. Must be one of {list(REDUCERS)}")
+            if job.reducer == "columns" and not job.columns:
+                raise ValueError("The columns to read must be given for the columns reducer")
+        futures = [Future() for _ in jobs]
+        for f in futures:
+            f.set_running_or_notify_cancel()
+        self._threads.submit(self._run, url, list(jobs), futures)
+        return futures
+
+    def submit(self, url: str, reducer: str, dataset_id=None, date_field: Optional[str] = None,
+               agency_field: Optional[str] = None) -> Future:
+        """Download and parse the Excel file at url. The result of the returned future is the result of REDUCERS[reducer]."""
+        return self.submit_group(url, [Job(reducer, dataset_id, date_field, agency_field)])[0]
+
+    def submit_read(self, url: str, columns: list[str], dataset_id=None, date_field: Optional[str] = None) -> Future:
+        """Download the Excel or zip file at url and read only columns of dataset_id. The result of the returned
+        future is a DataFrame. The files of a combined dataset (e.g. {'files': [Q1, Q2, Q3, Q4]}) are read
+        concurrently in separate processes and concatenated in the order that they are listed. date_field (if it is
+        one of columns) is converted to dates as in the OPD loader.
+        """
+        return self.submit_group(url, [Job("columns", dataset_id, date_field, None, tuple(columns))])[0]
+
+    def submit_rows(self, rows: pd.DataFrame, reducer: str) -> dict:
+        """Reduce Excel rows of the source table, downloading and opening each URL once.
+        Returns futures keyed by the index of rows. Rows with combined datasets that are not supported (see
+        _members) are not submitted.
+        """
+        futures = {}
+        rows = rows[[_supported(url, x) for url, x in zip(rows["URL"], rows["dataset_id"])]]
+        for url, group in rows.groupby("URL", sort=False):
+            jobs = [Job(reducer, row["dataset_id"], _field(row.get("date_field")), _field(row.get("agency_field")))
+                    for _, row in group.iterrows()]
+            futures.update(zip(group.index, self.submit_group(url, jobs)))
+        return futures
@@ -2,12 +2,110 @@ from argparse import ArgumentParser
 import pandas as pd
 import os
 
+from generate_source_table_ids import KEY_COLUMNS, SOURCE_TABLE_ID, build_source_table_id
+from table_diff import read_table, table_ids
+
+# Inserted rows are placed after the last row of the same dataset series in the base table
+GROUP_COLUMNS = ['State', 'SourceName', 'Agency', 'TableType']
+
+
+def keyed(df, name):
+    '''Index df by source_table_id. Rows without an ID (e.g. newly added rows) are given one from their key columns'''
+    df = df.copy()
+    ids = table_ids(df)
+    dups = ids[ids.duplicated()]
+    if len(dups)>0:
+        raise ValueError(f'{name} contains duplicate {SOURCE_TABLE_ID} value(s): {", ".join(dups.unique()[:20])}')
+    df.index = pd.Index(ids, name=SOURCE_TABLE_ID)
+    return df
+
+
+def changed_cells(a, b, columns=None):
+    '''Boolean DataFrame of cells that differ between a and b for the rows they share. Columns missing from one table are empty.'''
+    columns = columns if columns is not None else a.columns.union(b.columns, sort=False)
+    ids = a.index.intersection(b.index, sort=False)
+    a = a.reindex(index=ids, columns=columns, fill_value='')
+    b = b.reindex(index=ids, columns=columns, fill_value='')
+    return a.ne(b)
+
+
+def three_way_merge(base, new, update_cols, ancestor=None):
+    '''Merge update_cols of new into base keyed by source_table_id.
+
+    If ancestor (the table that new was created from) is provided, only cells that new changed relative to
+    ancestor are applied, cells that both base and new changed to different values are conflicts (base is kept),
+    and rows that new deleted are deleted if base did not change them. Without ancestor, every cell of update_cols
+    that differs is taken from new and rows missing from new are reported but kept.
+    Rows added in new are inserted with all of their columns.
+
+    Returns the merged table and a dict with the inserted, deleted, changed (cells per column), and conflict (cells per column) IDs
+    '''
+    base = keyed(base, 'Base table')
+    new = keyed(new, 'New table')
+
+    update_cols = [c for c in update_cols if c in new and c!=SOURCE_TABLE_ID]
+    # New columns are only added if they are updated
+    cols = base.columns.append(pd.Index([c for c in update_cols if c not in base]))
+
+    inserted = new.index.difference(base.index, sort=False)
+    missing = base.index.difference(new.index, sort=False)
+    if ancestor is not None:
+        ancestor = keyed(ancestor, 'Ancestor table')
+        # Rows that are not in base but were in ancestor were deleted from base
+        inserted = inserted.difference(ancestor.index, sort=False)
+        deleted = missing.intersection(ancestor.index, sort=False)
+        base_changed = changed_cells(base.loc[deleted], ancestor, cols).any(axis=1)
+        deleted = deleted[~base_changed.reindex(deleted, fill_value=False).values]
+    else:
+        deleted = pd.Index([], name=SOURCE_TABLE_ID)
+
+    common = base.index.intersection(new.index, sort=False)
+    diff = changed_cells(base.loc[common], new.loc[common], update_cols)
+    conflict = pd.DataFrame(False, index=diff.index, columns=diff.columns)
+    if ancestor is not None:
+        # Only apply cells changed by new. Rows not in ancestor were added to both so new wins.
+        new_changed = changed_cells(ancestor, new.loc[common], update_cols).reindex(index=common, fill_value=True)
+        base_changed = changed_cells(ancestor, base.loc[common], update_cols).reindex(index=common, fill_value=False)
+        conflict = diff & new_changed & base_changed
+        diff = diff & new_changed & ~base_changed
+
+    merged = base.reindex(columns=cols, fill_value='')
+    merged.loc[common, update_cols] = merged.loc[common, update_cols].mask(diff, new.loc[common, update_cols].reindex(columns=update_cols, fill_value=''))
+    merged = merged.drop(index=deleted)
+
+    if len(inserted)>0:
+        added = new.loc[inserted].reindex(columns=cols, fill_value='')
+        # Position rows after the last base row of their group so that base rows are not reordered
+        position = pd.Series(range(len(merged)), index=merged.index, dtype=float)
+        last = merged[GROUP_COLUMNS].assign(position=position.values).groupby(GROUP_COLUMNS)['position'].max()
+        added_position = pd.MultiIndex.from_frame(added[GROUP_COLUMNS]).map(last.to_dict().get)
+        added_position = pd.Series(added_position, index=added.index, dtype=float).fillna(len(merged))
+        added_position += 0.5 + pd.Series(range(len(added)), index=added.index) / (2*len(added))
+        merged = pd.concat([merged, added])
+        merged = merged.iloc[pd.concat([position, added_position]).argsort(kind='stable')]
+
+    # IDs depend on key columns, which may have been updated
+    if SOURCE_TABLE_ID in merged:
+        merged[SOURCE_TABLE_ID] = [build_source_table_id(r) for r in merged[list(KEY_COLUMNS)].to_dict('records')]
+
+    report = {
+        'inserted': list(inserted),
+        'deleted': list(deleted),
+        'missing': list(missing.difference(deleted, sort=False)),
+        'changed': {c:list(diff.index[diff[c]]) for c in diff.columns if diff[c].any()},
+        'conflicts': {c:list(conflict.index[conflict[c]]) for c in conflict.columns if conflict[c].any()},
+    }
+    return merged.reset_index(drop=True), report
+
+
 def merge():
     p = ArgumentParser()
     p.add_argument('update', help='Comma separated list of columns to update in opd_source_table.csv from tmp.csv')
     p.add_argument('-d', '--diff', default=None, help='Comma separated list of columns that differ between opd_source_table.csv from tmp.csv. '+
                    'Defaults to update. This can be used if there are columns that differ but should not be updated.')
     p.add_argument('-m','--merge', action='store_true', help='Whether to merge and save. If not set, only diffs will be evalauted')
+    p.add_argument('-a', '--ancestor', default=None, help='File or git revision of opd_source_table.csv that tmp.csv was created from. '+
+                   'If set, a three-way merge is performed so that changes made to opd_source_table.csv since then are not overwritten.')
     args = p.parse_args()
 
     update_cols = [x.strip() for x in args.update.split(',')]
@@ -22,29 +120,36 @@ def merge():
         base_csv = os.path.join('..', base_csv)
         new_csv = os.path.join('..', new_csv)
 
-    base = pd.read_csv(base_csv)
-    new = pd.read_csv(new_csv)
-    
-    assert len(base)==len(new), 'Merge cannot currently be performed if number of rows has changed'
+    base = read_table(base_csv)
+    new = read_table(new_csv)
+    ancestor = read_table(args.ancestor) if args.ancestor else None
 
     for c in new.columns:
-        assert c in base, 'Need to add handling of adding new columns'
-        try:
-            pd.testing.assert_series_equal(base[c], new[c])
-            if c in changed_cols:
-                print(f'WARNING: Column {c} was expected to differ but does not')
-        except:
+        if c not in base and c not in update_cols:
+            print(f'WARNING: Column {c} is not in {base_csv} and will not be added unless it is in update')
+
+    all_cols = [c for c in new.columns if c!=SOURCE_TABLE_ID]
+    merged, report = three_way_merge(base, new, all_cols, ancestor)
+    for c in all_cols:
+        if c in report['changed'] or c in report['conflicts']:
             if c not in changed_cols:
                 print(f'WARNING: Column {c} was NOT expected to differ but does')
             else:
-                print(f'Column {c} differs as expected')
+                print(f'Column {c} differs as expected in {len(report["changed"].get(c,[]))} rows')
+        elif c in changed_cols:
+            print(f'WARNING: Column {c} was expected to differ but does not')
 
-    if args.merge:
-        for c in update_cols:
-            base[c] = new[c]
+    print(f'{len(report["inserted"])} rows inserted, {len(report["deleted"])} rows deleted, '+
+          f'{len(set(x for v in report["changed"].values() for x in v))} rows changed')
+    if report['missing']:
+        print(f'WARNING: {len(report["missing"])} rows of {base_csv} are not in {new_csv} and will be kept: {report["missing"][:10]}')
+    for c, ids in report['conflicts'].items():
+        print(f'WARNING: Column {c} was changed in both tables for {len(ids)} rows. {base_csv} values are kept: {ids[:10]}')
 
-        base.to_csv(base_csv, index=False)
+    if args.merge:
+        merged, _ = three_way_merge(base, new, update_cols, ancestor)
+        merged.to_csv(base_csv, index=False, lineterminator='\n')
 
 
 if __name__=='__main__':
-    merge()
\ No newline at end of file
+    merge()
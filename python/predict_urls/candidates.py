@@ -0,0 +1,146 @@
+"""Generate candidate URLs for new years of datasets in the OPD source table.
+
+Candidates are generated for the whole table at once with vectorized pandas operations so that the
+candidate set can be inspected (or dry-run) without making any requests before it is probed.
+"""
+
+from __future__ import annotations
+
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parent.parent))
+from generate_source_table_ids import KEY_COLUMNS, SOURCE_TABLE_ID, build_source_table_id
+from url_templates import Template, expand, learn_templates, tokenize
+
+
+COMPOSITE_KEY = ['State', 'SourceName', 'Agency', 'TableType']
+YEAR_PATTERN = r"(20\d{2})"
+
+
+def latest_per_series(df: pd.DataFrame, key: list = COMPOSITE_KEY) -> pd.DataFrame:
+    """Most recent row (by coverage_end) of each dataset series"""
+    coverage_end = pd.to_datetime(df["coverage_end"], errors="coerce")
+    order = coverage_end.sort_values(na_position="first", kind="stable").index
+    return df.loc[order].drop_duplicates(subset=key, keep="last").sort_index()
+
+
+def source_table_ids(df: pd.DataFrame) -> pd.Series:
+    keys = df[list(KEY_COLUMNS)].astype(object).where(df[list(KEY_COLUMNS)].notnull(), "").astype(str)
+    return pd.Series([build_source_table_id(row) for row in keys.to_dict("records")], index=df.index, dtype=object)
+
+
+def build_candidates(
+    df: pd.DataFrame,
+    outdated_days: Optional[int] = None,
+    source_name: Optional[str] = None,
+    now: Optional[datetime] = None,
+    use_templates: bool = True,
+    max_per_year: int = 3,
+    max_months: int = 3
+) -> pd.DataFrame:
+    """Build new rows for the source table for all years after the latest year of each dataset series.
+
+    Args:
+        df (DataFrame): OPD source table as read from the CSV file
+        outdated_days (int): How many days before a source is considered outdated. If None, all sources are used.
+        source_name (str): Name of source to generate candidates for (all will be used by default)
+        now (datetime): Current time. Defaults to now.
+        use_templates (bool): If True, URLs are predicted from templates learned from each series (see url_templates).
+            Otherwise, the minimum year in the URL is replaced.
+        max_per_year (int): Maximum number of candidates for each dataset and year (and quarter)
+        max_months (int): Maximum number of months to try for URLs containing a YYYY-MM folder
+
+    Returns:
+        DataFrame with the columns of df for each candidate row, where URL and Year are for the candidate year and
+        base_url and base_year are the URL and year of the row it was generated from. score is the likelihood
+        of the candidate URL, template is the learned template (if used), and quarter is the quarter for
+        quarterly files. Candidates are sorted from most to least likely. Candidates whose URL is already in df
+        are not included.
+    """
+    now = pd.Timestamp(now or datetime.now())
+    current_year = now.year
+
+    year = pd.to_numeric(df["Year"], errors="coerce")
+    rows = df[df["supplying_entity"].isnull() & year.notnull() & df["URL"].notnull()]
+    if source_name:
+        rows = rows[rows["SourceName"] == source_name]
+
+    # Only use the most recent dataset of each series
+    rows = latest_per_series(rows)
+    rows = rows[pd.to_numeric(rows["Year"], errors="coerce") != current_year]
+
+    if outdated_days is not None:
+        last_check = pd.to_datetime(rows["last_coverage_check"], errors="coerce")
+        rows = rows[last_check <= now - pd.Timedelta(days=outdated_days)]
+
+    rows = rows.copy()
+    rows["base_url"] = rows["URL"]
+    rows["template"] = [tokenize(u, int(y))[0] for u, y in zip(rows["URL"], rows["Year"])]
+    use_template = rows["template"].str.contains("{y", regex=False) & use_templates
+    # If the URL cannot be converted to a template, assume minimum year in URL is the year of the dataset
+    rows["base_year"] = rows["URL"].str.extractall(YEAR_PATTERN)[0].astype(int).groupby(level=0).min()
+    rows.loc[use_template, "base_year"] = pd.to_numeric(rows.loc[use_template, "Year"])
+    rows["use_template"] = use_template
+    rows = rows[rows["base_year"].notnull() & (rows["base_year"] < current_year)]
+    rows["base_year"] = rows["base_year"].astype(int)
+
+    # One candidate per year from the year after the base year through the current year
+    counts = current_year - rows["base_year"]
+    cand = rows.loc[rows.index.repeat(counts)].copy()
+    cand["year"] = cand["base_year"] + cand.groupby(level=0).cumcount() + 1
+    cand = cand.reset_index(drop=True)
+
+    # Replace the base year with the candidate year. Loop is over the distinct (base year, year) pairs, not rows.
+    simple = cand[~cand["use_template"]].copy()
+    new_urls = simple["base_url"].copy()
+    for (base, y), idx in simple.groupby(["base_year", "year"]).groups.items():
+        new_urls[idx] = simple.loc[idx, "base_url"].str.replace(str(base), str(y), regex=False)
+    simple["URL"] = new_urls
+    simple["score"] = 1.0
+    simple["quarter"] = float("nan")
+
+    # Fill the templates learned from the series for each candidate year. Loop is over series, years, and the
+    # templates of their rows, not rows. Templates are learned per agency so that one agency's URLs are not
+    # predicted for another agency's dataset.
+    templated = cand[cand["use_template"]]
+    learned = learn_templates(df, COMPOSITE_KEY) if len(templated) else {}
+    expanded = []
+    for key, g in templated.groupby(COMPOSITE_KEY + ["year", "template"], sort=False):
+        series, y, template = key[:-2], key[-2], key[-1]
+        series_templates = learned.get(series, [])
+        if template not in [t.template for t in series_templates]:
+            series_templates = [Template(template, 1.0)] + series_templates
+        e = expand(series_templates, y, max_months, now).drop(columns="template")
+        if len(e) == 0:
+            continue
+        # Candidates are merged back to the row they were generated from
+        expanded.extend(e.assign(_row=k) for k in g.index)
+    if expanded:
+        templated = templated.drop(columns="URL").merge(pd.concat(expanded, ignore_index=True), left_index=True,
+                                                        right_on="_row").drop(columns="_row")
+    else:
+        templated = templated.assign(score=pd.Series(dtype=float), quarter=pd.Series(dtype=float))
+
+    cand = pd.concat([simple, templated], ignore_index=True)
+
+    # Anti-join against URLs already in the table
+    cand = cand[(cand["URL"] != cand["base_url"]) & ~cand["URL"].isin(pd.Index(df["URL"].dropna().unique()))]
+
+    # Rank by likelihood and only keep the most likely candidates for each dataset
+    cand = cand.sort_values("score", ascending=False, kind="stable").drop_duplicates("URL")
+    cand = cand.groupby(["base_url", "year", "quarter"], dropna=False, sort=False).head(max_per_year)
+
+    cand["Year"] = cand["year"].astype(str)
+    cand["last_coverage_check"] = now.strftime("%m/%d/%Y")
+    cand["coverage_start"] = "01/01/" + cand["Year"]
+    cand["coverage_end"] = "12/31/" + cand["Year"]
+    cand["source_url"] = ""
+    if SOURCE_TABLE_ID in cand:
+        cand[SOURCE_TABLE_ID] = source_table_ids(cand)
+
+    return cand.drop(columns=["year", "use_template"]).reset_index(drop=True)
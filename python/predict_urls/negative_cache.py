@@ -0,0 +1,131 @@
+"""Persistent cache of candidate URLs that had no data so that they are not requested again on every run.
+
+Most candidate URLs for new years do not exist yet, and each nightly run of auto_update_sources would request
+them all again. A failed candidate is not requested again until its backoff has passed: BACKOFF_DAYS[0] days
+after its first failure, BACKOFF_DAYS[1] days after its second, and so on, with the last backoff used for all
+later failures. Datasets in datasets_deleted_by_publisher.csv are tombstones that are never requested.
+
+Host-level failures (see circuit_breaker.is_host_failure) are not cached. They say nothing about whether the URL
+exists and are handled by the HostCircuitBreaker.
+
+    cache = NegativeCache(deleted_table=DELETED_TABLE)
+    if cache.allow(url):
+        ...
+        cache.record_failure(url, exc)
+    cache.save()
+"""
+
+from __future__ import annotations
+
+import sys
+import urllib.error
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+import requests
+
+from openpolicedata.exceptions import OPD_DataUnavailableError
+
+sys.path.append(str(Path(__file__).parent.parent))
+import state
+from circuit_breaker import is_host_failure
+from scheduler import dataset_key
+
+
+STATE_FILE = "url_negative_cache.json"
+BACKOFF_DAYS = [1, 3, 7]
+
+# Failure classes
+NOT_FOUND = "not_found"
+NO_DATA = "no_data"
+ERROR = "error"
+HOST = "host"
+
+
+def classify_failure(exc: Optional[BaseException]) -> str:
+    """Failure class of an exception raised while checking a URL. None means the URL had no data."""
+    if exc is None:
+        return NO_DATA
+    if is_host_failure(exc):
+        return HOST
+    if isinstance(exc, (OPD_DataUnavailableError, requests.exceptions.HTTPError, urllib.error.HTTPError)):
+        return NOT_FOUND
+    return ERROR
+
+
+def load_tombstones(deleted_table: Path) -> set[str]:
+    """Keys of the datasets in datasets_deleted_by_publisher.csv"""
+    deleted_table = Path(deleted_table)
+    if not deleted_table.exists():
+        return set()
+    deleted = pd.read_csv(deleted_table, dtype=str)
+    deleted = deleted[deleted["URL"].notnull()]
+    dataset_ids = deleted["dataset_id"] if "dataset_id" in deleted else [None] * len(deleted)
+    return {dataset_key(url, x) for url, x in zip(deleted["URL"], dataset_ids)}
+
+
+class NegativeCache:
+    """Failed candidate URLs with backoff before they are retried
+
+    Parameters
+    ----------
+    state_file : str
+        Name of the file in the state directory that the cache is stored in
+    deleted_table : Path
+        datasets_deleted_by_publisher.csv. Its datasets are never requested. If None, there are no tombstones.
+    clock : callable
+        Returns the current datetime. Defaults to datetime.now
+    """
+
+    def __init__(self, state_file: str = STATE_FILE, deleted_table: Optional[Path] = None,
+                 clock: Callable[[], datetime] = datetime.now) -> None:
+        self.state_file = state_file
+        self._clock = clock
+        # key -> {"failure": failure class, "failures": number of consecutive failures, "checked": time of last failure}
+        self._entries: dict[str, dict] = state.load_json(state_file)
+        self._tombstones = load_tombstones(deleted_table) if deleted_table is not None else set()
+        self.skipped: dict[str, str] = {}
+
+    def save(self) -> None:
+        state.save_json(self.state_file, self._entries)
+
+    def retry_at(self, url: str, dataset_id=None) -> Optional[datetime]:
+        """Time after which a failed URL can be requested again. None if it has not failed."""
+        entry = self._entries.get(dataset_key(url, dataset_id))
+        if entry is None:
+            return None
+        days = BACKOFF_DAYS[min(entry["failures"], len(BACKOFF_DAYS)) - 1]
+        return datetime.fromisoformat(entry["checked"]) + timedelta(days=days)
+
+    def reason(self, url: str, dataset_id=None) -> Optional[str]:
+        """Why a URL should not be requested or None if it should be"""
+        key = dataset_key(url, dataset_id)
+        if key in self._tombstones:
+            return "deleted by publisher"
+        retry_at = self.retry_at(url, dataset_id)
+        if retry_at is not None and self._clock() < retry_at:
+            entry = self._entries[key]
+            return f"{entry['failure']} {entry['failures']} time(s). Retrying after {retry_at:%Y-%m-%d %H:%M}"
+        return None
+
+    def allow(self, url: str, dataset_id=None) -> bool:
+        """Whether a URL should be requested"""
+        reason = self.reason(url, dataset_id)
+        if reason is not None:
+            self.skipped[dataset_key(url, dataset_id)] = reason
+        return reason is None
+
+    def record_failure(self, url: str, exc: Optional[BaseException] = None, dataset_id=None) -> None:
+        """Record that a URL had no data (exc is None) or could not be read. Host failures are ignored."""
+        failure = classify_failure(exc)
+        if failure == HOST:
+            return
+        key = dataset_key(url, dataset_id)
+        failures = self._entries.get(key, {}).get("failures", 0)
+        self._entries[key] = {"failure": failure, "failures": failures + 1,
+                              "checked": self._clock().isoformat(timespec="seconds")}
+
+    def record_success(self, url: str, dataset_id=None) -> None:
+        self._entries.pop(dataset_key(url, dataset_id), None)
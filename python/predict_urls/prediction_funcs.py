@@ -3,59 +3,72 @@ import pandas as pd
 from datetime import datetime
 from pathlib import Path
 import requests
+import sys
 import urllib
 
 from openpolicedata.exceptions import OPD_DataUnavailableError
 from openpolicedata.data_loaders import Arcgis, Carto, Ckan, Csv, Excel, Html, Socrata
 
+sys.path.append(str(Path(__file__).parent.parent))
+from circuit_breaker import HostCircuitBreaker, host_of
+from candidates import build_candidates
+from negative_cache import NegativeCache
+from url_templates import SERIES_KEY, candidates_for_url, learn_templates
+import validate_table
+from validate_table import REQUIRED_FIELDS
+
 OPD_SOURCE_TABLE = Path(__file__).parent.parent.parent / "opd_source_table.csv"
 DELETED_TABLE = Path(__file__).parent.parent.parent / "datasets_deleted_by_publisher.csv"
 
 # TODO: Check what happens with  Winooski, and Norman data
 
-# Map DataType to loader class and required spreadsheet_fields
+# Map DataType to loader class and required spreadsheet_fields (rules are shared with validate_table)
 LOADER_MAP = {  
     "arcgis": {
         "loader": Arcgis,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType"],  # date_field required if Year is MULTI, but unlikely if URL contains year 
+        "required_fields": REQUIRED_FIELDS["arcgis"],
         "constructor": lambda url, sf: (url, sf.get("date_field"), sf.get("query"))
     },
     "carto": {
         "loader": Carto,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType", "dataset_id"],  # dataset_id required
+        "required_fields": REQUIRED_FIELDS["carto"],
         "constructor": lambda url, sf: (url, sf["dataset_id"], sf.get("date_field"), sf.get("query"))
     },
     "ckan": {
         "loader": Ckan,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType", "dataset_id"],  # dataset_id required
+        "required_fields": REQUIRED_FIELDS["ckan"],
         "constructor": lambda url, sf: (url, sf["dataset_id"], sf.get("date_field"), sf.get("query"))
     },
     "csv": {
         "loader": Csv,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType"],
+        "required_fields": REQUIRED_FIELDS["csv"],
         "constructor": lambda url, sf: (url, sf.get("date_field"), sf.get("agency_field"), sf.get("dataset_id"), sf.get("query"))
     },
     "excel": {
         "loader": Excel,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType"],
+        "required_fields": REQUIRED_FIELDS["excel"],
         "constructor": lambda url, sf: (url, sf.get("dataset_id"), sf.get("date_field"), sf.get("agency_field"))
     },
     "html": {
         "loader": Html,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType"],
+        "required_fields": REQUIRED_FIELDS["html"],
         "constructor": lambda url, sf: (url, sf.get("date_field"), sf.get("agency_field"))
     },
     "socrata": {
         "loader": Socrata,
-        "required_fields": ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType", "dataset_id"],  # dataset_id required
+        "required_fields": REQUIRED_FIELDS["socrata"],
         "constructor": lambda url, sf: (url, sf["dataset_id"], sf.get("date_field"))
     }
 }
 
-def is_data_available(data_type, url, spreadsheet_fields, verbose=True):
+def is_data_available(data_type, url, spreadsheet_fields, verbose=True, breaker=None, negative_cache=None):
     """
     Returns True if the endpoint is available and has at least one record.
     Returns False if not available, not accessible, or has no data.
+    If a HostCircuitBreaker is provided, URLs on hosts with an open breaker are not requested and
+    connection failures are recorded.
+    If a NegativeCache is provided, URLs that recently failed or were deleted by their publisher are not
+    requested and failures are recorded.
     """
 
     if re.search(r'/DocumentCenter/View/\d+/', url):
@@ -70,44 +83,60 @@ def is_data_available(data_type, url, spreadsheet_fields, verbose=True):
         if field not in spreadsheet_fields or (spreadsheet_fields[field] in [None, ""] and field != "date_field"):
             raise ValueError(f"Missing required field '{field}' for DataType '{data_type}'")
         
+    # Check the negative cache first so that a trial request of a half-open breaker is only taken for a URL that is requested
+    dataset_id = spreadsheet_fields.get("dataset_id")
+    if negative_cache is not None and not negative_cache.allow(url, dataset_id):
+        if verbose:
+            print(f"Skipping {url}: {negative_cache.reason(url, dataset_id)}")
+        return False
+
+    if breaker is not None and not breaker.allow(url):
+        if verbose:
+            print(f"Skipping {url}: circuit breaker is open for host {host_of(url)}")
+        return False
+
     args = loader_info["constructor"](url, spreadsheet_fields)
     try:
         loader = loader_info["loader"](*args)
     except Exception as e:
+        if breaker is not None:
+            breaker.record_failure(url, e)
+        if negative_cache is not None:
+            negative_cache.record_failure(url, e, dataset_id)
         if not any(isinstance(e, x) for x in [OPD_DataUnavailableError, requests.exceptions.HTTPError, urllib.error.URLError]):
             print(f"Failed for data type {data_type} and URL {url}")
         return False
     try:
         count = loader.get_count(force=True)
+        if breaker is not None:
+            breaker.record_success(url)
         # print(f"Data available for {url}: {count} records found.")
-        return count > 1 # Error message appears as count = 1 for CSV while testing. Didn't check other data_types
+        available = count > 1 # Error message appears as count = 1 for CSV while testing. Didn't check other data_types
+        if negative_cache is not None:
+            if available:
+                negative_cache.record_success(url, dataset_id)
+            else:
+                negative_cache.record_failure(url, None, dataset_id)
+        return available
     
     except Exception as e:
+        if breaker is not None:
+            breaker.record_failure(url, e)
+        if negative_cache is not None:
+            negative_cache.record_failure(url, e, dataset_id)
         if verbose:
             print(f"Exception in is_data_available for {url}: {e}")
         return False
 
-def find_valid_url_for_year(url, year, year_str, data_type, spreadsheet_fields, verbose=True):
-    """
-    Returns (is_valid, new_url, coverage_start, coverage_end)
-    """
-    new_url = url.replace(year_str, str(year))
-    if new_url==url:
-        valid = False
-    else:
-        try:
-            valid = is_data_available(data_type, new_url, spreadsheet_fields, verbose)
-        except Exception as e:
-            valid = False
-    return valid, new_url
-
 def try_url_years(
     url: str,
     spreadsheet_fields: dict,
     n_years = 5,
     forward: bool = None,
     year_slice: tuple = None,
-    verbose: bool = False
+    verbose: bool = False,
+    breaker: HostCircuitBreaker = None,
+    negative_cache: NegativeCache = None
 ):
     """
     Try to find valid URLs by replacing a 4-digit year in the URL.
@@ -117,7 +146,13 @@ def try_url_years(
     n_years: int or range. If int, tries n_years forward (or backward if forward=False). If range, uses as years to try.
     forward: If n_years is int, direction to try. If None, defaults to True.
     year_slice: tuple of (start, end) to slice the URL for the year. If None, finds the first 4-digit year in the URL.
+        If the URL contains more than one 4-digit number (e.g. a YYYY-MM upload folder and a year), "Year" must be
+        in spreadsheet_fields and candidate URLs are predicted from the URL's template (see url_templates), ranked using
+        templates learned from other years of the same State, SourceName, and TableType.
     verbose: If True, prints progress messages.
+    breaker: HostCircuitBreaker for skipping hosts that are down. If None, one is created from outages.csv.
+    negative_cache: NegativeCache for skipping URLs that recently failed or were deleted by their publisher.
+        If None, the cache in the state directory is used and saved.
     
     Attempts to find valid URLs by incrementing or decrementing the year in the URL and checking if the resulting URL is valid.
     Updates OPD_SOURCE_TABLE and DELETED_TABLE as appropriate.
@@ -127,6 +162,7 @@ def try_url_years(
     data_type = spreadsheet_fields["DataType"].lower()
 
     # 1. Find 4-digit year in URL
+    use_template = False
     if year_slice:
         year_str = url[year_slice[0]:year_slice[1]]
         if not re.fullmatch(r"\d{4}", year_str):
@@ -134,8 +170,14 @@ def try_url_years(
     else:
         matches = re.findall(r"\d{4}", url)
         if len(matches) != 1:
-            raise ValueError(f"Expected exactly one 4-digit year in URL, found {len(matches)}: {matches}")
-        year_str = matches[0]
+            if len(matches) == 0 or not str(spreadsheet_fields.get("Year", "")).isdigit():
+                raise ValueError(f"Expected exactly one 4-digit year in URL, found {len(matches)}: {matches}. " +
+                                 "If the URL contains multiple 4-digit numbers, Year must be in spreadsheet_fields.")
+            use_template = True
+            year_str = str(spreadsheet_fields["Year"])
+        else:
+            year_str = matches[0]
+        year_slice = (url.index(year_str), url.index(year_str) + 4) if not use_template else None
 
     year = int(year_str)
 
@@ -153,56 +195,41 @@ def try_url_years(
     else:
         raise ValueError("n_years must be an int or a range.")
     
+    if breaker is None:
+        breaker = HostCircuitBreaker.from_outages()
+    save_cache = negative_cache is None
+    if save_cache:
+        negative_cache = NegativeCache(deleted_table=DELETED_TABLE)
+
     df = pd.read_csv(OPD_SOURCE_TABLE)
-    # deleted_df = pd.read_csv(DELETED_TABLE)
     current_year = datetime.now().year    
-    
-    for y in years_to_try:
-        new_url = url.replace(year_str, str(y), 1)
+
+    if use_template:
+        # Most likely URLs first
+        history = learn_templates(df).get(tuple(spreadsheet_fields.get(k) for k in SERIES_KEY), [])
+        cand = candidates_for_url(url, year, years_to_try, history)
+        candidate_urls = [(y, u) for y in years_to_try for u in cand.loc[cand["year"]==y, "URL"]]
+    else:
+        candidate_urls = [(y, url[:year_slice[0]] + str(y) + url[year_slice[1]:]) for y in years_to_try]
+
+    done_years = set()
+    for y, new_url in candidate_urls:
+        if y in done_years:
+            continue
         # Check if URL is already in the spreadsheet
         in_spreadsheet = (df["URL"] == new_url).any()
         if in_spreadsheet:
+            done_years.add(y)
             if verbose:
                 print(f"{new_url} already in spreadsheet. Skipping.")
             continue
-            # idx = df.index[df["URL"] == new_url][0]
-            # row = df.loc[idx]
-            # # Test if still valid
-            # valid, _ = find_valid_url_for_year(url, y, year_str, data_type, spreadsheet_fields)
-            # if valid:
-            #     # Update last_coverage_check and coverage dates
-            #     df.at[idx, "last_coverage_check"] = datetime.now().strftime("%m/%d/%Y")
-            #     df.to_csv(OPD_SOURCE_TABLE, index=False)
-            #     if verbose:
-            #         print(f"{new_url} already in spreadsheet and valid. Updated last_coverage_check.")
-            #     continue
-            # else:
-            #     # Remove from spreadsheet, add to deleted
-            #     if verbose:
-            #         print(f"{new_url} in spreadsheet but no longer valid. Removing and logging as deleted.")
-            #     removed_row = df.loc[[idx]].copy()
-            #     deleted_fields = [
-            #         "OPD Status","State","SourceName","Agency","AgencyFull","TableType","Year","Error",
-            #         "Date Outage Started","Last Outage Confirmation","Date Outage Ended","Date Last Contacted",
-            #         "Contact Details","source-url","URL","dataset-id"
-            #     ]
-            #     # Prepare the deleted row
-            #     deleted_row = {f: "" for f in deleted_fields}
-            #     deleted_row["OPD Status"] = f"Deleted from OPD {datetime.now().strftime('%m/%d/%Y')}"
-            #     deleted_row["Error"] = "URL no longer valid via prediction_funcs test."
-            #     for col in deleted_fields:
-            #         if col in removed_row.columns:
-            #             deleted_row[col] = removed_row.iloc[0].get(col, "")
-
-            #     # Append to deleted_df and update files
-            #     deleted_df = pd.concat([deleted_df, pd.DataFrame([deleted_row])], ignore_index=True)
-            #     df = df.drop(idx)
-            #     df.to_csv(OPD_SOURCE_TABLE, index=False)
-            #     deleted_df.to_csv(DELETED_TABLE, index=False)
-            #     continue
         else:
-            valid, new_url = find_valid_url_for_year(url, y, year_str, data_type, spreadsheet_fields, verbose)
+            try:
+                valid = is_data_available(data_type, new_url, spreadsheet_fields, verbose, breaker, negative_cache)
+            except Exception as e:
+                valid = False
             if valid:
+                done_years.add(y)
                 if verbose:
                     print(f"Valid URL found: {new_url}. Adding to OPD_Source_table.")
                 # Prepare row for OPD_Source_table
@@ -223,7 +250,7 @@ def try_url_years(
                     row["coverage_end"] = f"12/31/{y}"
                 if spreadsheet_fields:
                     for k, v in spreadsheet_fields.items():
-                        if k in row:
+                        if k in row and k not in ["URL", "Year", "last_coverage_check", "coverage_start", "coverage_end"]:
                             row[k] = v
                 # Append to OPD_Source_table.csv
                 df = pd.read_csv(OPD_SOURCE_TABLE)
@@ -235,12 +262,78 @@ def try_url_years(
             else:
                 if verbose:
                     print(f"{new_url}: not valid. Skipping.")
+    if save_cache:
+        negative_cache.save()
     return None
 
+def append_to_source_table(new_rows):
+    """Append rows to OPD_Source_table.csv, sort it, and save it"""
+    df = pd.read_csv(OPD_SOURCE_TABLE)
+    violations = validate_table.validate(df)
+    df = pd.concat([df, new_rows[[c for c in new_rows.columns if c in df.columns]]], ignore_index=True)
+    # Reorder columns so columns most useful to user are up front
+    start_cols = ["State","SourceName","Agency","AgencyFull","TableType","coverage_start","coverage_end",
+                "last_coverage_check",'Year','agency_originated','supplying_entity',"Description","source_url","readme","URL"]
+    sort_cols = start_cols.copy()
+    sort_cols.extend([x for x in df.columns if x not in start_cols])
+
+    df['coverage_start'] = pd.to_datetime(df['coverage_start'], errors='coerce')
+    df['coverage_end'] = pd.to_datetime(df['coverage_end'], errors='coerce')
+
+    if 'dataset_id' in sort_cols:
+        sort_cols.remove('dataset_id')
+    df = df.sort_values(by=sort_cols)
+
+    # Convert back to MM/DD/YYYY string format before saving
+    df['coverage_start'] = df['coverage_start'].dt.strftime('%m/%d/%Y')
+    df['coverage_end'] = df['coverage_end'].dt.strftime('%m/%d/%Y')
+    validate_table.warn_new_violations(violations, df)
+    df.to_csv(OPD_SOURCE_TABLE, index=False)
+
+def probe_candidates(candidates, verbose=False, breaker=None, negative_cache=None):
+    """
+    Check which candidate rows from candidates.build_candidates have data available.
+    Candidates are checked in order. Once a valid URL is found for a dataset, year and quarter,
+    less likely candidates for it are not checked. Candidates that recently failed or were deleted by their
+    publisher are not checked (see negative_cache). If negative_cache is None, the cache in the state
+    directory is used and saved.
+
+    Returns candidates with an added boolean "valid" column.
+    """
+    if breaker is None:
+        breaker = HostCircuitBreaker.from_outages()
+    save_cache = negative_cache is None
+    if save_cache:
+        negative_cache = NegativeCache(deleted_table=DELETED_TABLE)
+
+    valid = []
+    found = set()
+    for row in candidates.to_dict("records"):
+        group = (row.get("base_url"), row["Year"], row.get("quarter") if pd.notnull(row.get("quarter")) else None)
+        if group in found:
+            valid.append(False)
+            continue
+        is_valid = is_data_available(row["DataType"], row["URL"], row, verbose, breaker, negative_cache)
+        if is_valid:
+            found.add(group)
+        if verbose:
+            print(f"{row['URL']}: " + ("valid" if is_valid else "not valid. Skipping."))
+        valid.append(is_valid)
+
+    if verbose and breaker.open_hosts():
+        print("Hosts skipped by circuit breaker:\n" + breaker.summary())
+    if negative_cache.skipped:
+        print(f"Skipped {len(negative_cache.skipped)} candidate URLs that recently failed or were deleted by their publisher")
+    if save_cache:
+        negative_cache.save()
+
+    return candidates.assign(valid=pd.Series(valid, index=candidates.index, dtype=bool))
+
 def auto_update_sources(
     outdated_days=None,
     verbose=False,
-    source_name=None
+    source_name=None,
+    dry_run=False
 ):
     """
     Automatically check for new data by incrementing year in URLs for testable sources. Adds valid URLs to OPD_Source_table.csv.
@@ -249,88 +342,26 @@ def auto_update_sources(
         outdated_days (int): How many days before a source is considered outdated.
         verbose (bool): Print progress.
         source_name (str): Name of source to run (all will be run by default)
-    """
+        dry_run (bool): If True, return the candidate rows without checking them or modifying OPD_Source_table.csv
 
-    current_date = datetime.now()
-    current_year = current_date.year
+    Returns the candidate rows with a "valid" column indicating if data was found (no "valid" column if dry_run)
+    """
 
-    # Load table and parse datetimes
     df = pd.read_csv(OPD_SOURCE_TABLE)
-    df["last_coverage_check_dt"] = pd.to_datetime(df["last_coverage_check"], errors="coerce")
-    df["coverage_end_dt"] = pd.to_datetime(df["coverage_end"], errors="coerce")
-    df['Year'] = df['Year'].apply(lambda x: int(x) if pd.notnull(x) and x.isdigit() else x)
-
-    # Remove data
-    df = df[df['supplying_entity'].isnull()]
-    df = df[~df['Year'].isin(['MULTIPLE','NONE'])]
-    if source_name:
-        df = df[df['SourceName']==source_name]
-
-    # Group by composite key and only keep most recent dataset
-    composite_key = ['State', 'SourceName', 'Agency', 'TableType']
-    max_df = df.loc[df.groupby(composite_key)["coverage_end_dt"].idxmax()]
-    max_df = max_df[max_df['Year']!=current_year]
-
-    # 3. Filter URLs with exactly one 4-digit year
-    max_df = max_df[max_df["URL"].str.contains(r"20\d{2}", regex=True)]
-
-    # Keep rows where last_coverage_check_dt is NaT or older than outdated_days
-    to_test = max_df.copy()
-    if outdated_days is not None:
-        cutoff_date = current_date - pd.Timedelta(days=outdated_days)
-        to_test = to_test[to_test["last_coverage_check_dt"] <= cutoff_date]
-        
-    to_test = to_test.drop(columns=["last_coverage_check_dt", 'coverage_end_dt'])
-    # 6. For each outdated row, try to find new URLs by incrementing year using try_url_years
-    count = 0
-    for row in to_test.itertuples(index=False):
-        url = row.URL
-        data_type = row.DataType.lower()
-        year_match = re.findall(r"20\d{2}", url)
-        if len(year_match)==0:
-            continue
-        # Assuming minimum year is correct
-        year_str = min(year_match)
-        year = int(year_str)
-        spreadsheet_fields = row._asdict()
-        if year < current_year:
-            for y in range(year + 1, current_year + 1):
-                valid, new_url = find_valid_url_for_year(url, y, year_str, data_type, spreadsheet_fields, verbose)
-                if valid:
-                    new_row = spreadsheet_fields.copy()
-                    new_row["URL"] = new_url
-                    new_row["Year"] = str(y)
-                    new_row["last_coverage_check"] = datetime.now().strftime("%m/%d/%Y")
-                    new_row["coverage_start"] = f"01/01/{y}"
-                    new_row["coverage_end"] = f"12/31/{y}"
-                    new_row["source_url"] = ""
-                    
-                    df = pd.read_csv(OPD_SOURCE_TABLE)
-                    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                    # Reorder columns so columns most useful to user are up front
-                    start_cols = ["State","SourceName","Agency","AgencyFull","TableType","coverage_start","coverage_end",
-                                "last_coverage_check",'Year','agency_originated','supplying_entity',"Description","source_url","readme","URL"]
-                    sort_cols = start_cols.copy()
-                    sort_cols.extend([x for x in df.columns if x not in start_cols])
-
-                    df['coverage_start'] = pd.to_datetime(df['coverage_start'], errors='coerce')
-                    df['coverage_end'] = pd.to_datetime(df['coverage_end'], errors='coerce')
-
-                    if 'dataset_id' in sort_cols:
-                        sort_cols.remove('dataset_id')
-                    df = df.sort_values(by=sort_cols)
-
-                    # Convert back to MM/DD/YYYY string format before saving
-                    df['coverage_start'] = df['coverage_start'].dt.strftime('%m/%d/%Y')
-                    df['coverage_end'] = df['coverage_end'].dt.strftime('%m/%d/%Y')
-                    df.to_csv(OPD_SOURCE_TABLE, index=False)
-                    count += 1
-                    if verbose:
-                        print(f"Added to OPD_Source_table: {new_url}") 
-                else:
-                    if verbose:
-                        print(f"{new_url}: not valid. Skipping.")
-    return print(f"Checked {len(to_test)} sources for new URLs, found {count} new sources.")
+    candidates = build_candidates(df, outdated_days=outdated_days, source_name=source_name)
+    if dry_run:
+        return candidates
+
+    results = probe_candidates(candidates, verbose)
+    new_rows = results[results["valid"]].drop(columns=["valid", "base_url", "base_year", "score", "quarter", "template"])
+    if len(new_rows) > 0:
+        append_to_source_table(new_rows)
+        if verbose:
+            for url in new_rows["URL"]:
+                print(f"Added to OPD_Source_table: {url}")
+
+    print(f"Checked {results['base_url'].nunique()} sources for new URLs, found {len(new_rows)} new sources.")
+    return results
 
 if __name__ == "__main__":
     auto_update_sources(verbose=True)
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""Learn URL templates from existing rows of a dataset series to predict URLs for new years.
+
+A series is the set of single-year rows with the same State, SourceName, and TableType. Each URL in a series
+is converted to a template relative to the row's Year, e.g.
+
+    .../dataset/2025-12/ripa-stop-data-2024.zip (Year 2024) -> .../dataset/{y+1}-{m}/ripa-stop-data-{y+0}.zip
+
+Years within 2 of the row's year become year offsets, YYYY-MM upload folders become a year offset and a month,
+and Q1-Q4 suffixes become a quarter. Templates are weighted by how many (and how recent) rows use them and
+months by how close they are to the months that have been observed, so that candidates can be ranked by likelihood.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import defaultdict
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+
+SERIES_KEY = ['State', 'SourceName', 'TableType']
+MAX_YEAR_OFFSET = 2
+
+# Numbers can follow an escape such as %20
+_START = r"(?:(?<!\d)|(?<=%[0-9A-Fa-f]{2}))"
+_TOKEN_PATTERN = re.compile(
+    rf"(?P<ym>{_START}(?P<ym_year>(?:19|20)\d{{2}})(?P<ym_sep>[-_/])(?P<ym_month>0[1-9]|1[0-2])(?!\d))"
+    rf"|(?P<year>{_START}(?:19|20)\d{{2}}(?!\d))"
+    r"|(?P<quarter>(?<=[Qq])[1-4](?!\d))"
+)
+_PLACEHOLDER_PATTERN = re.compile(r"\{(y[+-]\d+|m|q)\}")
+_OFFSET_PATTERN = re.compile(r"\{y([+-]\d+)\}")
+_FOLDER_OFFSET_PATTERN = re.compile(r"\{y([+-]\d+)\}[-_/]\{m\}")
+
+
+@dataclass
+class Template:
+    """URL template learned from a series. weight is the probability of the template within its series."""
+    template: str
+    weight: float = 0.0
+    months: dict[int, float] = field(default_factory=dict)
+
+    @property
+    def has_month(self) -> bool:
+        return "{m}" in self.template
+
+    @property
+    def has_quarter(self) -> bool:
+        return "{q}" in self.template
+
+    def max_offset(self) -> int:
+        return max(int(x) for x in _OFFSET_PATTERN.findall(self.template))
+
+    def folder_offset(self) -> Optional[int]:
+        m = _FOLDER_OFFSET_PATTERN.search(self.template)
+        return int(m.group(1)) if m else None
+
+    def month_probabilities(self, scale: float = 1.5) -> dict[int, float]:
+        """Probability of each month, decaying with circular distance from the observed months"""
+        if not self.months:
+            return {m: 1 / 12 for m in range(1, 13)}
+        probs = {}
+        for m in range(1, 13):
+            probs[m] = sum(w * np.exp(-min(abs(m - k), 12 - abs(m - k)) / scale) for k, w in self.months.items())
+        total = sum(probs.values())
+        return {m: p / total for m, p in probs.items()}
+
+    def fill(self, year: int, month: Optional[int] = None, quarter: Optional[int] = None) -> str:
+        def repl(match):
+            token = match.group(1)
+            if token == "m":
+                return f"{month:02d}"
+            elif token == "q":
+                return str(quarter)
+            return str(year + int(token[1:]))
+        return _PLACEHOLDER_PATTERN.sub(repl, self.template)
+
+
+def tokenize(url: str, year: int) -> tuple[str, Optional[int]]:
+    """Convert a URL to a template relative to year. Returns the template and the month of a YYYY-MM token if present."""
+    month = None
+
+    def repl(match):
+        nonlocal month
+        if match.group("ym"):
+            offset = int(match.group("ym_year")) - year
+            if abs(offset) > MAX_YEAR_OFFSET:
+                return match.group(0)
+            month = int(match.group("ym_month"))
+            return f"{{y{offset:+d}}}{match.group('ym_sep')}{{m}}"
+        elif match.group("year"):
+            offset = int(match.group("year")) - year
+            return f"{{y{offset:+d}}}" if abs(offset) <= MAX_YEAR_OFFSET else match.group(0)
+        else:
+            return "{q}"
+
+    return _TOKEN_PATTERN.sub(repl, url), month
+
+
+def learn_series(urls: Iterable[str], years: Iterable[int]) -> list[Template]:
+    """Learn the templates of one series from its URLs and years, most likely first.
+
+    Rows are weighted by recency so that a change in URL format is followed quickly.
+    """
+    urls = list(urls)
+    years = [int(y) for y in years]
+    if len(urls) == 0:
+        return []
+
+    max_year = max(years)
+    templates: dict[str, Template] = {}
+    months: dict[str, dict[int, float]] = defaultdict(lambda: defaultdict(float))
+    for url, year in zip(urls, years):
+        template, month = tokenize(url, year)
+        if "{y" not in template:
+            # URL does not depend on year
+            continue
+        w = 1 / (1 + max_year - year)
+        t = templates.setdefault(template, Template(template))
+        t.weight += w
+        if month is not None:
+            months[template][month] += w
+
+    total = sum(t.weight for t in templates.values())
+    for t in templates.values():
+        t.weight /= total
+        t.months = dict(months[t.template])
+
+    return sorted(templates.values(), key=lambda t: t.weight, reverse=True)
+
+
+def learn_templates(df: pd.DataFrame, key: list = SERIES_KEY) -> dict[tuple, list[Template]]:
+    """Learn templates for every series in the source table. Returns {series key: templates}"""
+    year = pd.to_numeric(df["Year"], errors="coerce")
+    rows = df[year.notnull() & df["URL"].notnull()].assign(_year=year)
+    return {k: learn_series(g["URL"], g["_year"]) for k, g in rows.groupby(key, sort=False)}
+
+
+def expand(templates: list[Template], year: int, max_months: int = 3, now: Optional[datetime] = None) -> pd.DataFrame:
+    """Candidate URLs for year from a series' templates ranked by score (template weight x month probability).
+
+    Only the max_months most likely months are used for templates with a month. Templates with a quarter
+    produce a separate candidate for each quarter since each quarter is a separate file. URLs containing
+    years or YYYY-MM folders after now are not included.
+    """
+    now = now or datetime.now()
+    records = []
+    for t in templates:
+        if year + t.max_offset() > now.year:
+            continue
+        if t.has_month:
+            folder_year = year + (t.folder_offset() or 0)
+            months = [x for x in t.month_probabilities().items() if (folder_year, x[0]) <= (now.year, now.month)]
+            months = sorted(months, key=lambda x: x[1], reverse=True)[:max_months]
+        else:
+            months = [(None, 1.0)]
+        quarters = range(1, 5) if t.has_quarter else [float("nan")]
+        for m, p in months:
+            for q in quarters:
+                records.append({"URL": t.fill(year, m, q), "quarter": q, "score": t.weight * p, "template": t.template})
+
+    cand = pd.DataFrame(records, columns=["URL", "quarter", "score", "template"])
+    cand = cand.sort_values("score", ascending=False, kind="stable").drop_duplicates("URL")
+    return cand.reset_index(drop=True)
+
+
+def candidates_for_url(url: str, year: int, years_to_try: Iterable[int], history: Optional[list[Template]] = None,
+                       max_months: int = 3, now: Optional[datetime] = None) -> pd.DataFrame:
+    """Candidate URLs for other years of a dataset whose URL may contain several years or a YYYY-MM folder.
+
+    The template of url is used. If templates learned from other rows of the same series are provided,
+    their months are used to rank the months of url's template.
+    """
+    template, month = tokenize(url, year)
+    if "{y" not in template:
+        raise ValueError(f"Unable to find year {year} in URL {url}")
+
+    years_to_try = list(years_to_try)
+    t = Template(template, 1.0, {month: 1.0} if month is not None else {})
+    for h in history or []:
+        if h.template == template:
+            t.months = h.months or t.months
+            break
+
+    cand = [expand([t], y, max_months, now).assign(year=y) for y in years_to_try]
+    cand = [c for c in cand if len(c) > 0]
+    return pd.concat(cand, ignore_index=True) if cand else pd.DataFrame(columns=["URL", "quarter", "score", "template", "year"])
@@ -0,0 +1,154 @@
+"""Per-row timing, transfer and outcome metrics for long-running maintenance scripts.
+
+Each unit of work (e.g. checking the coverage of a row) is recorded as a span with the type of probe, host,
+DataType, bytes received, latency and outcome. Spans are appended to a JSONL file in the runs directory of the
+local state directory as they finish so that a run that is interrupted can still be analyzed. At the end of a
+run, summary reports the hosts that took the most time, p50/p95 latency per DataType and bytes per row.
+
+    metrics = RunMetrics("update_dates")
+    with metrics.span("coverage", url=row["URL"], data_type=row["DataType"], source_table_id=row["source_table_id"]) as span:
+        ...
+        span["outcome"] = "changed"
+    metrics.close()
+
+The bytes of responses received through RunMetrics.session (or any session from metered_session) are added to the
+span of the thread that made the request. Streamed responses are counted by the code that reads them (see add_bytes
+and download_cache). Requests made by other libraries, such as OPD's data loaders, are not counted.
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import requests
+
+import state
+from circuit_breaker import host_of, is_host_failure
+
+
+RUNS_DIR = "runs"
+TOP_HOSTS = 10
+
+_local = threading.local()
+
+def _current_spans() -> list:
+    if not hasattr(_local, "spans"):
+        _local.spans = []
+    return _local.spans
+
+
+def add_bytes(n: int) -> None:
+    """Add n bytes received to the innermost span of this thread (if any)"""
+    spans = _current_spans()
+    if spans:
+        spans[-1]["bytes"] += n
+
+
+def count_response_bytes(r: requests.Response, *args, stream: bool = False, **kwargs) -> requests.Response:
+    """requests response hook that adds the bytes of a response that is not streamed to the current span"""
+    if not stream:
+        add_bytes(len(r.content))
+    return r
+
+
+def metered_session() -> requests.Session:
+    """Session whose responses are counted in the span of the thread that made the request"""
+    session = requests.Session()
+    session.hooks["response"].append(count_response_bytes)
+    return session
+
+
+class RunMetrics:
+    def __init__(self, name: str, path: Optional[Path] = None) -> None:
+        self.name = name
+        self.path = path or state.state_path(RUNS_DIR) / f"{name}_{datetime.now():%Y%m%d_%H%M%S}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+        self._file = self.path.open("a", encoding="utf-8")
+        self._closed = False
+        self.session = metered_session()
+
+    def __enter__(self) -> RunMetrics:
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._file.close()
+            self.session.close()
+
+    @contextmanager
+    def span(self, probe: str, url: Optional[str] = None, data_type: Optional[str] = None, **fields):
+        """Record a unit of work. The yielded dict can be updated (e.g. outcome) before the span ends."""
+        record = {"probe": probe, "host": host_of(url) if isinstance(url, str) else None, "data_type": data_type,
+                  "bytes": 0, "outcome": "ok", **fields, "start": datetime.now().isoformat(timespec="seconds")}
+        spans = _current_spans()
+        spans.append(record)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["outcome"] = "error"
+            record["error"] = type(e).__name__
+            record["host_failure"] = is_host_failure(e)
+            raise
+        finally:
+            record["latency"] = round(time.perf_counter() - t0, 4)
+            spans.pop()
+            self._write(record)
+
+    def _write(self, record: dict) -> None:
+        with self._lock:
+            self.spans.append(record)
+            if not self._closed:
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+
+    def frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.spans, columns=sorted(set(["probe", "host", "data_type", "bytes", "outcome", "latency"]).union(*self.spans)))
+
+    def summary(self, top: int = TOP_HOSTS) -> dict[str, pd.DataFrame]:
+        """Hosts that took the most total time, latency percentiles per DataType and bytes per row"""
+        df = self.frame()
+        if len(df) == 0:
+            return {}
+        df["failed"] = df["outcome"].isin(["error", "host_failure"])
+        hosts = df.groupby(df["host"].fillna("(none)")).agg(
+            rows=("latency", "size"), total_seconds=("latency", "sum"), p95_seconds=("latency", lambda x: x.quantile(0.95)),
+            failures=("failed", "sum"), bytes=("bytes", "sum"))
+        data_types = df.groupby(df["data_type"].fillna("(none)")).agg(
+            rows=("latency", "size"), p50_seconds=("latency", "median"), p95_seconds=("latency", lambda x: x.quantile(0.95)),
+            total_seconds=("latency", "sum"), bytes_per_row=("bytes", "mean"))
+        return {
+            "hosts": hosts.sort_values("total_seconds", ascending=False).head(top),
+            "data_types": data_types.sort_values("total_seconds", ascending=False),
+            "outcomes": df["outcome"].value_counts().to_frame("rows"),
+        }
+
+    def print_summary(self, top: int = TOP_HOSTS) -> None:
+        summary = self.summary(top)
+        if not summary:
+            return
+        total = sum(x["latency"] for x in self.spans)
+        print(f"\n{len(self.spans)} rows in {total/60:.1f} minutes. Spans written to {self.path}")
+        with pd.option_context("display.width", 200, "display.float_format", "{:.2f}".format):
+            print(f"\nSlowest hosts:\n{summary['hosts']}")
+            print(f"\nLatency per DataType:\n{summary['data_types']}")
+            print(f"\nOutcomes:\n{summary['outcomes']}")
+
+
+def load_run(path: Path) -> pd.DataFrame:
+    """Load the spans of a previous run"""
+    with Path(path).open(encoding="utf-8") as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
@@ -0,0 +1,196 @@
+"""Schedule coverage checks in update_dates by staleness and update cadence.
+
+Each row is assigned an expected update interval from the history of previous checks (how often its
+coverage_end has been observed to change). If there is not enough history, the interval is estimated from the
+lag between coverage_end and last_coverage_check: a dataset whose data ended the day before it was checked
+is updated frequently, and one whose data ended a year before it was checked is not. A row is due when the
+interval has elapsed since it was last checked. Due rows are processed most overdue first within a budget.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+import state
+
+
+DELETED_TABLE = Path(__file__).parent.parent / "datasets_deleted_by_publisher.csv"
+# Backups of datasets deleted by their publishers are stored in this repo
+BACKUP_URL_PATTERN = r"githubusercontent\.com/openpolicedata/opd-datasets/"
+
+PAST_SINGLE_YEAR = "past single-year"
+FROZEN_STANFORD = "frozen Stanford"
+PUBLISHER_DELETED = "publisher-deleted"
+
+HISTORY_FILE = "coverage_history.json"
+MAX_HISTORY = 20
+
+MIN_INTERVAL_DAYS = 1
+MAX_INTERVAL_DAYS = 180
+# Single year datasets for the current year are typically updated monthly or quarterly if at all
+CURRENT_YEAR_INTERVAL_DAYS = 30
+STATIC_INTERVAL_DAYS = 365
+
+
+def load_history() -> dict:
+    """Load history of checks: {source_table_id: {"probes": [ISO dates], "changes": [[ISO date, coverage_end], ...]}}"""
+    return state.load_json(HISTORY_FILE)
+
+
+def save_history(history: dict) -> None:
+    state.save_json(HISTORY_FILE, history)
+
+
+def record_probe(history: dict, source_table_id: str, when: Optional[datetime] = None) -> None:
+    """Record that a row was checked"""
+    if pd.isnull(source_table_id):
+        return
+    when = (when or datetime.now()).isoformat(timespec="seconds")
+    entry = history.setdefault(source_table_id, {"probes": [], "changes": []})
+    entry["probes"] = (entry["probes"] + [when])[-MAX_HISTORY:]
+
+
+def record_change(history: dict, source_table_id: str, coverage_end: Optional[str], when: Optional[datetime] = None) -> None:
+    """Record that a check found a new coverage_end for a row"""
+    if pd.isnull(source_table_id):
+        return
+    when = (when or datetime.now()).isoformat(timespec="seconds")
+    entry = history.setdefault(source_table_id, {"probes": [], "changes": []})
+    entry["changes"] = (entry["changes"] + [[when, coverage_end]])[-MAX_HISTORY:]
+
+
+def _history_frame(history: dict) -> pd.DataFrame:
+    records = []
+    for source_table_id, entry in history.items():
+        changes = pd.to_datetime(pd.Series([x[0] for x in entry.get("changes", [])], dtype=object), errors="coerce").dropna()
+        interval = changes.sort_values().diff().dt.total_seconds().div(86400).median() if len(changes) > 1 else float("nan")
+        last_probe = max(entry["probes"]) if entry.get("probes") else None
+        records.append({"source_table_id": source_table_id, "observed_interval": interval, "last_probe": last_probe})
+
+    hist = pd.DataFrame(records, columns=["source_table_id", "observed_interval", "last_probe"])
+    hist["last_probe"] = pd.to_datetime(hist["last_probe"], errors="coerce")
+    return hist.set_index("source_table_id")
+
+
+def schedule(df: pd.DataFrame, history: Optional[dict] = None, now: Optional[datetime] = None) -> pd.DataFrame:
+    """Compute the update interval, next due time and how overdue each row of the source table is.
+
+    Returns a DataFrame with the index of df and columns interval_days, last_checked, next_due, and overdue_days.
+    Rows that are never checked (Year is NONE) have a null next_due.
+    """
+    now = pd.Timestamp(now or datetime.now())
+    history = load_history() if history is None else history
+    hist = _history_frame(history)
+
+    coverage_end = pd.to_datetime(df["coverage_end"], errors="coerce")
+    last_check = pd.to_datetime(df["last_coverage_check"], errors="coerce", format="%m/%d/%Y")
+    year = pd.to_numeric(df["Year"], errors="coerce")
+    is_multi = df["Year"].astype(str) == "MULTIPLE"
+    is_stanford = df["URL"].astype(str).str.contains("stanford.edu", regex=False)
+
+    # Lag between the end of the data and when it was checked
+    lag = (last_check - coverage_end).dt.days.clip(lower=MIN_INTERVAL_DAYS, upper=MAX_INTERVAL_DAYS)
+    interval = pd.Series(float("nan"), index=df.index)
+    interval[is_multi] = lag[is_multi].fillna(MIN_INTERVAL_DAYS)
+    interval[year.notnull()] = STATIC_INTERVAL_DAYS
+    interval[year == now.year] = CURRENT_YEAR_INTERVAL_DAYS
+    interval[is_stanford] = STATIC_INTERVAL_DAYS
+
+    observed = df["source_table_id"].map(hist["observed_interval"]) if len(hist) else pd.Series(float("nan"), index=df.index)
+    observed = observed.clip(lower=MIN_INTERVAL_DAYS, upper=MAX_INTERVAL_DAYS)
+    use_observed = observed.notnull() & interval.notnull()
+    interval[use_observed] = observed[use_observed]
+
+    last_probe = df["source_table_id"].map(hist["last_probe"]) if len(hist) else pd.Series(pd.NaT, index=df.index)
+    last_checked = pd.concat([last_check, pd.to_datetime(last_probe)], axis=1).max(axis=1)
+
+    next_due = last_checked + pd.to_timedelta(interval, unit="D")
+    overdue = (now - next_due).dt.total_seconds() / 86400
+    # Rows that have never been checked are due immediately and go first
+    never_checked = last_checked.isnull() & interval.notnull()
+    next_due[never_checked] = now
+    overdue[never_checked] = float("inf")
+
+    return pd.DataFrame({"interval_days": interval, "last_checked": last_checked, "next_due": next_due, "overdue_days": overdue},
+                        index=df.index)
+
+
+def due_rows(df: pd.DataFrame, history: Optional[dict] = None, now: Optional[datetime] = None) -> pd.Index:
+    """Index of rows of df that are due for a check, most overdue first"""
+    sched = schedule(df, history, now)
+    sched = sched[sched["next_due"].notnull() & (sched["overdue_days"] >= 0)]
+    return sched.sort_values("overdue_days", ascending=False, kind="stable").index
+
+
+def dataset_key(url, dataset_id=None) -> str:
+    """Key of a dataset from its URL and dataset ID (e.g. for matching rows to datasets_deleted_by_publisher.csv)"""
+    url = url.strip() if isinstance(url, str) else ""
+    if type(dataset_id) in [list, dict]:
+        dataset_id = json.dumps(dataset_id)
+    elif not isinstance(dataset_id, str):
+        dataset_id = "" if pd.isnull(dataset_id) else str(dataset_id)
+    # Socrata IDs are sometimes recorded with underscores in the deleted table
+    return url + "|" + dataset_id.strip().lower().replace("_", "-")
+
+
+def _dataset_key(urls: pd.Series, dataset_ids: pd.Series) -> pd.Series:
+    return pd.Series([dataset_key(u, x) for u, x in zip(urls, dataset_ids)], index=urls.index, dtype=object)
+
+
+def classify_immutable(df: pd.DataFrame, deleted: Optional[pd.DataFrame] = None, now: Optional[datetime] = None) -> pd.Series:
+    """Classify rows whose coverage can no longer change.
+
+    Returns a Series with the index of df containing the reason a row is immutable or an empty string if it is not:
+
+    - past single-year: Year is a past year and coverage is already 01/01 to 12/31 of that year
+    - frozen Stanford: Stanford Open Policing Project data, which is no longer updated, with coverage already set
+    - publisher-deleted: Dataset is listed in datasets_deleted_by_publisher.csv or is a backup of a deleted dataset
+    """
+    now = pd.Timestamp(now or datetime.now())
+    if deleted is None:
+        deleted = pd.read_csv(DELETED_TABLE, dtype=str) if DELETED_TABLE.exists() else pd.DataFrame(columns=["URL", "dataset_id"])
+
+    coverage_start = pd.to_datetime(df["coverage_start"], errors="coerce")
+    coverage_end = pd.to_datetime(df["coverage_end"], errors="coerce")
+    year = pd.to_numeric(df["Year"], errors="coerce")
+    urls = df["URL"].astype(str)
+
+    past_single_year = (year < now.year) & \
+        (coverage_start.dt.year == year) & (coverage_start.dt.month == 1) & (coverage_start.dt.day == 1) & \
+        (coverage_end.dt.year == year) & (coverage_end.dt.month == 12) & (coverage_end.dt.day == 31)
+    frozen_stanford = urls.str.contains("stanford.edu", regex=False) & coverage_start.notnull() & coverage_end.notnull()
+    publisher_deleted = urls.str.contains(BACKUP_URL_PATTERN, regex=True) | \
+        _dataset_key(df["URL"], df["dataset_id"]).isin(_dataset_key(deleted["URL"], deleted["dataset_id"]))
+
+    reason = pd.Series("", index=df.index)
+    reason[past_single_year] = PAST_SINGLE_YEAR
+    reason[frozen_stanford] = FROZEN_STANFORD
+    reason[publisher_deleted] = PUBLISHER_DELETED
+    return reason
+
+
+class Budget:
+    """Time and probe budget for a run. A limit of None is unlimited."""
+
+    def __init__(self, max_seconds: Optional[float] = None, max_probes: Optional[int] = None, clock=time.monotonic) -> None:
+        self.max_seconds = max_seconds
+        self.max_probes = max_probes
+        self._clock = clock
+        self._start = clock()
+        self.probes = 0
+
+    def charge(self, probes: int = 1) -> None:
+        self.probes += probes
+
+    def elapsed(self) -> float:
+        return self._clock() - self._start
+
+    def exhausted(self) -> bool:
+        return (self.max_probes is not None and self.probes >= self.max_probes) or \
+            (self.max_seconds is not None and self.elapsed() >= self.max_seconds)
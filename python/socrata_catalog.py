@@ -0,0 +1,69 @@
+"""Find when Socrata datasets were last updated with one catalog request per portal.
+
+Checking the coverage of a Socrata dataset takes a count query per year and several loads. The catalog of each
+Socrata domain reports when the data of each of its datasets was last updated, so the update times of all the
+datasets on a domain can be requested at once (in batches of BATCH_SIZE IDs). See upstream_changes for how the
+update times are used to skip datasets that have not changed.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import pandas as pd
+import requests
+
+from circuit_breaker import HostCircuitBreaker, host_of
+from scheduler import Budget
+
+
+CATALOG_PATH = "/api/catalog/v1"
+BATCH_SIZE = 100
+TIMEOUT = 30
+
+
+def fetch_updated(domain: str, ids: list[str], session: Optional[requests.Session] = None) -> dict[str, str]:
+    """Time that the data of each dataset in ids was last updated according to the catalog of domain.
+    Datasets that are not in the catalog are not included.
+    """
+    session = session or requests
+    updated = {}
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start+BATCH_SIZE]
+        r = session.get(f"https://{domain}{CATALOG_PATH}", params={"ids": batch, "limit": len(batch)}, timeout=TIMEOUT)
+        r.raise_for_status()
+        for result in r.json().get("results", []):
+            resource = result.get("resource", {})
+            # data_updated_at is the catalog's equivalent of rowsUpdatedAt in the views API
+            value = resource.get("data_updated_at") or resource.get("updatedAt")
+            if resource.get("id") and value:
+                updated[resource["id"]] = value
+    return updated
+
+
+def sweep(df: pd.DataFrame, breaker: Optional[HostCircuitBreaker] = None,
+          session: Optional[requests.Session] = None, budget: Optional[Budget] = None) -> pd.Series:
+    """Current data update time of each Socrata row of df with one catalog request per domain. Other rows and
+    rows whose update time could not be found are null. Each domain is charged to budget, and no more domains are
+    read once it is exhausted.
+    """
+    updated = pd.Series(None, index=df.index, dtype=object)
+    socrata = df[(df["DataType"] == "Socrata") & df["dataset_id"].apply(lambda x: isinstance(x, str))]
+    for domain, rows in socrata.groupby(socrata["URL"].map(host_of)):
+        if budget is not None and budget.exhausted():
+            break
+        if breaker is not None and not breaker.allow(domain):
+            continue
+        if budget is not None:
+            budget.charge()
+        try:
+            found = fetch_updated(domain, list(rows["dataset_id"].str.strip().unique()), session)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if breaker is not None:
+                breaker.record_failure(domain, e)
+            print(f"Unable to read the Socrata catalog of {domain}. Its rows will be checked: {e}")
+            continue
+        if breaker is not None:
+            breaker.record_success(domain)
+        updated[rows.index] = rows["dataset_id"].str.strip().map(found).values
+    return updated.where(updated.notnull(), None)
@@ -7,9 +7,10 @@ and therefore, have more up-to-date data.
 """
 
 import pandas as pd
-import requests
 from datetime import datetime
 
+import download_cache
+
 _us_state_abbrev = {
     'AL' : 'Alabama', 
     'AK' : 'Alaska',
@@ -147,7 +148,7 @@ def find_time_range(r, start, end):
 def get_stanford():
     url = "https://openpolicing.stanford.edu/data/"
 
-    r = requests.get(url)
+    r = download_cache.get(url)
 
     states = []
     sources = []
@@ -205,7 +206,7 @@ def gen_stanford_table():
     import re
     url = "https://openpolicing.stanford.edu/data/"
 
-    r = requests.get(url)
+    r = download_cache.get(url)
 
     table_content = re.findall('<td(.*?)>(.*?)</td>', r.text, re.DOTALL)
 
@@ -0,0 +1,45 @@
+"""Local state shared by the table maintenance scripts.
+
+Caches, schedules and registries that persist between runs of the scripts in this directory are stored
+as JSON files in STATE_DIR. The directory is not tracked by git and can be deleted at any time to reset them.
+Set the OPD_STATE_DIR environment variable to store them elsewhere (e.g. on a shared drive for workers).
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+
+STATE_DIR = Path(os.environ.get("OPD_STATE_DIR", Path(__file__).parent / ".opd_state"))
+
+
+def state_path(name: str) -> Path:
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    return STATE_DIR / name
+
+
+def load_json(name: str, default: Any = None) -> Any:
+    path = state_path(name)
+    if not path.exists():
+        return {} if default is None else default
+
+    with path.open(encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def save_json(name: str, data: Any) -> None:
+    """Write data to the state file atomically so that an interrupted run does not corrupt it"""
+    path = state_path(name)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            json.dump(data, handle, indent=1, sort_keys=True, default=str)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
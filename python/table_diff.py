@@ -0,0 +1,149 @@
+"""Cell-level diff between two versions of the source table.
+
+Rows are matched by source_table_id. Each row is hashed so that changed rows are found in a single pass, and
+cells are only compared for rows whose hashes differ. Either version can be a CSV file or a git revision, which is
+read from its blob with git show without checking it out.
+
+    python table_diff.py HEAD~10 HEAD
+    python table_diff.py origin/main ../opd_source_table.csv --cells changes.csv
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import os
+import subprocess
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from generate_source_table_ids import KEY_COLUMNS, SOURCE_TABLE_ID, build_source_table_id
+
+
+REPO_DIR = Path(__file__).parent.parent
+SOURCE_TABLE = "opd_source_table.csv"
+
+
+def read_revision(rev: str, path: str = SOURCE_TABLE) -> pd.DataFrame:
+    """Read the source table at a git revision from its blob"""
+    result = subprocess.run(["git", "show", f"{rev}:{path}"], cwd=REPO_DIR, capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f"Unable to read {path} at revision {rev}: {result.stderr.decode().strip()}")
+    return pd.read_csv(io.BytesIO(result.stdout), dtype=str, keep_default_na=False)
+
+
+def read_table(spec: str, path: str = SOURCE_TABLE) -> pd.DataFrame:
+    """Read a source table as strings from a file or, if spec is not a file, from a git revision"""
+    if os.path.exists(spec):
+        return pd.read_csv(spec, dtype=str, keep_default_na=False)
+    return read_revision(spec, path)
+
+
+def table_ids(df: pd.DataFrame) -> pd.Series:
+    """source_table_id of each row. Rows without one are given an ID computed from their key columns."""
+    ids = df[SOURCE_TABLE_ID].fillna("") if SOURCE_TABLE_ID in df else pd.Series("", index=df.index)
+    missing = ids == ""
+    if missing.any():
+        keys = df.loc[missing, list(KEY_COLUMNS)].fillna("").astype(str)
+        ids = ids.copy()
+        ids[missing] = [build_source_table_id(r) for r in keys.to_dict("records")]
+    return ids
+
+
+def row_hashes(df: pd.DataFrame, columns: list) -> pd.Series:
+    return pd.util.hash_pandas_object(df.reindex(columns=columns, fill_value="").fillna(""), index=False)
+
+
+@dataclass
+class TableDiff:
+    inserted: pd.Index
+    deleted: pd.Index
+    # Long format: source_table_id, column, old, new
+    cells: pd.DataFrame
+    added_columns: list = field(default_factory=list)
+    removed_columns: list = field(default_factory=list)
+
+    @property
+    def changed(self) -> pd.Index:
+        return pd.Index(self.cells[SOURCE_TABLE_ID].unique(), name=SOURCE_TABLE_ID)
+
+    def changes_per_column(self) -> pd.Series:
+        return self.cells["column"].value_counts()
+
+    def summary(self) -> str:
+        lines = [f"{len(self.inserted)} rows inserted, {len(self.deleted)} rows deleted, {len(self.changed)} rows changed"]
+        if self.added_columns:
+            lines.append(f"Columns added: {', '.join(self.added_columns)}")
+        if self.removed_columns:
+            lines.append(f"Columns removed: {', '.join(self.removed_columns)}")
+        for c, n in self.changes_per_column().items():
+            lines.append(f"    {c}: {n} cells")
+        return "\n".join(lines)
+
+
+def diff_tables(old: pd.DataFrame, new: pd.DataFrame, columns: Optional[list] = None) -> TableDiff:
+    """Diff two source tables read as strings (see read_table). columns limits the columns that are compared."""
+    old = old.set_axis(pd.Index(table_ids(old), name=SOURCE_TABLE_ID))
+    new = new.set_axis(pd.Index(table_ids(new), name=SOURCE_TABLE_ID))
+    for name, df in [("Old", old), ("New", new)]:
+        if df.index.has_duplicates:
+            raise ValueError(f"{name} table contains duplicate {SOURCE_TABLE_ID} value(s): "
+                             f"{', '.join(df.index[df.index.duplicated()].unique()[:20])}")
+
+    if columns is None:
+        columns = [c for c in old.columns.union(new.columns, sort=False) if c != SOURCE_TABLE_ID]
+
+    common = old.index.intersection(new.index, sort=False)
+    old_common = old.loc[common]
+    new_common = new.loc[common]
+    changed = row_hashes(old_common, columns).values != row_hashes(new_common, columns).values
+
+    old_changed = old_common[changed].reindex(columns=columns, fill_value="").fillna("")
+    new_changed = new_common[changed].reindex(columns=columns, fill_value="").fillna("")
+    mask = old_changed.ne(new_changed)
+    stacked = mask.stack()
+    stacked = stacked[stacked]
+    cells = pd.DataFrame({
+        SOURCE_TABLE_ID: stacked.index.get_level_values(0),
+        "column": stacked.index.get_level_values(1),
+        "old": old_changed.stack()[stacked.index].values,
+        "new": new_changed.stack()[stacked.index].values,
+    })
+
+    return TableDiff(
+        inserted=new.index.difference(old.index, sort=False),
+        deleted=old.index.difference(new.index, sort=False),
+        cells=cells,
+        added_columns=[c for c in new.columns if c not in old],
+        removed_columns=[c for c in old.columns if c not in new],
+    )
+
+
+def diff_revisions(old_rev: str, new_rev: str, path: str = SOURCE_TABLE, columns: Optional[list] = None) -> TableDiff:
+    """Diff the source table at two git revisions (or files)"""
+    return diff_tables(read_table(old_rev, path), read_table(new_rev, path), columns)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old", help="File or git revision of the old table")
+    parser.add_argument("new", nargs="?", default=str(REPO_DIR / SOURCE_TABLE),
+                        help="File or git revision of the new table (default: working copy of opd_source_table.csv)")
+    parser.add_argument("--path", default=SOURCE_TABLE, help="Path of the table in the repository for git revisions")
+    parser.add_argument("-c", "--columns", help="Comma separated list of columns to compare (default: all)")
+    parser.add_argument("--cells", type=Path, help="Write changed cells (source_table_id, column, old, new) to this CSV file")
+    args = parser.parse_args()
+
+    columns = [x.strip() for x in args.columns.split(",")] if args.columns else None
+    diff = diff_revisions(args.old, args.new, args.path, columns)
+    print(diff.summary())
+    if args.cells:
+        diff.cells.to_csv(args.cells, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
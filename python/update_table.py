@@ -5,9 +5,11 @@ except:
     sys.path.append('../openpolicedata')
     import openpolicedata as opd
 
+from argparse import ArgumentParser
 import os
 import pandas as pd
 from datetime import datetime
+import requests
 import urllib
 from io import BytesIO
 import json
@@ -15,31 +17,188 @@ import re
 import warnings
 from zipfile import ZipFile
 
-def compare_tables():
-    old_file = r"opd_source_table.csv"
-    new_file = r"opd_source_table w source url.csv"
-
-    df1 = pd.read_csv(old_file)
-    df2 = pd.read_csv(new_file)
-
-    df1["which"] = 0
-    df2["which"] = 1
-
-    df = pd.concat([df2,df1])
-
-    cols = []
-    for c in df.columns:
-        if c=='readme':
-            break
+from agency_registry import AgencyRegistry
+import arcgis_layers
+from circuit_breaker import CLOSED, HostCircuitBreaker, host_of, is_host_failure
+import coverage_index
+from date_formats import DateFormatCache
+import distinct_agencies
+import download_cache
+from file_executor import FileExecutor, read_columns, reduce_dates
+from run_metrics import RunMetrics
+import scheduler
+import table_diff
+from upstream_changes import UpstreamChanges
+import validate_table
+from year_cache import YearSpanCache, row_fingerprint
+
+def compare_tables(old_file=r"opd_source_table.csv", new_file=r"opd_source_table w source url.csv"):
+    """Print and return the differences between 2 versions of the source table. Either can be a file or git revision."""
+    diff = table_diff.diff_tables(table_diff.read_table(old_file), table_diff.read_table(new_file))
+    print(diff.summary())
+    return diff
+
+def date_range_coverage(start, end):
+    """Coverage start and end dates from the results of reduce_dates for the tables containing the first and last dates"""
+    min_val = start["min"]
+    # Assuming 1st date might be a mistake if it is much earlier than the rest
+    if isinstance(min_val, pd.Timestamp) and min_val.year<2000 and start["second_min"] is not None and \
+        start["second_min"].year - min_val.year > 5:
+        min_val = start["second_min"]
+    if not isinstance(min_val, str):
+        min_val = min_val.strftime('%m/%d/%Y')
+
+    max_val = end["max"]
+    if not isinstance(max_val, str):
+        max_val = max_val.strftime('%m/%d/%Y')
+
+    return min_val, max_val
+
+def get_multi_coverage(src, cur_row, access_type, min_year=1990, breaker=None, year_cache=None, prefetched=None, validator=None,
+                       date_formats=None, session=None):
+    """Find the coverage start and end dates of a MULTIPLE year dataset. Returns None if they cannot be found.
+
+    prefetched: Future from FileExecutor.submit that reduces the file to its dates (reducer "dates")
+    validator: Value from the data portal that changes when the data changes (see YearSpanCache.get_years)
+    date_formats: DateFormatCache for parsing a date column found when date_field is not set
+    session: requests.Session for requests made by this module (e.g. RunMetrics.session so that their bytes are counted)
+    """
+
+    if prefetched is not None:
+        try:
+            reduced = prefetched.result()
+        except (opd.exceptions.OPD_DataUnavailableError, requests.exceptions.HTTPError, ValueError) as e:
+            # The file could not be downloaded (e.g. 404) or the sheet or zip member could not be read. Only skip this row.
+            if breaker is not None:
+                breaker.record_failure(cur_row["URL"], e)
+            warnings.warn(f'Unable to read {cur_row["URL"]} for {cur_row["SourceName"]} {cur_row["TableType"]}: {e}')
+            return None
+        return date_range_coverage(reduced, reduced)
+
+    if cur_row["DataType"]=="ArcGIS" and pd.notnull(cur_row["date_field"]) and pd.isnull(cur_row["query"]):
+        # The date range can be found with a single statistics query instead of loading the first and last years
+        try:
+            reduced = arcgis_layers.date_stats(cur_row["URL"], cur_row["date_field"], min_year, session)
+        except (requests.exceptions.HTTPError, ValueError):
+            # Not supported by the server or date_field is not a date. Fall back to loading the data
+            reduced = None
+        if reduced is not None:
+            if reduced["count"]==0:
+                warnings.warn(f'No dates found for {cur_row["SourceName"]}, {cur_row["State"]} {cur_row["TableType"]}')
+                return None
+            return date_range_coverage(reduced, reduced)
+
+    # Manually get years since get years gets years for all datasets
+    try:
+        loader = src._Source__get_loader(opd.defs.DataType(cur_row["DataType"]), cur_row["URL"], cur_row['query'], 
+                                dataset=cur_row["dataset_id"],
+                                date_field=cur_row["date_field"], agency_field=cur_row["agency_field"])
+    except opd.exceptions.OPD_DataUnavailableError as e:
+        if breaker is not None:
+            breaker.record_failure(cur_row["URL"], e)
+        return None
+
+    if cur_row['DataType'] in ["Excel",'CSV']:
+        years = [opd.defs.MULTI]
+    else:
+        try:
+            if year_cache is None:
+                years = loader.get_years()
+            else:
+                years = year_cache.get_years(loader, cur_row["source_table_id"], row_fingerprint(cur_row), validator)
+        except (opd.exceptions.OPD_SocrataHTTPError, opd.exceptions.OPD_DataUnavailableError) as e:
+            if breaker is not None:
+                breaker.record_failure(cur_row["URL"], e)
+            return None
+        years.sort()
+        years = [x for x in years if x >= min_year]
+
+    if len(years)==0:
+        warnings.warn(f'No years found for {cur_row["SourceName"]}, {cur_row["State"]} {cur_row["TableType"]}')
+        return None
+
+    nrows = 1 if access_type=="API" else None
+
+    # For if case, assuming 1st year might be a mistake
+    years_req = years[:2] if len(years)>1 and years[1]-years[0]>5 else years[0]
+
+    if nrows==1:
+        assert pd.notnull(cur_row["date_field"])
+
+    try:
+        table = src.load(year=years_req, table_type=cur_row["TableType"], nrows=nrows, url=cur_row['URL'], id=cur_row['dataset_id'],
+                        sortby='date')
+    except opd.exceptions.OPD_MinVersionError:
+        return None
+    if len(table.table)==0:
+        raise ValueError("No records found in first year")
+
+    if pd.notnull(cur_row["date_field"]):
+        date_field = cur_row["date_field"]
+        start = reduce_dates(table.table, date_field)
+        if years!=[opd.defs.MULTI]:
+            table = src.load(year=years[-1], table_type=cur_row["TableType"], url=cur_row['URL'], id=cur_row['dataset_id'])
+            end = reduce_dates(table.table, date_field)
         else:
-            cols.append(c)
-
-    df = df.sort_values(by=cols)
-    df = df.drop_duplicates(subset=cols, keep=False, ignore_index=True)
-
-def update_dates(kstart=0):
+            end = start
+
+        coverage_start, coverage_end = date_range_coverage(start, end)
+    else:
+        # Attempt to find date column
+        dt_col = [x for x in table.table.columns if "date" in x.lower()]
+        if len(dt_col)>1:
+            raise NotImplementedError()
+        elif len(dt_col)==0:
+            dt_col = [x for x in table.table.columns if "year" in x.lower()]
+            if len(dt_col)>1:
+                raise NotImplementedError()
+            elif len(dt_col)==0:
+                return None
+            else:
+                dt_col = dt_col[0]
+                min_year = table.table[dt_col].min()
+                max_year = table.table[dt_col].max()
+                coverage_start = "01/01/{}".format(min_year)
+                coverage_end = "12/31/{}".format(max_year)
+        else:
+            dt_col = dt_col[0]
+            date_formats = date_formats if date_formats is not None else DateFormatCache()
+            if isinstance(table.table[dt_col],str):
+                raise NotImplementedError()
+            else:
+                table.table[dt_col] = date_formats.to_datetime(table.table[dt_col], cur_row["source_table_id"], dt_col)
+                min_val = table.table[dt_col].min()
+                if not isinstance(min_val, str):
+                    min_val = min_val.strftime('%m/%d/%Y')
+                coverage_start = min_val
+
+                if years[-1]!=years_req:
+                    table = src.load(year=years[-1], table_type=cur_row["TableType"], url=cur_row['URL'], id=cur_row['dataset_id'])
+                    table.table[dt_col] = date_formats.to_datetime(table.table[dt_col], cur_row["source_table_id"], dt_col)
+                max_val = table.table[dt_col].max()
+                if not isinstance(max_val, str):
+                    max_val = max_val.strftime('%m/%d/%Y')
+                coverage_end = max_val
+
+    return coverage_start, coverage_end
+
+def update_dates(kstart=0, scheduled=False, max_minutes=None, max_probes=None, full=False, workers=None):
+    '''Update coverage dates in the source table
+
+    kstart: Index of first row to check. Ignored if scheduled is True.
+    scheduled: If True, only check rows that are due based on how often they are updated, most overdue first
+    max_minutes: Maximum run time
+    max_probes: Maximum number of requests for the data of MULTIPLE year rows. Skipped rows are not counted.
+    full: If True, also check rows whose coverage cannot change (past single years, Stanford, and deleted datasets)
+    workers: If set, MULTIPLE year Excel files are downloaded on threads and parsed in a pool of this many processes
+    '''
     import stanford
 
+    breaker = HostCircuitBreaker.from_outages()
+    year_cache = YearSpanCache()
+    date_formats = DateFormatCache()
+    metrics = RunMetrics("update_dates")
+
     skip = []
     run = None
 
@@ -47,7 +206,7 @@ def update_dates(kstart=0):
     if src_file is not None:
         opd.datasets.reload(src_file)
     df = opd.datasets.query()
-    df_stanford = stanford.get_stanford()
+    df_stanford = None
 
     downloadable_file = "Downloadable File"
     data_type_to_access_type = {"Socrata":"API", "ArcGIS":"API","CSV":downloadable_file,"Excel":downloadable_file,"Carto":"API",
@@ -72,9 +231,53 @@ def update_dates(kstart=0):
     df['coverage_start'] = df['coverage_start'].dt.strftime('%m/%d/%Y')
     df['coverage_end'] = df['coverage_end'].dt.strftime('%m/%d/%Y')
 
+    violations = validate_table.validate(df)
+    coverage_issues = coverage_index.CoverageIndex(df).report()
+    history = scheduler.load_history()
+    budget = scheduler.Budget(max_seconds=max_minutes*60 if max_minutes else None, max_probes=max_probes)
+    if scheduled:
+        order = scheduler.due_rows(df, history)
+        print(f"{len(order)} of {len(df)} rows are due for a coverage check")
+    else:
+        order = df.index
+
+    if not full:
+        immutable = scheduler.classify_immutable(df)
+        for reason, count in immutable[immutable!=""].value_counts().items():
+            print(f"Skipping {count} {reason} rows whose coverage cannot change (use --full to check them)")
+        order = order[(immutable[order]=="").to_numpy()]
+
+    changes = UpstreamChanges()
+    rows = df.loc[order if scheduled else order[order>=kstart]]
+    rows = rows[rows["Year"]==opd.defs.MULTI]
+    # Rows after the first max_probes would not be checked in this run. Requests of the sweep are charged to the budget.
+    rows = rows.iloc[:max_probes] if max_probes else rows
+    updated = changes.sweep(rows, breaker, budget)
+    if not full:
+        unchanged = changes.unchanged(df.loc[order], updated)
+        if unchanged.any():
+            print(f"Skipping {unchanged.sum()} rows whose data has not been updated since they were last checked")
+        order = order[~unchanged.to_numpy()]
+
+    prefetched = {}
+    executor = FileExecutor(cpu_workers=workers) if workers else None
+    if executor is not None:
+        to_check = order if scheduled else order[order>=kstart]
+        # Only MULTIPLE year rows are charged to the budget
+        multi = df.loc[to_check, "Year"]==opd.defs.MULTI
+        to_check = to_check[multi.to_numpy()]
+        to_check = to_check[:max_probes] if max_probes else to_check
+        rows = df.loc[to_check]
+        rows = rows[(rows["DataType"]=="Excel") & (rows["Year"]==opd.defs.MULTI) & rows["date_field"].notnull() & \
+                    ~rows["URL"].str.contains("stanford.edu", regex=False)]
+        # Rows of hosts that are not closed are checked in the loop below, where a half-open host gets its single trial
+        rows = rows[rows["URL"].map(breaker.state)==CLOSED]
+        prefetched = executor.submit_rows(rows, "dates")
+        print(f"Parsing {len(prefetched)} Excel rows from {rows['URL'].nunique()} files in {workers} processes")
+
     min_year = 1990
-    for k in df.index:
-        if k<kstart:
+    for k in order:
+        if not scheduled and k<kstart:
             continue
         cur_row = df.loc[k]
 
@@ -83,439 +286,277 @@ def update_dates(kstart=0):
         if run is not None and (cur_row["SourceName"], cur_row["TableType"]) not in run:
             continue
 
+        if budget.exhausted():
+            print(f"Stopping after {budget.probes} probes in {budget.elapsed()/60:.1f} minutes. Budget is exhausted.")
+            break
+
         print("{}: {} {} for year {}".format(k, cur_row["SourceName"], cur_row["TableType"], cur_row["Year"]))
+        probe = "stanford" if "stanford.edu" in cur_row["URL"] else "multi" if cur_row["Year"] == opd.defs.MULTI else "year"
+        with metrics.span(probe, url=cur_row["URL"], data_type=cur_row["DataType"], source_table_id=cur_row["source_table_id"],
+                          row=int(k), prefetched=k in prefetched) as span:
+
+            if "stanford.edu" in df.loc[k,"URL"]:
+                if df_stanford is None:
+                    df_stanford = stanford.get_stanford()
+                match = (df_stanford["state"]==cur_row["State"]) & \
+                    (df_stanford["source"].isin([cur_row["SourceName"],cur_row["SourceName"].replace("Police",'Patrol')])) & \
+                    (df_stanford["agency"].isin([cur_row["Agency"], cur_row["Agency"].replace("Police",'Patrol')]))
+                if match.sum()==0 and cur_row["SourceName"]=='Charlotte-Mecklenburg':
+                    match = df_stanford["source"] == 'Charlotte'
+                if match.sum()!=1:
+                    raise ValueError("Unable to find the correct # of Stanford matches")
+                coverage_start = df_stanford[match]["start_date"].iloc[0].strftime('%m/%d/%Y')
+                coverage_end = df_stanford[match]["end_date"].iloc[0].strftime('%m/%d/%Y')
 
-        if "stanford.edu" in df.loc[k,"URL"]:
-            match = (df_stanford["state"]==cur_row["State"]) & \
-                (df_stanford["source"].isin([cur_row["SourceName"],cur_row["SourceName"].replace("Police",'Patrol')])) & \
-                (df_stanford["agency"].isin([cur_row["Agency"], cur_row["Agency"].replace("Police",'Patrol')]))
-            if match.sum()==0 and cur_row["SourceName"]=='Charlotte-Mecklenburg':
-                match = df_stanford["source"] == 'Charlotte'
-            if match.sum()!=1:
-                raise ValueError("Unable to find the correct # of Stanford matches")
-            coverage_start = df_stanford[match]["start_date"].iloc[0].strftime('%m/%d/%Y')
-            coverage_end = df_stanford[match]["end_date"].iloc[0].strftime('%m/%d/%Y')
+            else:
+                src = opd.Source(cur_row["SourceName"], cur_row["State"], agency=cur_row["Agency"])
 
-        else:
-            src = opd.Source(cur_row["SourceName"], cur_row["State"], agency=cur_row["Agency"])
-
-            if cur_row["Year"] == opd.defs.NA:
-                continue
-            elif cur_row["Year"] == opd.defs.MULTI:
-                # Manually get years since get years gets years for all datasets
-                try:
-                    loader = src._Source__get_loader(opd.defs.DataType(cur_row["DataType"]), cur_row["URL"], cur_row['query'], 
-                                            dataset=cur_row["dataset_id"],
-                                            date_field=cur_row["date_field"], agency_field=cur_row["agency_field"])
-                except opd.exceptions.OPD_DataUnavailableError:
+                if cur_row["Year"] == opd.defs.NA:
+                    span["outcome"] = "skipped"
                     continue
-                
-                if cur_row['DataType'] in ["Excel",'CSV']:
-                    years = [opd.defs.MULTI]
-                else:
+                elif cur_row["Year"] == opd.defs.MULTI:
+                    if not breaker.allow(cur_row["URL"]):
+                        print(f"Skipping {cur_row['URL']}: circuit breaker is open for host {host_of(cur_row['URL'])}")
+                        span["outcome"] = "skipped"
+                        continue
+                    # Only requests for the data are charged. Skipped rows stay due and are retried in the next run.
+                    budget.charge()
                     try:
-                        years = loader.get_years()
-                    except (opd.exceptions.OPD_SocrataHTTPError, opd.exceptions.OPD_DataUnavailableError):
+                        coverage = get_multi_coverage(src, cur_row, data_type_to_access_type[cur_row["DataType"]], min_year, breaker, year_cache,
+                                                      prefetched.pop(k, None), updated.get(k), date_formats, metrics.session)
+                    except Exception as e:
+                        if not is_host_failure(e):
+                            raise
+                        breaker.record_failure(cur_row["URL"], e)
+                        warnings.warn(f'Unable to reach {host_of(cur_row["URL"])} for {cur_row["SourceName"]} {cur_row["TableType"]}: {e}')
+                        span["outcome"] = "host_failure"
+                        span["error"] = type(e).__name__
                         continue
-                    years.sort()
-                    years = [x for x in years if x >= min_year]
-
-                if len(years)==0:
-                    warnings.warn(f'No years found for {cur_row["SourceName"]}, {cur_row["State"]} {cur_row["TableType"]}')
-                    continue
+                    if coverage is None:
+                        breaker.release(cur_row["URL"])
+                        span["outcome"] = "no_data"
+                        continue
+                    breaker.record_success(cur_row["URL"])
+                    coverage_start, coverage_end = coverage
+                else:
+                    coverage_start = "01/01/{}".format(cur_row["Year"])
+                    coverage_end = "12/31/{}".format(cur_row["Year"])
+
+            # The check finished (whether or not the coverage changed), so the row is not due until its next interval
+            scheduler.record_probe(history, cur_row["source_table_id"])
+
+            start_changed = False
+            if pd.to_datetime(coverage_start) < pd.to_datetime(df.loc[k,"coverage_start"]):
+                start_changed = True
+                df.loc[k,"coverage_start"] = coverage_start
+            elif pd.to_datetime(df.loc[k,"coverage_start"]) == pd.to_datetime(coverage_start):
+                pass
+            elif pd.to_datetime(coverage_start) > pd.to_datetime(df.loc[k,"coverage_start"]):
+                start_changed = True
+                warnings.warn(f'Coverage start increased from {df.loc[k,"coverage_start"]} to {coverage_start}')
+                df.loc[k,"coverage_start"] = coverage_start
+            else:
+                throw_error = True
+                if throw_error:
+                    raise ValueError("Start")
+
+            end_changed = False
+            if pd.to_datetime(coverage_end) > pd.to_datetime(df.loc[k,"coverage_end"]) or \
+                (pd.isnull(pd.to_datetime(df.loc[k,"coverage_end"])) and not pd.isnull(pd.to_datetime(coverage_end))):
+                end_changed = True
+                df.loc[k,"coverage_end"] = coverage_end
+            elif  pd.to_datetime(df.loc[k,"coverage_end"]) == pd.to_datetime(coverage_end):
+                pass
+            elif pd.to_datetime(coverage_end) < pd.to_datetime(df.loc[k,"coverage_end"]):
+                end_changed = True
+                warnings.warn(f'Coverage end decreased from {df.loc[k,"coverage_end"]} to {coverage_end}')
+                df.loc[k,"coverage_end"] = coverage_end
+            else:
+                raise ValueError("Stop")
 
-                nrows = 1 if data_type_to_access_type[cur_row["DataType"]]=="API" else None
+            span["outcome"] = "changed" if start_changed or end_changed else "unchanged"
+            changes.record(cur_row["source_table_id"], updated.get(k))
+            if end_changed:
+                scheduler.record_change(history, cur_row["source_table_id"], df.loc[k,"coverage_end"])
 
-                # For if case, assuming 1st year might be a mistake
-                years_req = years[:2] if len(years)>1 and years[1]-years[0]>5 else years[0]
+            if start_changed or end_changed:
+                df.loc[k, "last_coverage_check"] = datetime.now().strftime('%m/%d/%Y')
 
-                if nrows==1:
-                    assert pd.notnull(cur_row["date_field"])
+                assert df['coverage_start'].apply(lambda x: pd.isnull(x) or isinstance(x,str)).all()
+                assert df['coverage_end'].apply(lambda x: pd.isnull(x) or isinstance(x,str)).all()
 
-                try:
-                    table = src.load(year=years_req, table_type=cur_row["TableType"], nrows=nrows, url=cur_row['URL'], id=cur_row['dataset_id'],
-                                    sortby='date')
-                except opd.exceptions.OPD_MinVersionError:
-                    continue
-                if len(table.table)==0:
-                    raise ValueError("No records found in first year")
-                
-                if pd.notnull(cur_row["date_field"]):
-                    date_field = cur_row["date_field"]
-                    min_val = table.table[date_field].min()
-                    if isinstance(min_val, pd.Timestamp) and min_val.year<2000 and len(table.table)>1 and \
-                        table.table[date_field].nsmallest(2).iloc[1].year - min_val.year > 5:
-                        min_val = table.table[date_field].nsmallest(2).iloc[1]
-                    if not isinstance(min_val, str):
-                        min_val = min_val.strftime('%m/%d/%Y')
-                    coverage_start = min_val
-
-                    if years!=[opd.defs.MULTI]:
-                        table = src.load(year=years[-1], table_type=cur_row["TableType"], url=cur_row['URL'], id=cur_row['dataset_id'])
-
-                    col = table.table[date_field][table.table[date_field].apply(lambda x: not isinstance(x,str))]
-                    if len(col)==0:
-                        col = pd.to_datetime(table.table[date_field])
-                    try:
-                        max_val = col.max()
-                    except TypeError:
-                        col = col[col.apply(lambda x: isinstance(x, pd.Timestamp))]
-                        max_val = col.max()
-
-                    if not isinstance(max_val, str):
-                        max_val = max_val.strftime('%m/%d/%Y')
-                    coverage_end = max_val
-                else:
-                    # Attempt to find date column
-                    dt_col = [x for x in table.table.columns if "date" in x.lower()]
-                    if len(dt_col)>1:
-                        raise NotImplementedError()
-                    elif len(dt_col)==0:
-                        dt_col = [x for x in table.table.columns if "year" in x.lower()]
-                        if len(dt_col)>1:
-                            raise NotImplementedError()
-                        elif len(dt_col)==0:
-                            continue
-                        else:
-                            dt_col = dt_col[0]
-                            min_year = table.table[dt_col].min()
-                            max_year = table.table[dt_col].max()
-                            coverage_start = "01/01/{}".format(min_year)
-                            coverage_end = "12/31/{}".format(max_year)
-                    else:
-                        dt_col = dt_col[0]
-                        if isinstance(table.table[dt_col],str):
-                            raise NotImplementedError()
-                        else:
-                            table.table[dt_col] = pd.to_datetime(table.table[dt_col], format='mixed')
-                            min_val = table.table[dt_col].min()
-                            if not isinstance(min_val, str):
-                                min_val = min_val.strftime('%m/%d/%Y')
-                            coverage_start = min_val
-
-                            if years[-1]!=years_req:
-                                table = src.load(year=years[-1], table_type=cur_row["TableType"], url=cur_row['URL'], id=cur_row['dataset_id'])
-                            max_val = table.table[dt_col].max()
-                            if not isinstance(max_val, str):
-                                max_val = max_val.strftime('%m/%d/%Y')
-                            coverage_end = max_val
-            else:
-                coverage_start = "01/01/{}".format(cur_row["Year"])
-                coverage_end = "12/31/{}".format(cur_row["Year"])
-
-        start_changed = False
-        if pd.to_datetime(coverage_start) < pd.to_datetime(df.loc[k,"coverage_start"]):
-            start_changed = True
-            df.loc[k,"coverage_start"] = coverage_start
-        elif pd.to_datetime(df.loc[k,"coverage_start"]) == pd.to_datetime(coverage_start):
-            pass
-        elif pd.to_datetime(coverage_start) > pd.to_datetime(df.loc[k,"coverage_start"]):
-            start_changed = True
-            warnings.warn(f'Coverage start increased from {df.loc[k,"coverage_start"]} to {coverage_start}')
-            df.loc[k,"coverage_start"] = coverage_start
-        else:
-            throw_error = True
-            if throw_error:
-                raise ValueError("Start")
-
-        end_changed = False
-        if pd.to_datetime(coverage_end) > pd.to_datetime(df.loc[k,"coverage_end"]) or \
-            (pd.isnull(pd.to_datetime(df.loc[k,"coverage_end"])) and not pd.isnull(pd.to_datetime(coverage_end))):
-            end_changed = True
-            df.loc[k,"coverage_end"] = coverage_end
-        elif  pd.to_datetime(df.loc[k,"coverage_end"]) == pd.to_datetime(coverage_end):
-            pass
-        elif pd.to_datetime(coverage_end) < pd.to_datetime(df.loc[k,"coverage_end"]):
-            end_changed = True
-            warnings.warn(f'Coverage end decreased from {df.loc[k,"coverage_end"]} to {coverage_end}')
-            df.loc[k,"coverage_end"] = coverage_end
-        else:
-            raise ValueError("Stop")
-
-        if start_changed or end_changed:
-            df.loc[k, "last_coverage_check"] = datetime.now().strftime('%m/%d/%Y')
-
-            assert df['coverage_start'].apply(lambda x: pd.isnull(x) or isinstance(x,str)).all()
-            assert df['coverage_end'].apply(lambda x: pd.isnull(x) or isinstance(x,str)).all()
-
-            # df['coverage_start'] = df['coverage_start'].dt.strftime('%m/%d/%Y')
-            # df['coverage_end'] = df['coverage_end'].dt.strftime('%m/%d/%Y')
-
-            df_save = df.copy()
-            df_save['dataset_id'] = df_save['dataset_id'].apply(lambda x: json.dumps(x) if type(x) in [list, dict] else x)
-            df_save.to_csv(src_file, index=False)
-
-agency_types = ['Police',"Sheriffs", 'St Prison for Women',"St Prison",
-                "St Hospital", "Probation", "Department of Corrections",'Health Care Facility','Medical Facility',
-                'Department of Public Safety','Community Correctional Facility', 'Prison', 
-                'Department of Forestry & Fire Protection','Department of Parks & Recreation','Transit',
-                'Unified School District Police','Sheriff','Forest Preserve Police',
-                'Park District Police','University Police','Illinois University Police',
-                'Transit Administration Police', 'District Attorney']
-agency_types.sort(key=len, reverse=True)
-agency_types = [x.title() for x in agency_types]
-agency_types = [re.sub(r"s\s",' ',x) for x in agency_types]
-
-p = re.compile(r"\s("+"|".join(agency_types)+r").*$", re.IGNORECASE)
-def count_agencies():
-    from rapidfuzz import fuzz
-    ca_state_prison = "California St Prison"
-    st_univ_police = 'St University Police'
-
-    def clean(x):
-        return p.sub("", x).strip()
-    
-    def add_agency(agency_name_orig, state, agencies):
-        agency_name = agency_name_orig.strip().title()\
-                                 .replace("Allegany","Alleghany")\
-                                 .replace(" Co. ", " County ")\
-                                 .replace(" So"," Sheriff").title()
-        agency_name = re.sub('(.+) \\1', '\\1', agency_name)
-
-        agency_name = re.sub(r"['’]?s?\s*(Department|Office|dept\.?)", "", agency_name, flags=re.IGNORECASE)
-        agency_name = re.sub(r'\sPD\b',r' Police',agency_name, flags=re.IGNORECASE)
-        agency_name = re.sub(r"(\w+)pd",'\\1 Police', agency_name.lower(), flags=re.IGNORECASE)
-        agency_name = re.sub(r"\sSd$",r" Sheriff",agency_name, flags=re.IGNORECASE)
-        agency_name = re.sub(r"\sDa$",r" District Attorney",agency_name, flags=re.IGNORECASE)
-        agency_name = re.sub(r"P(oli|rin)$",r"Police",agency_name)
-        agency_name = re.sub('Csp Troop [A-Z]','Connecticut St Police',agency_name)
-        agency_name = re.sub(r'\s+',' ',agency_name)
-        agency_name = re.sub(r'\buniv\.?\b','university',agency_name, flags=re.IGNORECASE)
-        # agency_name = re.sub(r"('s|s|')\s",' ',agency_name.lower())
-        agency_name = re.sub(r"\sco\.?(?=\s|$)",' county',agency_name)
-        # Both saint and state can be abbreviated st so just convert to abbreviation
-        agency_name = re.sub(r"\b(state|saint)\b", "st", agency_name,  flags=re.IGNORECASE)
-        agency_name = re.sub(r"\s*\#?\s*\d+$", "", agency_name)  # Remove any numbers at the end that may indicate parts of a larger org
-        agency_name = agency_name.replace("-",' ').replace(',','')
-        agency_name = agency_name.title()
-        agency = clean(agency_name)
-        reduced_agencies = [x[0] for x in agencies if x[1]==state]
-        cleaned_agencies = [clean(x) for x in reduced_agencies]
-        cur_type = [x for x in agency_types if x in agency_name]
-        cur_type = cur_type[0] if len(cur_type)>0 else None
-        matches = [x.replace('-',' ')==agency.replace('-',' ') for x in cleaned_agencies]
-        if len([m.start() for m in re.finditer('department', agency_name, re.IGNORECASE)])>1:
-            # Word department is repeated. String likely contains multiple departments or same one repeated
-            return
-        if any(matches):
-            full_names = [x for x,y in zip(reduced_agencies, matches) if y]
-            match_types = []
-            for y in full_names:
-                full_type = [x for x in agency_types if x in y]
-                match_types.append(full_type[0] if len(full_type)>0 else None)
-            if any([x.replace('-',' ') == agency_name.replace('-',' ') for x in full_names]) or \
-                full_names[0].lower().replace(" ", "").startswith(agency_name.replace(" ", "").lower()):
-                return
-            elif cur_type is not None and all([x is not None and (w.startswith(ca_state_prison) or x!=cur_type) for w,x in zip(full_names,match_types)]):
-                agencies.append((agency_name,state))
-            elif agency_name.startswith(st_univ_police) and all([x.startswith(st_univ_police) and \
-                    x.replace(st_univ_police,'').strip() != agency_name.replace(st_univ_police,'').strip() for x in full_names]):
-                agencies.append((agency_name,state))
-            elif len(full_names) != 1:
-                if agency_name.startswith(ca_state_prison) and \
-                    all([x.startswith(ca_state_prison) and x.split(',')[1] != agency_name.split(',')[1] for x in full_names]):
-                    agencies.append((agency_name,state))
-                # elif any(['Departmentuthern' in x for x in full_names]):
-                #     return
-                else:
-                    return
-            else:
-                full_type = [x for x in agency_types if x in full_names[0]]
-                if cur_type is not None and len(full_type)>=1 and cur_type!=full_type[0] and \
-                    full_names[0].replace(full_type[0],cur_type) == agency_name:
-                    agencies.append((agency_name,state))
-                elif (full_names[0].startswith(ca_state_prison) and agency_name.startswith(ca_state_prison) and \
-                    full_names[0].split(',')[1] != agency_name.split(',')[1]) or \
-                        full_names[0].startswith(ca_state_prison) + agency_name.startswith(ca_state_prison)==1:
-                    agencies.append((agency_name,state))
-                elif full_names[0].startswith(st_univ_police) and agency_name.startswith(st_univ_police) and \
-                    full_names[0].replace(st_univ_police,'').strip() != agency_name.replace(st_univ_police,'').strip():
-                    agencies.append((agency_name,state))
-                elif agency_name.split('-')[0].strip() == full_names[0]:
-                    pass
-                elif (full_names[0].startswith(agency_name) and cur_type is None):
-                    pass
-                elif agency_name.startswith(full_names[0]) and len(full_type)==0:
-                    k = [k for k,x in enumerate(agencies) if x==(full_names[0],state)][0]
-                    agencies[k] = (agency_name,state)
-                elif agency_name.startswith(full_names[0]) and '-' in agency_name_orig:
-                    # This was found when 2 departments were concatenated with a -
-                    pass
-                else:
-                    return
-        else:
-            def fuzzclean(x):
-                return x.replace("County","").replace("University Of","")
-            ratios = [fuzz.ratio(fuzzclean(agency), fuzzclean(x)) for x in cleaned_agencies]
-            if len(ratios)> 0 and max(ratios)>86:
-                high_scoring = [x for x,y in zip(cleaned_agencies, ratios) if y==max(ratios)]
-                if high_scoring[0]=="Chico" and agency=="Chino":
-                    return
-                r = [x for x,y in zip(reduced_agencies,cleaned_agencies) if y in high_scoring]
-                match_types = []
-                for y in r:
-                    full_type = [x for x in agency_types if x in y]
-                    match_types.append(full_type[0] if len(full_type)>0 else None)
-                keep = [cur_type is None or x is None or x==cur_type for x in match_types]
-                match_types = [x for x,y in zip(match_types, keep) if y]
-                r = [x for x,y in zip(r, keep) if y]
-                if len(r)==0:
-                    agencies.append((agency_name,state))
-                elif len(r)>0 and cur_type is not None and \
-                    any([y is not None and y==cur_type and fuzz.ratio(agency_name, x)>98 for x,y in zip(r,match_types)]):
-                    return
-                elif len(r)==1:
-                    if agency.replace("Women","Men")==r[0] or\
-                        agency_name.replace("Park","Beach")==r[0] or\
-                        agency.replace("Center","Institution")==r[0] or \
-                        agency_name.replace("County ","")==r[0] or \
-                        ((a:=re.match(r"Sant?a?\s([A-Z][a-z]+)", agency_name)) and (b:=re.match(r"Sant?a?\s([A-Z][a-z]+)", r[0])) and a.group(1)!=b.group(1)) or \
-                        (len(agency_name) > len(r[0]) and r[0]==agency_name[-len(r[0]):]):
-                        agencies.append((agency_name,state))
-                    elif (agency_name.startswith('Willisville') and len(r)==1 and r[0].startswith('Williamsville')):
-                        agencies.append((agency_name,state))
-                    elif (agency_name.startswith(r[0]) and len(r[0])>=35) or \
-                        agency_name in ["Towsonu",] or \
-                        " " not in agency_name and r[0].startswith(agency_name+" ") or \
-                        r[0].lower().replace(" ", "").startswith(agency_name.lower()):
-                        return
-                    else:
-                        words1 = agency_name.split()
-                        words2 = r[0].split()
-                        k1 = k2 = 0
-                        while k1<len(words1) and k2<len(words2):
-                            if words1[k1]==words2[k2]:
-                                words1.pop(k1)
-                                words2.pop(k2)
-                            else:
-                                break
-                        k1 = len(words1)-1
-                        k2 = len(words2)-1
-                        while k1>=0 and k2>=0:
-                            if words1[k1]==words2[k2]:
-                                words1.pop(k1)
-                                words2.pop(k2)
-                                k1-=1
-                                k2-=1
-                            else:
-                                break
-                        w1 = " ".join(words1)
-                        w2 = " ".join(words2)
-                        score = fuzz.ratio(w1, w2)
-                        if score==0:
-                            if agency_name.split()==1:
-                                raise NotImplementedError()
-                            else:
-                                agencies.append((agency_name,state))
-                        elif score<90:
-                            agencies.append((agency_name,state))
-                        else:
-                            return
-                elif (cur_type is not None and all([x is not None and (w.startswith(ca_state_prison) or x!=cur_type) for w,x in zip(r,match_types)])) or \
-                    (a:=re.match(r"Lo\s([A-Z][a-z]+)", agency_name)) and all([(b:=re.match(r"Lo\s([A-Z][a-z]+)", d)) and a.group(1)!=b.group(1) for d in r]):
-                    agencies.append((agency_name,state))
-                elif agency_name=="Prince George Police" or \
-                    " " not in agency_name and r[0].startswith(agency_name+" ") or \
-                    r[0].lower().replace(" ", "").startswith(agency_name.lower()):
-                    # Should be County PD
-                    return
-                elif 'forest ranger' in agency_name.lower():
-                    return
-                else:
-                    print(f"{agency_name_orig} is unknown")
-                    return
-                # elif all([("county" in agency_name.lower())+("county" in x.lower())==1 for x in high_scoring]):
-                #     agencies.append((agency_name,state))
-            else:
-                agencies.append((agency_name,state))
+                # df['coverage_start'] = df['coverage_start'].dt.strftime('%m/%d/%Y')
+                # df['coverage_end'] = df['coverage_end'].dt.strftime('%m/%d/%Y')
 
+                df_save = df.copy()
+                df_save['dataset_id'] = df_save['dataset_id'].apply(lambda x: json.dumps(x) if type(x) in [list, dict] else x)
+                violations = validate_table.warn_new_violations(violations, df_save)
+                coverage_issues = coverage_index.warn_new_issues(coverage_issues, df_save)
+                df_save.to_csv(src_file, index=False)
+                scheduler.save_history(history)
+                year_cache.save()
+                date_formats.save()
+                changes.save()
+
+    if executor is not None:
+        executor.shutdown()
+    metrics.close()
+    scheduler.save_history(history)
+    year_cache.save()
+    date_formats.save()
+    changes.save()
+    metrics.print_summary()
+    if breaker.open_hosts():
+        print("Hosts skipped by circuit breaker:\n" + breaker.summary())
+
+def count_agencies(workers=None, rebuild=False):
+    '''Count the agencies in the source table, including those in datasets containing multiple agencies
+
+    Agencies are stored in an AgencyRegistry, and only rows that are new or changed since the last run are read.
+    Agencies of rows that were deleted from the table are removed.
+
+    workers: If set, Excel files are downloaded on threads and parsed in a pool of this many processes
+    rebuild: If True, the registry is rebuilt from all rows
+    '''
     src_file = r"opd_source_table.csv"
     if src_file is not None:
         opd.datasets.datasets =opd. datasets._build(src_file)
     datasets = opd.datasets.query()
 
     output_dir = os.path.join('.','data')
+    metrics = RunMetrics("count_agencies")
 
-    agencies = []
-    for k in range(len(datasets)):
-        if datasets['Agency'][k] not in [opd.defs.MULTI, opd.defs.NA]:
-            if (datasets['AgencyFull'][k],datasets['State'][k]) not in agencies:
-                add_agency(datasets['AgencyFull'][k], datasets['State'][k], agencies)
-                # def clean(x):
-                #     return p.sub("", x)
-                
-                # agency = clean(datasets['AgencyFull'][k])
-                # cleaned_agencies = [clean(x[0]) for x in agencies if x[1]==datasets['State'][k]]
-                # matches = [x==agency for x in cleaned_agencies]
-                # if any(matches):
-                #     raise NotImplementedError()
-                # else:
-                #     ratios = [fuzz.ratio(agency, x) for x in cleaned_agencies]
-                #     if len(ratios)> 0 and max(ratios)>77:
-                #         high_scoring = [x for x,y in zip(cleaned_agencies, ratios) if y==max(ratios)]
-                #         raise NotImplementedError()
-                #     else:
-                #         agencies.append((datasets['AgencyFull'][k],datasets['State'][k]))
+    registry = AgencyRegistry(rebuild=rebuild)
+    breaker = HostCircuitBreaker.from_outages()
+    removed = registry.prune(datasets['source_table_id'])
+    if len(removed) > 0:
+        print(f"Removed {len(removed)} rows that are no longer in the source table from the agency registry")
+    current = datasets.apply(registry.is_current, axis=1)
+    print(f"Agencies of {current.sum()} of {len(datasets)} rows are up to date")
 
     for k in range(len(datasets)):
-        if datasets['Agency'][k] == opd.defs.MULTI and datasets['State'][k] != opd.defs.MULTI:
-            now = datetime.now().strftime("%d.%b %Y %H:%M:%S")
-            print(f"{now} Testing {k} of {len(datasets)-1}: {datasets.iloc[k]['SourceName']} {datasets.iloc[k]['TableType']} table")
-
-            src = opd.Source(datasets['SourceName'][k], datasets['State'][k], agency=datasets["Agency"][k])
-            csv_filename = src.get_csv_filename(datasets['Year'][k], output_dir, datasets.iloc[k]["TableType"], 
-                     url=datasets.iloc[k]['URL'], id=datasets.iloc[k]['dataset_id'])
-            output_file = csv_filename.replace('.csv','.txt')
-            if datasets['Year'][k]!=opd.defs.MULTI and datasets['Year'][k]!=opd.defs.NA and datasets['Year'][k] < datetime.now().year and \
-                os.path.exists(output_file):
-                with open(output_file) as f:
-                    new_agencies = [x.strip() for x in f.readline().split(',')]
-
-            elif datasets['DataType'][k] in ["CSV"]:
-                t = src.load(datasets['TableType'][k], datasets['Year'][k], url=datasets['URL'][k], id=datasets['dataset_id'][k])
-                new_agencies = t.table[datasets['agency_field'][k]].unique()
-                if datasets['agency_field'][k] == "ORI":
-                    if datasets['Year'][k]<=2020:
-                        data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2022-08/URSUS_ORI-Agency_Names_20210902.xlsx","Agency","ORI_Number",pd.read_excel)
-                    elif datasets['Year'][k]==2021:
-                        data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2022-08/UseofForce_ORI-Agency_Names_2021.csv","AGENCY_NAME","ORI", pd.read_csv)
-                    elif datasets['Year'][k]==2022:
-                        data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2023-06/UseofForce_ORI-Agency_Names_2022f.csv","AGENCY_NAME","ORI", pd.read_csv)
-                    elif datasets['Year'][k]==2023:
-                        data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2024-07/UseofForce_ORI-Agency_Names_2023.csv","AGENCY_NAME","ORI", pd.read_csv)
-                    else:
-                        raise ValueError("Unknown dataset")
-                    try:
-                        ori_df = data[3](data[0])
-                    except urllib.error.URLError as e:
-                        with opd.data_loaders.get_legacy_session() as session:
-                            r = session.get(data[0])
-                            
-                        r.raise_for_status()
-                        file_like = BytesIO(r.content)
-                        ori_df = data[3](file_like)
-                    except:
-                        raise
-                    for j in range(len(new_agencies)):
-                        match = ori_df[data[1]][ori_df[data[2]] == new_agencies[j]]
-                        if len(match)!=1:
-                            raise NotImplementedError()
+        if datasets['Agency'][k] not in [opd.defs.MULTI, opd.defs.NA] and not current[k]:
+            registry.add_row(datasets.loc[k], [datasets['AgencyFull'][k]])
+
+    prefetched = {}
+    executor = FileExecutor(cpu_workers=workers) if workers else None
+    if executor is not None:
+        multi = datasets[(datasets['Agency']==opd.defs.MULTI) & (datasets['State']!=opd.defs.MULTI) & \
+                         (datasets['DataType']=="Excel") & datasets['agency_field'].notnull() & ~current]
+        needed = []
+        for k, row in multi.iterrows():
+            year = row['Year']
+            if year not in [opd.defs.MULTI, opd.defs.NA] and year < datetime.now().year:
+                src = opd.Source(row['SourceName'], row['State'], agency=row['Agency'])
+                output_file = src.get_csv_filename(year, output_dir, row["TableType"], url=row['URL'], id=row['dataset_id']).replace('.csv','.txt')
+                if os.path.exists(output_file):
+                    # Agencies will be read from the previous output
+                    continue
+            needed.append(k)
+        # Rows that share a file (e.g. files of a zip file) are downloaded and opened once
+        prefetched = executor.submit_rows(multi.loc[needed].drop(columns='date_field'), "agencies")
+
+    try:
+        for k in range(len(datasets)):
+            if datasets['Agency'][k] == opd.defs.MULTI and datasets['State'][k] != opd.defs.MULTI and not current[k]:
+                now = datetime.now().strftime("%d.%b %Y %H:%M:%S")
+                print(f"{now} Testing {k} of {len(datasets)-1}: {datasets.iloc[k]['SourceName']} {datasets.iloc[k]['TableType']} table")
+
+                with metrics.span("agencies", url=datasets['URL'][k], data_type=datasets['DataType'][k],
+                                  source_table_id=datasets['source_table_id'][k], row=k) as span:
+                    src = opd.Source(datasets['SourceName'][k], datasets['State'][k], agency=datasets["Agency"][k])
+                    csv_filename = src.get_csv_filename(datasets['Year'][k], output_dir, datasets.iloc[k]["TableType"], 
+                             url=datasets.iloc[k]['URL'], id=datasets.iloc[k]['dataset_id'])
+                    output_file = csv_filename.replace('.csv','.txt')
+                    if datasets['Year'][k]!=opd.defs.MULTI and datasets['Year'][k]!=opd.defs.NA and datasets['Year'][k] < datetime.now().year and \
+                        os.path.exists(output_file):
+                        span["probe"] = "previous_output"
+                        with open(output_file) as f:
+                            new_agencies = [x.strip() for x in f.readline().split(',')]
+
+                    elif datasets['DataType'][k] in ["CSV"]:
+                        if distinct_agencies.supported(datasets.loc[k]):
+                            # Only the agency column is read
+                            span["probe"] = "distinct"
+                            new_agencies = distinct_agencies.fetch(datasets.loc[k], metrics.session)
                         else:
-                            new_agencies[j] = match.iloc[0]
-            else:
-                # ds_filter, _ = src._Source__filter_for_source(datasets['TableType'][k], datasets.iloc[k]["Year"], None, None, errors=False)
-                # url_contains = datasets.iloc[k]['URL'] if isinstance(ds_filter,pd.DataFrame) and len(ds_filter)>1 else None
-                # id_contains = datasets.iloc[k]['dataset_id'] if isinstance(ds_filter,pd.DataFrame) and len(ds_filter)>1 else None
-                new_agencies = src.get_agencies(datasets['TableType'][k], year=datasets.iloc[k]["Year"])
-
-            with open(output_file, "w") as f:
-                f.write(','.join(new_agencies))
+                            span["probe"] = "load"
+                            t = src.load(datasets['TableType'][k], datasets['Year'][k], url=datasets['URL'][k], id=datasets['dataset_id'][k])
+                            new_agencies = t.table[datasets['agency_field'][k]].unique()
+                        if datasets['agency_field'][k] == "ORI":
+                            if datasets['Year'][k]<=2020:
+                                data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2022-08/URSUS_ORI-Agency_Names_20210902.xlsx","Agency","ORI_Number",pd.read_excel)
+                            elif datasets['Year'][k]==2021:
+                                data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2022-08/UseofForce_ORI-Agency_Names_2021.csv","AGENCY_NAME","ORI", pd.read_csv)
+                            elif datasets['Year'][k]==2022:
+                                data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2023-06/UseofForce_ORI-Agency_Names_2022f.csv","AGENCY_NAME","ORI", pd.read_csv)
+                            elif datasets['Year'][k]==2023:
+                                data = (r"https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2024-07/UseofForce_ORI-Agency_Names_2023.csv","AGENCY_NAME","ORI", pd.read_csv)
+                            else:
+                                raise ValueError("Unknown dataset")
+                            ori_df = data[3](download_cache.fetch(data[0]))
+                            for j in range(len(new_agencies)):
+                                match = ori_df[data[1]][ori_df[data[2]] == new_agencies[j]]
+                                if len(match)!=1:
+                                    raise NotImplementedError()
+                                else:
+                                    new_agencies[j] = match.iloc[0]
+                    else:
+                        url = datasets['URL'][k]
+                        new_agencies = None
+                        if k in prefetched:
+                            span["probe"] = "prefetched"
+                            try:
+                                new_agencies = prefetched.pop(k).result()
+                            except Exception as e:
+                                # The file could not be downloaded or parsed in the pool. Request the agencies below.
+                                breaker.record_failure(url, e)
+                                warnings.warn(f'Unable to read {url} for {datasets["SourceName"][k]} {datasets["TableType"][k]}: {e}')
+                                span["prefetch_error"] = type(e).__name__
+
+                        if new_agencies is None:
+                            if not breaker.allow(url):
+                                # The row stays out of date in the registry and is retried in the next run
+                                print(f"Skipping {url}: circuit breaker is open for host {host_of(url)}")
+                                span["outcome"] = "skipped"
+                                continue
+                            try:
+                                if distinct_agencies.supported(datasets.loc[k]):
+                                    # Distinct agencies are requested from the server
+                                    span["probe"] = "distinct"
+                                    new_agencies = distinct_agencies.fetch(datasets.loc[k], metrics.session)
+                                else:
+                                    # ds_filter, _ = src._Source__filter_for_source(datasets['TableType'][k], datasets.iloc[k]["Year"], None, None, errors=False)
+                                    # url_contains = datasets.iloc[k]['URL'] if isinstance(ds_filter,pd.DataFrame) and len(ds_filter)>1 else None
+                                    # id_contains = datasets.iloc[k]['dataset_id'] if isinstance(ds_filter,pd.DataFrame) and len(ds_filter)>1 else None
+                                    span["probe"] = "get_agencies"
+                                    new_agencies = src.get_agencies(datasets['TableType'][k], year=datasets.iloc[k]["Year"])
+                            except Exception as e:
+                                if not is_host_failure(e):
+                                    raise
+                                breaker.record_failure(url, e)
+                                warnings.warn(f'Unable to reach {host_of(url)} for {datasets["SourceName"][k]} {datasets["TableType"][k]}: {e}')
+                                span["outcome"] = "host_failure"
+                                span["error"] = type(e).__name__
+                                continue
+                            breaker.record_success(url)
+
+                    with open(output_file, "w") as f:
+                        f.write(','.join(new_agencies))
+                    span["agencies"] = len(new_agencies)
             
-            for agency in new_agencies:
-                if pd.isnull(agency) or len(agency)==1:
-                    continue
-                add_agency(agency, datasets['State'][k], agencies)
-    print(f"OPD contains data for {len(agencies)} police agencies")
+                registry.add_row(datasets.loc[k], new_agencies)
+                # Keep the progress of long runs
+                registry.save()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    registry.save()
+    metrics.close()
+    metrics.print_summary()
+    print(f"OPD contains data for {len(registry)} police agencies")
+    if breaker.open_hosts():
+        print("Hosts skipped by circuit breaker:\n" + breaker.summary())
 
 def update_ripa(url, dict_url, year):
     src_file = r"opd_source_table.csv"
@@ -542,7 +583,10 @@ def update_ripa(url, dict_url, year):
 
     q1_data = []
 
-    with opd.httpio.open(url, block_size=2**20) as fp:
+    # The zip file is several GB, so unless it is already in the cache, only the files in it that are needed are
+    # read with range requests rather than downloading it
+    path = download_cache.cached(url)
+    with (open(path, 'rb') if path else opd.httpio.open(url, block_size=2**20)) as fp:
         with ZipFile(fp, 'r') as z:
             for name in z.namelist():
                 if name.endswith('/'):
@@ -579,7 +623,11 @@ def update_ripa(url, dict_url, year):
                     new_entry['Agency'] = 'State Patrol'
                     new_entry['AgencyFull'] = 'California Highway Patrol'
                 else:
-                    data = pd.read_excel(BytesIO(z.read(name)))
+                    # Only the agency column is needed
+                    with z.open(name) as member:
+                        data = read_columns(member, [base['agency_field']])
+                    if data is None:
+                        data = pd.read_excel(BytesIO(z.read(name)))
 
                     if data[base['agency_field']].nunique()>1:
                         county = m.group('loc') + " County"
@@ -626,10 +674,21 @@ def update_ripa(url, dict_url, year):
                 df_save.to_csv(src_file, index=False)
 
 
-        
-update_dates(kstart=0)
-# count_agencies()
 
-# update_ripa('https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2025-12/ripa-stop-data-2024.zip',
-#             'https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2025-12/ripa-stop-dataset-readme-2024.pdf',
-#             2024)
\ No newline at end of file
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('--kstart', type=int, default=0, help='Index of first row to check')
+    p.add_argument('--scheduled', action='store_true', help='Only check rows that are due based on how often they are updated, most overdue first')
+    p.add_argument('--max-minutes', type=float, default=None, help='Maximum run time in minutes')
+    p.add_argument('--max-probes', type=int, default=None, help='Maximum number of requests for the data of MULTIPLE year rows')
+    p.add_argument('--full', action='store_true', help='Also check rows whose coverage cannot change (past single years, Stanford, and deleted datasets)')
+    p.add_argument('--workers', type=int, default=None, help='Number of processes for parsing Excel files. By default, files are parsed serially.')
+    args = p.parse_args()
+
+    update_dates(kstart=args.kstart, scheduled=args.scheduled, max_minutes=args.max_minutes, max_probes=args.max_probes,
+                 full=args.full, workers=args.workers)
+    # count_agencies(workers=args.workers)
+
+    # update_ripa('https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2025-12/ripa-stop-data-2024.zip',
+    #             'https://data-openjustice.doj.ca.gov/sites/default/files/dataset/2025-12/ripa-stop-dataset-readme-2024.pdf',
+    #             2024)
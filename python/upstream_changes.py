@@ -0,0 +1,72 @@
+"""Skip rows whose data has not been updated by their publisher since their coverage was last checked.
+
+Some portals report when each dataset was last updated, and the update times of every dataset on a portal (or
+service) can be found with one or a few requests. SWEEPS maps a DataType to a function that finds the update times
+of its rows in bulk. The update time seen when each row's coverage was last checked is stored, and rows whose
+update time has not changed since do not need to be checked.
+
+    changes = UpstreamChanges()
+    updated = changes.sweep(df)
+    df = df[~changes.unchanged(df, updated)]
+    ...
+    changes.record(source_table_id, updated[k])
+    changes.save()
+
+If the update times of a portal cannot be found, its rows are checked as usual.
+"""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import pandas as pd
+
+import arcgis_layers
+import ckan_portal
+import socrata_catalog
+import state
+from circuit_breaker import HostCircuitBreaker
+from run_metrics import metered_session
+from scheduler import Budget
+
+
+STATE_FILE = "upstream_updates.json"
+# DataType: function(df, breaker, session) returning the update time of each row of df (null if unknown)
+SWEEPS = {
+    "ArcGIS": arcgis_layers.sweep,
+    "CKAN": ckan_portal.sweep,
+    "Socrata": socrata_catalog.sweep,
+}
+
+
+class UpstreamChanges:
+    def __init__(self, state_file: str = STATE_FILE) -> None:
+        self.state_file = state_file
+        # source_table_id -> update time from the portal when coverage was last checked
+        self._checked: dict[str, str] = state.load_json(state_file)
+
+    def save(self) -> None:
+        state.save_json(self.state_file, self._checked)
+
+    def sweep(self, df: pd.DataFrame, breaker: Optional[HostCircuitBreaker] = None, budget: Optional[Budget] = None) -> pd.Series:
+        """Current update time of each row of df. Rows whose update time could not be found (e.g. because budget was
+        exhausted) are null.
+        """
+        updated = pd.Series(None, index=df.index, dtype=object)
+        with metered_session() as session:
+            for data_type, sweep in SWEEPS.items():
+                rows = df[df["DataType"] == data_type]
+                if len(rows) > 0:
+                    updated[rows.index] = sweep(rows, breaker, session, budget).values
+        return updated
+
+    def unchanged(self, df: pd.DataFrame, updated: pd.Series) -> pd.Series:
+        """Mask of rows of df whose data has not been updated since their coverage was last checked"""
+        updated = updated.reindex(df.index)
+        checked = df["source_table_id"].map(self._checked)
+        return updated.notnull() & (checked == updated)
+
+    def record(self, source_table_id: str, updated: Optional[str]) -> None:
+        """Record the update time of a row whose coverage has been checked"""
+        if isinstance(updated, str):
+            self._checked[source_table_id] = updated
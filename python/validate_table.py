@@ -0,0 +1,155 @@
+"""Validate every row of the source table at once.
+
+Each rule is a vectorized check over the whole table that returns a mask of the rows that violate it, so the
+full table is validated in well under a second. This is fast enough to run whenever the table is saved.
+validate returns one row per violation:
+
+    python validate_table.py ../opd_source_table.csv
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from generate_source_table_ids import KEY_COLUMNS, SOURCE_TABLE_ID, build_source_table_id
+
+
+SOURCE_TABLE = Path(__file__).parent.parent / "opd_source_table.csv"
+
+_BASE_FIELDS = ["State", "SourceName", "Agency", "AgencyFull", "TableType", "DataType"]
+# Fields that must be set for each DataType (lower case). date_field is also required for MULTIPLE year API datasets.
+REQUIRED_FIELDS = {
+    "arcgis": _BASE_FIELDS,
+    "carto": _BASE_FIELDS + ["dataset_id"],
+    "ckan": _BASE_FIELDS + ["dataset_id"],
+    "csv": _BASE_FIELDS,
+    "excel": _BASE_FIELDS,
+    "html": _BASE_FIELDS,
+    "opendatasoft": _BASE_FIELDS + ["dataset_id"],
+    "socrata": _BASE_FIELDS + ["dataset_id"],
+}
+API_DATA_TYPES = ["arcgis", "carto", "ckan", "opendatasoft", "socrata"]
+DATE_FORMAT = "%m/%d/%Y"
+VIOLATION_COLUMNS = ["row", SOURCE_TABLE_ID, "rule", "column", "message"]
+
+
+def _text(df: pd.DataFrame, column: str) -> pd.Series:
+    """Column as stripped strings with missing values as empty strings. Parsed values (e.g. dicts) are converted to JSON."""
+    if column not in df:
+        return pd.Series("", index=df.index)
+    values = df[column]
+    if values.dtype == object:
+        values = values.map(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else x)
+    return values.astype(object).where(values.notnull(), "").astype(str).str.strip()
+
+
+def _dates(df: pd.DataFrame, column: str) -> tuple[pd.Series, pd.Series]:
+    """Parsed dates and mask of values that are set but cannot be parsed"""
+    if column in df and pd.api.types.is_datetime64_any_dtype(df[column]):
+        return df[column], pd.Series(False, index=df.index)
+    text = _text(df, column)
+    dates = pd.to_datetime(text.where(text != ""), format=DATE_FORMAT, errors="coerce")
+    return dates, (text != "") & dates.isnull()
+
+
+def _json_invalid(value: str) -> bool:
+    try:
+        json.loads(value)
+        return False
+    except json.JSONDecodeError:
+        return True
+
+
+def validate(df: pd.DataFrame) -> pd.DataFrame:
+    """Apply every rule to df. Returns a DataFrame with one row per violation and columns VIOLATION_COLUMNS,
+    where row is the index of the row in df.
+
+    df can be the table as read from the CSV file or as returned by opd.datasets.query.
+    """
+    data_type = _text(df, "DataType").str.lower()
+    year = _text(df, "Year")
+    ids = _text(df, SOURCE_TABLE_ID)
+    found = []
+
+    def add(mask, rule, column, message):
+        if mask.any():
+            found.append(pd.DataFrame({"row": df.index[mask.to_numpy()], "rule": rule, "column": column, "message": message}))
+
+    add(~data_type.isin(list(REQUIRED_FIELDS)), "unknown_data_type", "DataType", "DataType is not supported")
+    # Datasets containing multiple agencies (or no agency) do not have a full agency name
+    single_agency = ~_text(df, "Agency").isin(["MULTIPLE", "NONE"])
+    for column in _BASE_FIELDS + ["dataset_id"]:
+        needs = data_type.isin([dt for dt, fields in REQUIRED_FIELDS.items() if column in fields])
+        if column == "AgencyFull":
+            needs &= single_agency
+        add(needs & (_text(df, column) == ""), "required_field", column, f"{column} is required for this DataType")
+
+    add(data_type.isin(API_DATA_TYPES) & (year == "MULTIPLE") & (_text(df, "date_field") == ""),
+        "multi_year_date_field", "date_field", "date_field is required for MULTIPLE year API datasets")
+
+    add(~(year.str.fullmatch(r"\d{4}") | year.isin(["MULTIPLE", "NONE"])), "invalid_year", "Year",
+        "Year must be a 4-digit year, MULTIPLE, or NONE")
+
+    if SOURCE_TABLE_ID in df:
+        add(ids.duplicated(keep=False) & (ids != ""), "duplicate_id", SOURCE_TABLE_ID, f"{SOURCE_TABLE_ID} is not unique")
+        keys = pd.DataFrame({c: _text(df, c) for c in KEY_COLUMNS})
+        expected = pd.Series([build_source_table_id(r) for r in keys.to_dict("records")], index=df.index)
+        add(ids != expected, "stale_id", SOURCE_TABLE_ID, f"{SOURCE_TABLE_ID} does not match key columns")
+
+    dataset_id = _text(df, "dataset_id")
+    is_json = dataset_id.str.startswith(("{", "["))
+    invalid_json = dataset_id.where(is_json, "null").map(_json_invalid).astype(bool)
+    add(invalid_json, "invalid_json", "dataset_id", "dataset_id is not valid JSON")
+
+    dates = {}
+    for column in ["coverage_start", "coverage_end", "last_coverage_check"]:
+        dates[column], invalid = _dates(df, column)
+        add(invalid, "invalid_date", column, f"{column} is not a {DATE_FORMAT} date")
+    add(dates["coverage_start"] > dates["coverage_end"], "date_order", "coverage_start", "coverage_start is after coverage_end")
+
+    if not found:
+        return pd.DataFrame(columns=VIOLATION_COLUMNS)
+    violations = pd.concat(found, ignore_index=True)
+    violations[SOURCE_TABLE_ID] = ids[violations["row"]].values
+    return violations[VIOLATION_COLUMNS].sort_values(["row", "rule"], kind="stable").reset_index(drop=True)
+
+
+def new_violations(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    """Violations in after that are not in before. Rows are matched by source_table_id (or row if it is not set)."""
+    def key(v):
+        return v[SOURCE_TABLE_ID].where(v[SOURCE_TABLE_ID] != "", v["row"].astype(str)) + "|" + v["rule"] + "|" + v["column"]
+    return after[~key(after).isin(key(before))]
+
+
+def warn_new_violations(before: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    """Validate df and print violations that are not in before. Returns all violations of df."""
+    violations = validate(df)
+    new = new_violations(before, violations)
+    if len(new) > 0:
+        print(f"WARNING: {len(new)} new validation error(s) in the source table:")
+        for v in new.head(20).itertuples():
+            print(f"    row {v.row} ({getattr(v, SOURCE_TABLE_ID)}): {v.message}")
+    return violations
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source_table", nargs="?", default=SOURCE_TABLE, type=Path, help="Path to opd_source_table.csv")
+    parser.add_argument("-o", "--output", type=Path, help="Write violations to this CSV file")
+    args = parser.parse_args()
+
+    violations = validate(pd.read_csv(args.source_table, dtype=str, keep_default_na=False))
+    print(f"{len(violations)} violation(s)")
+    for (rule, column), n in violations.groupby(["rule", "column"]).size().items():
+        print(f"    {rule} ({column}): {n}")
+    if args.output:
+        violations.to_csv(args.output, index=False)
+    return 1 if len(violations) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,90 @@
+"""Persistent cache of the years contained in MULTIPLE year datasets.
+
+For API datasets, loader.get_years() runs a count query for every year. The years found are cached by
+source_table_id so that later runs only check years from the last known year onward, which is typically
+1 or 2 requests. If an upstream validator (e.g. a last-modified timestamp from the portal) is provided and
+has not changed, no requests are made. The cache entry is discarded if the row's date_field or query changes
+and is fully refreshed periodically to pick up data that has been backfilled or removed.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import state
+
+
+CACHE_FILE = "year_spans.json"
+FULL_REFRESH_DAYS = 90
+
+
+def row_fingerprint(row) -> str:
+    """Hash of the fields of a row that affect which years are found. URL and dataset_id are part of source_table_id."""
+    fields = {k: row.get(k) for k in ["date_field", "query"]}
+    fields = {k: (None if not isinstance(v, (str, dict, list)) else v) for k, v in fields.items()}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class YearSpanCache:
+    def __init__(self, cache_file: str = CACHE_FILE, full_refresh_days: int = FULL_REFRESH_DAYS) -> None:
+        self.cache_file = cache_file
+        self.full_refresh_days = full_refresh_days
+        self._entries: dict[str, dict[str, Any]] = state.load_json(cache_file)
+        self.requests_saved = 0
+
+    def save(self) -> None:
+        state.save_json(self.cache_file, self._entries)
+
+    def known_years(self, source_table_id: str) -> list[int]:
+        entry = self._entries.get(source_table_id)
+        return list(entry["years"]) if entry else []
+
+    def invalidate(self, source_table_id: str) -> None:
+        self._entries.pop(source_table_id, None)
+
+    def get_years(self, loader, source_table_id: str, fingerprint: str, validator: Optional[str] = None,
+                  now: Optional[datetime] = None) -> list[int]:
+        """Get years in a dataset, using cached years where possible.
+
+        Parameters
+        ----------
+        loader : Data_Loader
+            OPD loader for the dataset. Its get_years method must accept the check keyword
+        source_table_id : str
+            ID of the row in the source table
+        fingerprint : str
+            Result of row_fingerprint for the row
+        validator : str
+            (Optional) Value from the data portal that changes when the data changes
+        """
+        now = now or datetime.now()
+        current_year = now.year
+        entry = self._entries.get(source_table_id)
+
+        if entry is None or entry["fingerprint"] != fingerprint or len(entry["years"]) == 0 or \
+            now - datetime.fromisoformat(entry["full_check"]) > timedelta(days=self.full_refresh_days):
+            years = sorted(loader.get_years())
+            full_check = now.isoformat(timespec="seconds")
+        elif validator is not None and entry.get("validator") == validator:
+            self.requests_saved += max(entry["years"]) - min(entry["years"]) + 1
+            return list(entry["years"])
+        else:
+            last_known = max(entry["years"])
+            check = list(range(last_known, current_year + 1))
+            new_years = loader.get_years(check=check)
+            self.requests_saved += max(0, last_known - min(entry["years"]))
+            # Last known year is rechecked in case it no longer contains data
+            years = sorted(set(y for y in entry["years"] if y < last_known) | set(new_years))
+            full_check = entry["full_check"]
+
+        self._entries[source_table_id] = {
+            "years": [int(y) for y in years],
+            "fingerprint": fingerprint,
+            "validator": validator,
+            "full_check": full_check,
+            "last_check": now.isoformat(timespec="seconds"),
+        }
+        return years